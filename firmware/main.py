@@ -14,11 +14,18 @@ SERVER_PORT = 5005
 HEADER_FORMAT = "!IBB"
 FLAG_AGGREGATED = 0x01
 
+READ_INTERVAL_MS = 500  # Time between readings (sped up for the demo)
+# Longest a reading may wait in the buffer per mode, ms (simulation/strategy.py MAX_AGE)
+MAX_AGE_MS = {"REAL-TIME": 60_000, "BALANCED": 1_800_000, "SURVIVAL": 3_600_000}
+URGENT_ABOVE = 40  # Alarm: a reading above this is sent at once
+
 
 class VirtualFirmware:
     def __init__(self):
         self.seq = 0
         self.buffer = []
+        self.oldest = None  # ticks_ms of the first buffered reading
+        self.urgent = False
         self.mock_battery = 100  # Start at 100%
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -49,7 +56,17 @@ class VirtualFirmware:
         else:
             return 10, "SURVIVAL"
 
-    def flush(self):
+    def flush_reason(self, threshold, mode):
+        if self.urgent:
+            return "URGENT"
+        if len(self.buffer) >= threshold:
+            return "COUNT"
+        # Deadline: flush on the last reading that still gets the oldest one out within MAX_AGE_MS
+        if time.ticks_diff(time.ticks_ms(), self.oldest) + READ_INTERVAL_MS >= MAX_AGE_MS[mode]:
+            return "DEADLINE"
+        return None
+
+    def flush(self, reason="COUNT"):
         if not self.buffer: return
 
         payload_format = f"{len(self.buffer)}B"
@@ -60,7 +77,9 @@ class VirtualFirmware:
 
         packet = header_bytes + payload_bytes
 
-        print(f"🚀 TX: Packet #{self.seq} | {len(packet)} bytes -> {SERVER_IP}:{SERVER_PORT}")
+        age = time.ticks_diff(time.ticks_ms(), self.oldest) / 1000
+        print(f"🚀 TX: Packet #{self.seq} | {len(packet)} bytes | {reason}, oldest reading {age:.1f}s -> "
+              f"{SERVER_IP}:{SERVER_PORT}")
         try:
             # Wokwi GUEST network will route this out to the internet
             self.sock.sendto(packet, socket.getaddrinfo(SERVER_IP, SERVER_PORT)[0][-1])
@@ -69,23 +88,30 @@ class VirtualFirmware:
 
         self.seq += 1
         self.buffer = []
+        self.oldest = None
+        self.urgent = False
 
     def run(self):
         print("=== VIRTUAL FIRMWARE STARTED ===")
         while True:
             reading = random.randint(20, 30)
+            if not self.buffer:
+                self.oldest = time.ticks_ms()
             self.buffer.append(reading)
+            if reading > URGENT_ABOVE:
+                self.urgent = True
 
             bat_level = self.get_battery_level()
             threshold, mode = self.get_strategy(bat_level)
 
             print(f"[Loop] Bat: {bat_level}% | Mode: {mode} | Buffer: {len(self.buffer)}/{threshold}")
 
-            if len(self.buffer) >= threshold:
-                self.flush()
+            reason = self.flush_reason(threshold, mode)
+            if reason:
+                self.flush(reason)
 
             # Time flows faster in our simulation so you don't have to wait all day
-            time.sleep(0.5)
+            time.sleep_ms(READ_INTERVAL_MS)
 
 
 if __name__ == "__main__":
@@ -1,67 +1,452 @@
 import socket
-import struct
 import time
 import os
-import csv
+import sys
+import signal
+import asyncio
+import argparse
+import multiprocessing
+import protocol_path  # noqa: F401 (makes the shared protocol modules in simulation/ importable)
+from persistence import LogWriter, FSYNC_NEVER, FSYNC_BATCH, FSYNC_INTERVAL
+from segment_store import SegmentSink
+from utils import FLAG_ACK, FLAG_V2, DL_CONFIG_REV, Packet, BufferPool
+from sessions import SessionTable, SEQ_DUPLICATE, SEQ_REPLAY
+from payload_codecs import codec_of
+from metrics import Metrics, SnapshotWriter, RateLimitedLog, kernel_udp_stats
+from ack_scheduler import AckScheduler, DownlinkTable, ACK_DELAY
+from aggregation_control import AggregationController, FRESHNESS_TARGET
+from reassembly import Reassembler
+from rollups import RollupStore
+from datagram_trace import TraceWriter
 
 # CONFIGURATION
 LISTEN_IP = "0.0.0.0"
 LISTEN_PORT = 5005
+RECV_BUFFER_SIZE = 1024  # = utils.MTU: bigger frames arrive as fragments (reassembly.py)
 LOG_FILE = "iot_gateway_log.csv"
+LOG_FSYNC = FSYNC_INTERVAL  # See persistence.py for the policies
+SEGMENT_DIR = "iot_gateway_segments"  # Columnar store (--store segments), see segment_store.py
+ROLLUP_FILE = "iot_gateway_rollups.roll"  # Per-device rollups and latest readings (python rollups.py)
 
-# PROTOCOL
-# Header: Seq (4B), Flags (1B), Budget (1B) -> 6 Bytes
-HEADER_FORMAT = "!IBB"
-HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
-FLAG_ACK = 0x02
+STORE_CSV = "csv"
+STORE_SEGMENTS = "segments"
 
+# Multi-core mode: one asyncio worker process per core, all bound to LISTEN_PORT
+DEFAULT_WORKERS = os.cpu_count() or 1
+SUPERVISOR_POLL = 1.0  # Seconds between worker health checks
+RESTART_BACKOFF = 1.0  # Minimum seconds between restarts of the same worker
+SESSION_SWEEP_INTERVAL = 60.0  # Seconds between idle-session sweeps
 
-def start_gateway():
+# Observability: counters/histograms snapshot (python ../simulation/metrics.py iot_gateway_stats*.json)
+STATS_FILE = "iot_gateway_stats.json"
+STATS_INTERVAL = 5.0  # Seconds between snapshots (0 = off)
+LOG_BURST = 10  # RX lines printed per second at most; the rest are counted, not printed
+
+# ACKs: held up to ACK_DELAY to cover several packets of a device (see ack_scheduler.py)
+CONFIG_REV = None  # Configuration revision announced to every device on its first ACKs (None = don't)
+
+
+class GatewayIngest:
+    """
+    The gateway pipeline for one socket: parse, de-duplicate, persist, ACK.
+    It never touches the socket itself, so every receive loop (classic or asyncio) shares it:
+    handle() and due_acks() return the (ack, addr) pairs to send.
+    """
+
+    def __init__(self, log_writer, tag="Gateway", metrics=None, ack_delay=ACK_DELAY, config_rev=CONFIG_REV,
+                 freshness=FRESHNESS_TARGET, capture=None):
+        self.log_writer = log_writer
+        self.tag = tag
+        self.capture = capture  # datagram_trace.TraceWriter: every datagram as received, for replay.py
+        self.sessions = SessionTable()
+        self.last_sweep = time.monotonic()
+        self.downlink = DownlinkTable()  # Settings piggybacked on the next ACKs of a device
+        # Frames bigger than the MTU, rebuilt from their fragments
+        self.fragments = Reassembler(delivered=self.delivered)
+        self.acks = AckScheduler(self.sessions.sack, ack_delay, downlink=self.downlink)
+        self.config_rev = config_rev
+        # Per-device threshold/retries from battery trend, loss and reading rate (None = devices decide alone)
+        self.controller = AggregationController(self.downlink, freshness) if freshness > 0 else None
+
+        self.metrics = metrics or Metrics(tag)
+        self.counters = self.metrics.counter("rx_packets", "rx_bytes", "malformed", "duplicates", "reboots",
+                                             "persist_dropped", "acks", "errors", "v2_packets",
+                                             "truncated")
+        self.t_parse = self.metrics.histogram("parse")
+        self.t_session = self.metrics.histogram("session")
+        self.t_persist = self.metrics.histogram("persist")
+        self.t_ack = self.metrics.histogram("ack")
+        self.t_total = self.metrics.histogram("total")
+        self.metrics.gauge("sessions", lambda: len(self.sessions))
+        self.metrics.gauge("acked_packets", lambda: self.acks.packets)
+        self.metrics.gauge("acks_held", self.acks.__len__)
+        self.metrics.gauge("downlink_pending", self.downlink.__len__)
+        self.metrics.gauge("reassembling", self.fragments.__len__)
+        self.metrics.gauge("reassembled", lambda: self.fragments.completed)
+        self.metrics.gauge("reassembly_dropped", lambda: self.fragments.expired + self.fragments.evicted)
+        self.metrics.gauge("reassembly_refused", lambda: self.fragments.refused)
+        if self.controller is not None:
+            self.metrics.gauge("controlled_devices", self.controller.__len__)
+            self.metrics.gauge("control_pushes", lambda: self.controller.pushes)
+        self.rx_log = RateLimitedLog(burst=LOG_BURST)
+
+    def handle(self, data, addr, arrival=None):
+        """
+        Processes one uplink datagram (data may be a memoryview into a reused receive buffer).
+        Returns the ACKs to send now: [(ack, addr)], empty if the datagram is dropped or its ACK is held.
+        arrival (Unix time) is the time logged with the readings; replay.py passes the captured one.
+        """
+        counters = self.counters
+        t0 = time.perf_counter_ns()
+        counters["rx_packets"] += 1
+        counters["rx_bytes"] += len(data)
+        arrival = time.time() if arrival is None else arrival
+        if self.capture is not None:
+            self.capture.write(data, addr, arrival)
+
+        # 0. Fragments wait for the rest of their frame; the last one brings the whole frame
+        data = self.fragments.feed(data, addr)
+        if data is None:
+            return []
+
+        # 1. Unpack Header (Header: Seq (4B), Flags (1B), Budget (1B) -> 6 Bytes)
+        seq, flags, budget, payload = Packet.unpack(data)
+        if seq is None or flags & FLAG_ACK:
+            counters["malformed"] += 1
+            return []
+        device_id, payload = Packet.split_device_id(flags, payload)
+        session_key = device_id if device_id is not None else addr
+        if flags & FLAG_V2:
+            counters["v2_packets"] += 1  # No nonce in the payload: whoever decrypts rebuilds it (see utils.py)
+        t1 = time.perf_counter_ns()
+        self.t_parse.record_ns(t1 - t0)
+
+        # 2. Per-device duplicate detection. Frames are not authenticated here, so a seq far
+        # below the window is taken as a device reboot (seq back to 0), not as a replay.
+        verdict = self.sessions.check(session_key, seq)
+        if verdict == SEQ_DUPLICATE:
+            # Retransmission: our ACK got lost. ACK again (right away) but don't store it twice.
+            counters["duplicates"] += 1
+            if self.controller is not None:
+                self.controller.observe(session_key, seq, budget, verdict)
+            acks = self.acks.ack(session_key, seq, addr, immediate=True)
+            counters["acks"] += len(acks)
+            return acks
+        if verdict == SEQ_REPLAY:
+            counters["reboots"] += 1
+            self.sessions.forget(session_key)
+            if self.controller is not None:
+                self.controller.forget(session_key)  # The rebooted device dropped our threshold/retries
+        if self.config_rev is not None and session_key not in self.sessions.slots:
+            self.downlink.push(session_key, {DL_CONFIG_REV: self.config_rev})  # New (or rebooted) device
+
+        now = time.monotonic()
+        self.sessions.update(session_key, seq, now)
+        if self.controller is not None:
+            self.controller.observe(session_key, seq, budget, verdict, now)  # May queue a downlink for this ACK
+        if now - self.last_sweep >= SESSION_SWEEP_INTERVAL:
+            self.sessions.evict_idle(now)
+            self.fragments.expire(now)
+            if self.controller is not None:
+                self.controller.evict_idle(now)
+            self.last_sweep = now
+        t2 = time.perf_counter_ns()
+        self.t_session.record_ns(t2 - t1)
+
+        # 3. Process Data (Simplified for Demo)
+        # In production, you would decrypt 'payload' here using the key.
+        # For now, we assume raw binary or hex for visibility.
+
+        # Sampled console line: printing every packet would cap the gateway at console speed
+        if self.rx_log.allow():
+            print(f"[{time.strftime('%H:%M:%S')}] [{self.tag}] RX from {addr[0]} | Seq:{seq} | Bat:{budget}% | "
+                  f"Bytes:{len(payload)}")
+
+        # 4. Save to Disk (write-behind: queued here, written in batches by the log thread)
+        # The writer thread decodes the readings in batches (codec ID from the flags byte).
+        # The payload view dies with the receive buffer, so this is the one copy we make.
+        if not self.log_writer.submit((arrival, addr[0], seq, budget, bytes(payload), device_id, codec_of(flags))):
+            counters["persist_dropped"] += 1
+        t3 = time.perf_counter_ns()
+        self.t_persist.record_ns(t3 - t2)
+
+        # 5. Send ACK (Optional, but good for protocol completeness)
+        # Ack packet: Seq (4), Flag (ACK | SACK), Budget (0), Cumulative + Bitmap for windowed senders,
+        # plus any downlink for the device. A device mid-burst gets one ACK for several packets.
+        acks = self.acks.ack(session_key, seq, addr)
+        counters["acks"] += len(acks)
+        t4 = time.perf_counter_ns()
+        self.t_ack.record_ns(t4 - t3)
+        self.t_total.record_ns(t4 - t0)
+        return acks
+
+    def delivered(self, session_key, seq):
+        """For the Reassembler: True if that frame is in already."""
+        return self.sessions.check(session_key, seq) == SEQ_DUPLICATE
+
+    def due_acks(self):
+        """Held ACKs whose delay is over: [(ack, addr)]."""
+        acks = self.acks.due()
+        self.counters["acks"] += len(acks)
+        return acks
+
+
+def open_log_writer(log_file, fsync=LOG_FSYNC, store=STORE_CSV, segment_dir=SEGMENT_DIR, metrics=None,
+                    rollup_file=ROLLUP_FILE):
+    sink = SegmentSink(segment_dir) if store == STORE_SEGMENTS else None
+    rollups = RollupStore(rollup_file) if rollup_file else None
+    return LogWriter(log_file, fsync=fsync, sink=sink, metrics=metrics, rollups=rollups).start()
+
+
+def start_metrics(metrics, sock, log_writer, stats_file, stats_interval, capture=None):
+    """Queue depths as gauges, plus the periodic snapshot file (returned, or None if disabled)."""
+    metrics.gauge("log_queue", log_writer.queue.qsize)
+    metrics.gauge("log_written", lambda: log_writer.written)
+    metrics.gauge("log_dropped", lambda: log_writer.dropped)
+    if capture is not None:
+        metrics.gauge("captured", lambda: capture.records)
+        metrics.gauge("capture_skipped", lambda: capture.skipped)
+    if log_writer.rollups is not None:
+        metrics.gauge("rollup_devices", log_writer.rollups.__len__)
+        metrics.gauge("rollup_evictions", lambda: log_writer.rollups.evictions)
+    metrics.gauge("kernel_rx_queue_bytes", lambda: (kernel_udp_stats(sock) or {}).get("rx_queue"))
+    metrics.gauge("kernel_drops", lambda: (kernel_udp_stats(sock) or {}).get("drops"))
+    return SnapshotWriter(metrics, stats_file, stats_interval).start() if stats_interval > 0 else None
+
+
+def start_gateway(fsync=LOG_FSYNC, store=STORE_CSV, stats_interval=STATS_INTERVAL, ack_delay=ACK_DELAY,
+                  config_rev=CONFIG_REV, freshness=FRESHNESS_TARGET, rollups=True, capture=None):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind((LISTEN_IP, LISTEN_PORT))
 
     print(f"IoT Gateway listening on port {LISTEN_PORT}")
-    print(f"Log file: {LOG_FILE}")
+    print(f"Log: {SEGMENT_DIR if store == STORE_SEGMENTS else LOG_FILE}")
+    if capture:
+        print(f"Capture: {capture}")
+
+    metrics = Metrics("gateway")
+    log_writer = open_log_writer(LOG_FILE, fsync, store, metrics=metrics, rollup_file=rollups and ROLLUP_FILE)
+    capture = TraceWriter(capture).open() if capture else None
+    snapshots = start_metrics(metrics, sock, log_writer, STATS_FILE, stats_interval, capture)
+    ingest = GatewayIngest(log_writer, metrics=metrics, ack_delay=ack_delay, config_rev=config_rev,
+                           freshness=freshness, capture=capture)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    # Datagrams are processed one at a time, so a single reused buffer is enough
+    buffers = BufferPool(count=1, size=RECV_BUFFER_SIZE)
+    holding = False  # ACKs held: recv wakes up after ack_delay to send them even if nothing arrives
 
-    # Initialize CSV if missing
-    if not os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'w', newline='') as f:
-            csv.writer(f).writerow(["Timestamp", "IP", "Seq", "Battery", "Payload_Size", "Data"])
+    try:
+        while True:
+            try:
+                if holding != (ingest.acks.next_due is not None):
+                    holding = not holding
+                    sock.settimeout(ack_delay if holding else None)  # Only on change: it costs a syscall
+                try:
+                    buf, nbytes, addr = buffers.recv_into(sock)
+                except socket.timeout:
+                    acks = []
+                else:
+                    try:
+                        if nbytes > len(buf):
+                            ingest.counters["truncated"] += 1  # Bigger than any fragment may be: don't store half
+                            acks = []
+                        else:
+                            acks = ingest.handle(memoryview(buf)[:nbytes], addr)
+                    finally:
+                        buffers.release(buf)
+                for ack, ack_addr in acks + ingest.due_acks():
+                    sock.sendto(ack, ack_addr)
 
-    while True:
+            except Exception as e:
+                metrics.counters["errors"] += 1
+                print(f"Error: {e}")
+    finally:
+        log_writer.close()
+        if capture:
+            capture.close()
+        if snapshots:
+            snapshots.close()
+
+
+# --- MULTI-CORE MODE ---
+class GatewayProtocol(asyncio.DatagramProtocol):
+    """
+    Event-loop version of the gateway loop. One instance runs per worker
+    process; the kernel spreads incoming datagrams across the workers.
+    """
+
+    def __init__(self, worker_id, log_writer, metrics=None, ack_delay=ACK_DELAY, config_rev=CONFIG_REV,
+                 freshness=FRESHNESS_TARGET, capture=None):
+        self.worker_id = worker_id
+        self.ingest = GatewayIngest(log_writer, tag=f"W{worker_id}", metrics=metrics, ack_delay=ack_delay,
+                                    config_rev=config_rev, freshness=freshness, capture=capture)
+        self.transport = None
+        self.ack_timer = None  # One timer for all held ACKs, not one per device
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
         try:
-            data, addr = sock.recvfrom(1024)
+            self.send(self.ingest.handle(data, addr))
+        except Exception as e:
+            self.ingest.counters["errors"] += 1
+            print(f"[W{self.worker_id}] Error: {e}")
 
-            if len(data) < HEADER_SIZE:
-                continue
+    def send(self, acks):
+        for ack, addr in acks:
+            self.transport.sendto(ack, addr)
+        next_due = self.ingest.acks.next_due
+        if next_due is not None and self.ack_timer is None:
+            # The scheduler's clock is time.monotonic, which is also the event loop's clock
+            self.ack_timer = asyncio.get_running_loop().call_at(next_due, self.send_due)
 
-            # 1. Unpack Header
-            header = data[:HEADER_SIZE]
-            payload = data[HEADER_SIZE:]
-            seq, flags, budget = struct.unpack(HEADER_FORMAT, header)
+    def send_due(self):
+        self.ack_timer = None
+        self.send(self.ingest.due_acks())
 
-            # 2. Process Data (Simplified for Demo)
-            # In production, you would decrypt 'payload' here using the key.
-            # For now, we assume raw binary or hex for visibility.
+    def error_received(self, exc):
+        print(f"[W{self.worker_id}] Socket error: {exc}")
 
-            # If payload is just bytes of integers (from your Sender.py logic)
-            # We can try to unpack them if we know it's not encrypted for this specific test
-            readings = list(payload)
 
-            print(f"[{time.strftime('%H:%M:%S')}] RX from {addr[0]} | Seq:{seq} | Bat:{budget}% | Bytes:{len(payload)}")
+def open_reuseport_socket(ip=LISTEN_IP, port=LISTEN_PORT):
+    """
+    Binds a UDP socket with SO_REUSEPORT so several processes can share the port.
+    The kernel hashes each (src ip, src port) to one socket, so a device
+    always lands on the same worker.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((ip, port))
+    sock.setblocking(False)
+    return sock
 
-            # 3. Save to Disk
-            with open(LOG_FILE, 'a', newline='') as f:
-                csv.writer(f).writerow([time.time(), addr[0], seq, budget, len(payload), readings])
 
-            # 4. Send ACK (Optional, but good for protocol completeness)
-            # Ack packet: Seq (4), Flag (ACK), Budget (0), No Payload
-            ack_header = struct.pack(HEADER_FORMAT, seq, FLAG_ACK, 0)
-            sock.sendto(ack_header, addr)
+def worker_file(path, worker_id):
+    # Each worker owns its own files so writes never interleave across processes
+    base, ext = os.path.splitext(path)
+    return f"{base}.w{worker_id}{ext}"
 
-        except Exception as e:
-            print(f"Error: {e}")
+
+async def serve_worker(worker_id, fsync=LOG_FSYNC, store=STORE_CSV, stats_interval=STATS_INTERVAL,
+                       ack_delay=ACK_DELAY, config_rev=CONFIG_REV, freshness=FRESHNESS_TARGET, rollups=True,
+                       capture=None):
+    log_file = worker_file(LOG_FILE, worker_id)
+    metrics = Metrics(f"w{worker_id}")
+    log_writer = open_log_writer(log_file, fsync, store, os.path.join(SEGMENT_DIR, f"w{worker_id}"), metrics,
+                                 rollups and worker_file(ROLLUP_FILE, worker_id))
+
+    capture = TraceWriter(worker_file(capture, worker_id)).open() if capture else None
+    sock = open_reuseport_socket()
+    snapshots = start_metrics(metrics, sock, log_writer, worker_file(STATS_FILE, worker_id), stats_interval, capture)
+
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: GatewayProtocol(worker_id, log_writer, metrics, ack_delay, config_rev, freshness, capture),
+        sock=sock)
+
+    print(f"[W{worker_id}] pid {os.getpid()} serving on port {LISTEN_PORT} -> "
+          f"{log_writer.sink.directory if store == STORE_SEGMENTS else log_file}")
+    try:
+        await loop.create_future()  # Run until the process is terminated
+    finally:
+        transport.close()
+        log_writer.close()
+        if capture:
+            capture.close()
+        if snapshots:
+            snapshots.close()
+
+
+def run_worker(worker_id, fsync=LOG_FSYNC, store=STORE_CSV, stats_interval=STATS_INTERVAL, ack_delay=ACK_DELAY,
+               config_rev=CONFIG_REV, freshness=FRESHNESS_TARGET, rollups=True, capture=None):
+    # terminate() from the supervisor sends SIGTERM; unwind so queued log records get written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(serve_worker(worker_id, fsync, store, stats_interval, ack_delay, config_rev, freshness,
+                                 rollups, capture))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+def start_gateway_workers(n_workers=DEFAULT_WORKERS, fsync=LOG_FSYNC, store=STORE_CSV, stats_interval=STATS_INTERVAL,
+                          ack_delay=ACK_DELAY, config_rev=CONFIG_REV, freshness=FRESHNESS_TARGET,
+                          rollups=True, capture=None):
+    """
+    Supervisor: starts N worker processes on the same port and restarts
+    any worker that exits.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT not supported on this platform. Falling back to single-core gateway.")
+        return start_gateway(fsync, store, stats_interval, ack_delay, config_rev, freshness, rollups, capture)
+
+    print(f"IoT Gateway listening on port {LISTEN_PORT} with {n_workers} workers")
+
+    workers = {}
+    last_start = {}
+
+    def spawn(worker_id):
+        p = multiprocessing.Process(target=run_worker,
+                                    args=(worker_id, fsync, store, stats_interval, ack_delay, config_rev, freshness,
+                                          rollups, capture),
+                                    name=f"gateway-w{worker_id}", daemon=True)
+        p.start()
+        workers[worker_id] = p
+        last_start[worker_id] = time.time()
+
+    for worker_id in range(n_workers):
+        spawn(worker_id)
+
+    # Make `kill <supervisor>` take the workers down with it
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        while True:
+            time.sleep(SUPERVISOR_POLL)
+            for worker_id, p in list(workers.items()):
+                if p.is_alive():
+                    continue
+                if time.time() - last_start[worker_id] < RESTART_BACKOFF:
+                    continue
+                print(f"[Supervisor] Worker {worker_id} (pid {p.pid}) exited with code {p.exitcode}. Restarting.")
+                spawn(worker_id)
+    except KeyboardInterrupt:
+        print("\n[Supervisor] Shutting down workers...")
+    finally:
+        for p in workers.values():
+            p.terminate()
+        for p in workers.values():
+            p.join()
 
 
 if __name__ == "__main__":
-    start_gateway()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="IoT Gateway")
+    parser.add_argument("--workers", type=int, default=0,
+                        help=f"Run N asyncio worker processes on the same port (0 = classic single loop, "
+                             f"cores on this box: {DEFAULT_WORKERS})")
+    parser.add_argument("--fsync", choices=[FSYNC_NEVER, FSYNC_BATCH, FSYNC_INTERVAL], default=LOG_FSYNC,
+                        help="When the log writer forces data to disk")
+    parser.add_argument("--store", choices=[STORE_CSV, STORE_SEGMENTS], default=STORE_CSV,
+                        help=f"CSV log or binary columnar segments in {SEGMENT_DIR}/")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help=f"Seconds between metrics snapshots to {STATS_FILE} (0 = off)")
+    parser.add_argument("--ack-delay", type=float, default=ACK_DELAY,
+                        help="Seconds an ACK may be held to cover more packets of a device (0 = ACK every packet)")
+    parser.add_argument("--config-rev", type=int, default=CONFIG_REV,
+                        help="Configuration revision piggybacked on the first ACKs of every device")
+    parser.add_argument("--freshness", type=float, default=FRESHNESS_TARGET,
+                        help="Seconds a reading may wait on the device: the aggregation controller's target "
+                             "(0 = controller off, devices follow their own battery tiers)")
+    parser.add_argument("--no-rollups", dest="rollups", action="store_false",
+                        help=f"Don't keep per-device rollups and latest readings in {ROLLUP_FILE}")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Append every received datagram to a binary trace (one per worker) for replay.py")
+    args = parser.parse_args()
+
+    if args.workers > 0:
+        start_gateway_workers(args.workers, args.fsync, args.store, args.stats_interval, args.ack_delay,
+                              args.config_rev, args.freshness, args.rollups, args.capture)
+    else:
+        start_gateway(args.fsync, args.store, args.stats_interval, args.ack_delay, args.config_rev, args.freshness,
+                      args.rollups, args.capture)
@@ -0,0 +1,178 @@
+import math
+import time
+from array import array
+import protocol_path  # noqa: F401
+from utils import DL_THRESHOLD, DL_RETRIES
+from sessions import SEQ_DUPLICATE, SEQ_NEW
+from strategy import select_strategy
+
+# Targets
+FRESHNESS_TARGET = 60.0  # Seconds the oldest reading of a packet may wait on the device
+DELIVERY_TARGET = 0.99  # Probability that a packet gets through, retries included
+LIFETIME_TARGET = 7 * 24 * 3600.0  # Battery life (at the current drain) below which retries are rationed
+
+# Bounds of what we recommend
+MAX_THRESHOLD = 32  # Readings per packet
+MAX_RETRIES = 3
+LOW_POWER_RETRIES = 1  # Retry budget for devices short of LIFETIME_TARGET
+
+ALPHA = 1 / 8  # EWMA weight of a new interval/drain sample (as for the RTT estimator)
+LOSS_ALPHA = 1 / 32  # Loss is a rare 0/1 event: average over more attempts (as LossEstimator's window)
+MIN_PACKETS = 4  # Packets seen before the first recommendation
+PUSH_INTERVAL = 60.0  # Seconds between two recommendations to the same device at most
+
+# Hysteresis, so a device isn't re-configured on every wobble of the estimates. Moves towards
+# freshness/reliability (smaller threshold, more retries) are never held back.
+THRESHOLD_GROWTH = 1.25  # A larger threshold is only pushed if it is at least this much larger
+RETRY_MARGIN = 1.25  # Fewer retries only if they would still do with this much more loss
+
+
+class AggregationController:
+    """
+    Gateway-side control loop for the aggregation threshold and retry budget of every device.
+
+    From the traffic alone it tracks, per device:
+      - the battery (Budget byte) and its trend in %/s,
+      - failed attempts: seqs that never arrived and retransmissions we had already received,
+      - the reading interval: time between packets divided by readings per packet.
+
+    Threshold: with the energy model of main.py (a fixed wake-up cost plus a cost per byte), the
+    energy per reading only falls as packets grow, so the optimum is the largest threshold that still
+    meets the freshness target: the first reading of a packet waits (threshold - 1) reading intervals.
+    Retries: the fewest that reach DELIVERY_TARGET at the observed loss, rationed to
+    LOW_POWER_RETRIES when the battery trend says the device won't last LIFETIME_TARGET.
+
+    Recommendations ride on the device's ACKs (DownlinkTable), only when they change and at most
+    every push_interval seconds. State lives in parallel arrays, as in SessionTable.
+    """
+
+    def __init__(self, downlink, freshness=FRESHNESS_TARGET, delivery=DELIVERY_TARGET, lifetime=LIFETIME_TARGET,
+                 push_interval=PUSH_INTERVAL, idle_timeout=3600.0):
+        self.downlink = downlink
+        self.freshness = freshness
+        self.delivery = delivery
+        self.lifetime = lifetime
+        self.push_interval = push_interval
+        self.idle_timeout = idle_timeout
+
+        self.slots = {}  # device key -> index into the arrays
+        self.free = []
+        self.budget = array('d')  # Last reported battery %
+        self.drain = array('d')  # EWMA of the battery trend, % per second (negative = draining)
+        self.last_time = array('d')
+        self.interval = array('d')  # EWMA of seconds between readings (0 = no sample yet)
+        self.loss = array('d')  # EWMA of failed attempts
+        self.highest = array('q')
+        self.packets = array('q')
+        self.threshold = array('q')  # What the device uses: our last recommendation, 0 = its own tiers
+        self.retries = array('q')  # Same, -1 = its own tiers
+        self.last_push = array('d')
+
+        self.pushes = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def observe(self, key, seq, budget, verdict, now=None):
+        """One uplink packet (verdict from SessionTable.check), possibly pushing a new recommendation."""
+        now = time.monotonic() if now is None else now
+        i = self.slots.get(key)
+        if i is None:
+            self._allocate(key, seq, budget, now)
+            return
+
+        # A retransmission of a packet we have: the device missed our ACK and paid for another attempt
+        if verdict == SEQ_DUPLICATE:
+            self.loss[i] += LOSS_ALPHA * (1.0 - self.loss[i])
+            return
+        missing = 0
+        if verdict == SEQ_NEW:
+            missing = max(0, min(seq - self.highest[i] - 1, 64))  # Never arrived, even with retries
+            if missing:
+                self.loss[i] = 1.0 - (1.0 - self.loss[i]) * (1.0 - LOSS_ALPHA) ** missing
+            self.highest[i] = seq
+        self.loss[i] *= 1.0 - LOSS_ALPHA
+
+        elapsed = now - self.last_time[i]
+        if elapsed > 0:
+            # The packets that never arrived carried readings too
+            readings = (self.threshold[i] or select_strategy(budget)[0]) * (missing + 1)
+            sample = elapsed / readings
+            previous = self.interval[i]
+            self.interval[i] = sample if not previous else previous + ALPHA * (sample - previous)
+            self.drain[i] += ALPHA * ((budget - self.budget[i]) / elapsed - self.drain[i])
+        self.budget[i] = budget
+        self.last_time[i] = now
+        self.packets[i] += 1
+
+        if self.packets[i] >= MIN_PACKETS and now - self.last_push[i] >= self.push_interval:
+            self._maybe_push(key, i, now)
+
+    def recommend(self, i):
+        """(threshold, retries) for device slot i, before hysteresis."""
+        threshold = 1
+        if self.interval[i] > 0:
+            threshold = 1 + int(self.freshness / self.interval[i])
+        threshold = max(1, min(MAX_THRESHOLD, threshold))
+
+        retries = self.retries_for(self.loss[i])
+        drain = -self.drain[i]
+        if drain > 0 and self.budget[i] / drain < self.lifetime:
+            retries = min(retries, LOW_POWER_RETRIES)
+        return threshold, retries
+
+    def retries_for(self, loss):
+        """Fewest retries r with loss^(r + 1) <= 1 - delivery target (attempts fail independently)."""
+        loss = min(max(loss, 1e-3), 0.95)
+        return min(MAX_RETRIES, max(0, math.ceil(math.log(1.0 - self.delivery) / math.log(loss)) - 1))
+
+    def evict_idle(self, now=None):
+        now = time.monotonic() if now is None else now
+        cutoff = now - self.idle_timeout
+        stale = [key for key, i in self.slots.items() if self.last_time[i] < cutoff]
+        for key in stale:
+            self.forget(key)
+        return len(stale)
+
+    def forget(self, key):
+        """Drops a device's state, e.g. after a reboot: it is back on its own tiers until we push again."""
+        i = self.slots.pop(key, None)
+        if i is not None:
+            self.free.append(i)
+
+    def _maybe_push(self, key, i, now):
+        threshold, retries = self.recommend(i)
+        current_threshold, current_retries = self.threshold[i], self.retries[i]
+        if current_threshold and current_threshold < threshold < current_threshold * THRESHOLD_GROWTH:
+            threshold = current_threshold
+        if retries < current_retries <= self.retries_for(self.loss[i] * RETRY_MARGIN):
+            retries = current_retries  # Still needed at a slightly worse loss rate: keep them
+        if threshold == current_threshold and retries == current_retries:
+            return
+        self.downlink.push(key, {DL_THRESHOLD: threshold, DL_RETRIES: retries})
+        # Interval samples now span readings at the new threshold: the EWMA divides by it from here
+        self.threshold[i] = threshold
+        self.retries[i] = retries
+        self.last_push[i] = now
+        self.pushes += 1
+
+    def _allocate(self, key, seq, budget, now):
+        if self.free:
+            i = self.free.pop()
+        else:
+            i = len(self.budget)
+            for column in (self.budget, self.drain, self.last_time, self.interval, self.loss, self.last_push):
+                column.append(0.0)
+            for column in (self.highest, self.packets, self.threshold, self.retries):
+                column.append(0)
+        self.slots[key] = i
+        self.budget[i] = budget
+        self.drain[i] = 0.0
+        self.last_time[i] = now
+        self.interval[i] = 0.0
+        self.loss[i] = 0.0
+        self.highest[i] = seq
+        self.packets[i] = 1
+        self.threshold[i] = 0
+        self.retries[i] = -1
+        self.last_push[i] = float("-inf")
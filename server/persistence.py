@@ -0,0 +1,209 @@
+import os
+import csv
+import time
+import queue
+import threading
+import protocol_path  # noqa: F401
+from payload_codecs import decode_batch
+
+LOG_HEADER = ["Timestamp", "IP", "Seq", "Battery", "Payload_Size", "Data"]
+
+# fsync policies
+FSYNC_NEVER = "never"  # Leave it to the OS page cache (fastest, may lose the last seconds on power loss)
+FSYNC_BATCH = "batch"  # fsync after every flushed batch
+FSYNC_INTERVAL = "interval"  # fsync at most once every fsync_interval seconds
+
+# Backpressure policies when the queue is full
+OVERFLOW_DROP = "drop"  # Drop the record and count it (receive loop never waits)
+OVERFLOW_BLOCK = "block"  # Wait up to block_timeout for room, then drop
+
+BATCH_SIZE_BOUNDS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+def format_readings(values):
+    # "21 22 23" instead of the Python list repr "[21, 22, 23]"
+    return " ".join(map(str, values))
+
+
+class CsvSink:
+    """
+    The gateway CSV log, kept open between batches and rotated by size or age.
+    Records are (timestamp, ip, seq, budget, payload, device_id, codec).
+    """
+
+    def __init__(self, path, rotate_bytes=64 * 1024 * 1024, rotate_seconds=24 * 3600):
+        self.path = path
+        self.rotate_bytes = rotate_bytes  # 0 disables size rotation
+        self.rotate_seconds = rotate_seconds  # 0 disables time rotation
+
+        self._file = None
+        self._writer = None
+        self._opened_at = 0.0
+
+    def open(self):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+        if new_file:
+            self._writer.writerow(LOG_HEADER)
+        self._opened_at = time.time()
+
+    def write_batch(self, batch, values, offsets):
+        self._maybe_rotate()
+        values = values.tolist()
+        self._writer.writerows(
+            (ts, ip, seq, budget, len(payload), format_readings(values[offsets[i]:offsets[i + 1]]))
+            for i, (ts, ip, seq, budget, payload, _, _) in enumerate(batch))
+        self._file.flush()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file:
+            self._file.flush()
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _maybe_rotate(self):
+        too_big = self.rotate_bytes and self._file.tell() >= self.rotate_bytes
+        too_old = self.rotate_seconds and time.time() - self._opened_at >= self.rotate_seconds
+        if not (too_big or too_old):
+            return
+
+        self.close()
+
+        base, ext = os.path.splitext(self.path)
+        rotated = f"{base}.{time.strftime('%Y%m%d-%H%M%S')}{ext}"
+        suffix = 1
+        while os.path.exists(rotated):
+            rotated = f"{base}.{time.strftime('%Y%m%d-%H%M%S')}-{suffix}{ext}"
+            suffix += 1
+        os.replace(self.path, rotated)
+        print(f"[LogWriter] Rotated {self.path} -> {rotated}")
+        self.open()
+
+
+class LogWriter:
+    """
+    Write-behind log for the gateway.
+
+    submit() only puts the record on a bounded in-memory queue. A background
+    thread keeps the sink open and writes records in batches, flushing when
+    batch_size records are pending or flush_interval seconds have passed.
+    The sink is the CSV log unless another one (e.g. segment_store.SegmentSink) is given.
+    Each batch is decoded once, here, for the sink and the optional rollups.RollupStore.
+    """
+
+    def __init__(self, path, batch_size=256, flush_interval=0.5, max_queue=10000,
+                 fsync=FSYNC_INTERVAL, fsync_interval=1.0,
+                 rotate_bytes=64 * 1024 * 1024, rotate_seconds=24 * 3600,
+                 overflow=OVERFLOW_DROP, block_timeout=0.01, sink=None, metrics=None, rollups=None):
+        self.path = path
+        self.rollups = rollups
+        self.sink = sink or CsvSink(path, rotate_bytes, rotate_seconds)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        # Optional metrics.Metrics: batch sizes and decode+write time per batch (this thread is the only writer)
+        self.batch_sizes = metrics.histogram("batch_size", BATCH_SIZE_BOUNDS) if metrics else None
+        self.write_time = metrics.histogram("write_batch") if metrics else None
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+
+        self._last_fsync = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self):
+        self.sink.open()
+        if self.rollups is not None:
+            self.rollups.open()
+        self._thread.start()
+        return self
+
+    def submit(self, record):
+        """
+        Queues one record: (timestamp, ip, seq, budget, payload, device_id, codec).
+        Returns False if the record was dropped because the queue is full.
+        """
+        try:
+            if self.overflow == OVERFLOW_BLOCK:
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        """Stops the writer thread after draining everything still queued."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.sink.close()
+        if self.rollups is not None:
+            self.rollups.close()
+
+    # --- WRITER THREAD ---
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while not (self._stop.is_set() and self.queue.empty()):
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+                # Drain whatever else is already waiting without blocking
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline or self._stop.is_set():
+                if batch:
+                    self._write_batch(batch)
+                    batch = []
+                if self.rollups is not None:
+                    self._checkpoint_rollups()
+                deadline = time.monotonic() + self.flush_interval
+
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        try:
+            started = time.perf_counter_ns()
+            values, offsets = decode_batch([r[6] for r in batch], [r[4] for r in batch])
+            self.sink.write_batch(batch, values, offsets)
+            if self.rollups is not None:
+                self.rollups.update(batch, values, offsets)
+            self.written += len(batch)
+            self.batches += 1
+            if self.write_time is not None:
+                self.write_time.record_ns(time.perf_counter_ns() - started)
+                self.batch_sizes.record(len(batch))
+
+            now = time.monotonic()
+            if self.fsync == FSYNC_BATCH or (
+                    self.fsync == FSYNC_INTERVAL and now - self._last_fsync >= self.fsync_interval):
+                self.sink.sync()
+                self._last_fsync = now
+        except OSError as e:
+            # Never let a disk error kill the writer thread; the records are lost, not the gateway
+            self.dropped += len(batch)
+            print(f"[LogWriter] Write failed ({len(batch)} records dropped): {e}")
+
+    def _checkpoint_rollups(self):
+        try:
+            self.rollups.maybe_checkpoint()
+        except OSError as e:
+            print(f"[LogWriter] Rollup checkpoint failed: {e}")
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Shared protocol code (header layout, sessions, codecs) lives next to the simulation.
+# Gateway-side modules import this first to make it importable.
+SIMULATION_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "simulation"))
+
+if SIMULATION_DIR not in sys.path:
+    sys.path.append(SIMULATION_DIR)
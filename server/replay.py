@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+import protocol_path  # noqa: F401
+from Gateway import GatewayIngest, open_log_writer, LOG_FILE, LOG_FSYNC, ROLLUP_FILE, SEGMENT_DIR, STORE_CSV, \
+    STORE_SEGMENTS
+from persistence import FSYNC_NEVER, FSYNC_BATCH, FSYNC_INTERVAL
+from ack_scheduler import ACK_DELAY
+from aggregation_control import FRESHNESS_TARGET
+from metrics import Metrics, LATENCY_BOUNDS_US
+from datagram_trace import merge_traces
+from utils import TAG_SIZE
+
+# CONFIGURATION
+OUT_DIR = "results/replay"  # Log, segments and rollups written by the replayed gateway (cleared on every run)
+RESULTS_FILE = "results/replay.json"
+
+TARGET_GATEWAY = "gateway"  # parse -> session -> persist (log writer + rollups) -> ACK
+TARGET_RECEIVER = "receiver"  # parse -> session -> decrypt -> decode -> ACK (simulation/Receiver.py, serial path)
+
+
+def drive(records, handle, speed=0.0, poll=None):
+    """
+    Feeds the datagrams to handle(data, addr, arrival) -> ACK count, in the calling thread.
+    speed 0 = as fast as possible, 1 = at the captured pacing, 2 = twice as fast...
+    poll() -> ACK count is called after every datagram (held ACKs coming due).
+    Returns (elapsed s, per-datagram handling ns, ACKs, lateness s per datagram or None).
+    """
+    latencies = np.empty(len(records), dtype=np.int64)
+    lateness = np.zeros(len(records)) if speed else None
+    acks = 0
+    first = records[0][0]
+    start = time.perf_counter()
+    for i, (arrival, addr, data) in enumerate(records):
+        if speed:
+            due = start + (arrival - first) / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                lateness[i] = -wait  # We can't keep up with the original traffic here
+        t0 = time.perf_counter_ns()
+        acks += handle(data, addr, arrival)
+        latencies[i] = time.perf_counter_ns() - t0
+        if poll is not None:
+            acks += poll()
+    return time.perf_counter() - start, latencies, acks, lateness
+
+
+def replay_gateway(records, speed, out_dir, store, fsync, rollups, ack_delay, freshness):
+    # A fresh gateway state and output on every run, so two replays of one trace do the same work
+    for path in (os.path.join(out_dir, LOG_FILE), os.path.join(out_dir, ROLLUP_FILE),
+                 os.path.join(out_dir, ROLLUP_FILE + ".idx")):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(os.path.join(out_dir, SEGMENT_DIR), ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+
+    metrics = Metrics("replay")
+    log_writer = open_log_writer(os.path.join(out_dir, LOG_FILE), fsync, store, os.path.join(out_dir, SEGMENT_DIR),
+                                 metrics, rollups and os.path.join(out_dir, ROLLUP_FILE))
+    ingest = GatewayIngest(log_writer, tag="Replay", metrics=metrics, ack_delay=ack_delay, freshness=freshness)
+
+    def poll():
+        next_due = ingest.acks.next_due
+        return len(ingest.due_acks()) if next_due is not None and next_due <= time.monotonic() else 0
+
+    elapsed, latencies, acks, lateness = drive(
+        records, lambda data, addr, arrival: len(ingest.handle(data, addr, arrival)), speed, poll)
+    acks += len(ingest.acks.flush())  # Whatever was still held at the end
+
+    # The log writer is behind the ingest loop: the run is over once it has written everything
+    started = time.perf_counter()
+    log_writer.close()
+    drain = time.perf_counter() - started
+    persisted = {"written": log_writer.written, "dropped": log_writer.dropped, "batches": log_writer.batches,
+                 "drain_s": round(drain, 3), "records_per_s": round(log_writer.written / (elapsed + drain), 1)}
+    return elapsed, latencies, acks, lateness, metrics, persisted
+
+
+def replay_receiver(records, speed, tag_size):
+    from Receiver import EnergyProtocolReceiver
+    from keystore import KeyRing
+
+    readings = [0]
+
+    def count_readings(device_id, seq, budget, values, size):
+        readings[0] += len(values)
+
+    # Bound to a spare port it never reads: datagrams come from the trace, ACKs are only counted
+    receiver = EnergyProtocolReceiver(KeyRing(tag_size=tag_size), port=0, workers=0, sink=count_readings)
+    acks = [0]
+
+    def count_acks(pending):
+        acks[0] += len(pending)
+        receiver.counters["acks"] += len(pending)
+    receiver.send_acks = count_acks
+
+    def handle(data, addr, arrival):
+        before = acks[0]
+        receiver.process_packet(data, addr)
+        return acks[0] - before
+
+    try:
+        elapsed, latencies, total_acks, lateness = drive(records, handle, speed)
+    finally:
+        receiver.stop()
+    return elapsed, latencies, total_acks, lateness, receiver.metrics, {"readings": readings[0]}
+
+
+def summarize(records, target, speed, elapsed, latencies, acks, lateness, metrics, extra):
+    us = latencies / 1000
+    traced = records[-1][0] - records[0][0]
+    summary = {
+        "target": target, "speed": speed, "datagrams": len(records),
+        "bytes": sum(len(data) for _, _, data in records),
+        "trace_s": round(traced, 3), "elapsed_s": round(elapsed, 3),
+        "datagrams_per_s": round(len(records) / elapsed, 1) if elapsed > 0 else None,
+        "acks": acks,
+        "handle_us": {"mean": round(float(us.mean()), 2),
+                      **{f"p{p:g}".replace(".", ""): round(float(np.percentile(us, p)), 2) for p in (50, 99, 99.9)},
+                      "max": round(float(us.max()), 2)},
+        "late_s": None if lateness is None else {"p99": round(float(np.percentile(lateness, 99)), 4),
+                                                 "max": round(float(lateness.max()), 4)},
+        **extra,
+    }
+    snapshot = metrics.snapshot()
+    summary["counters"] = snapshot["counters"]
+    # Per-stage times (the other histograms, e.g. batch sizes, aren't in microseconds)
+    summary["stages"] = {name: {k: h[k] for k in ("count", "mean", "p50", "p99", "p999", "max")}
+                         for name, h in snapshot["histograms"].items()
+                         if h["count"] and metrics.histograms[name].bounds is LATENCY_BOUNDS_US}
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured datagrams (Gateway.py --capture) through the "
+                                                 "ingest pipeline, without sockets")
+    parser.add_argument("traces", nargs="+", help="Trace files; several (one per worker) are merged by arrival time")
+    parser.add_argument("--target", choices=[TARGET_GATEWAY, TARGET_RECEIVER], default=TARGET_GATEWAY,
+                        help="Gateway pipeline, or the decrypting receiver of the simulation")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="0 = as fast as possible, 1 = original pacing, 2 = twice as fast...")
+    parser.add_argument("--repeat", type=int, default=1, help="Run the trace N times (fresh state each time)")
+    parser.add_argument("--out", default=OUT_DIR, help="Where the replayed gateway writes its log and rollups")
+    parser.add_argument("--store", choices=[STORE_CSV, STORE_SEGMENTS], default=STORE_CSV)
+    parser.add_argument("--fsync", choices=[FSYNC_NEVER, FSYNC_BATCH, FSYNC_INTERVAL], default=LOG_FSYNC)
+    parser.add_argument("--no-rollups", dest="rollups", action="store_false")
+    parser.add_argument("--ack-delay", type=float, default=ACK_DELAY)
+    parser.add_argument("--freshness", type=float, default=FRESHNESS_TARGET)
+    parser.add_argument("--tag-size", type=int, default=TAG_SIZE, help="v2 auth tag bytes (receiver target)")
+    parser.add_argument("--json", default=RESULTS_FILE, help="Where to write the summary")
+    args = parser.parse_args()
+
+    # 1. Load everything first: reading the trace is not part of what we measure
+    records = merge_traces(args.traces)
+    if not records:
+        raise SystemExit("Empty trace")
+    print(f"[Replay] {len(records)} datagrams over {records[-1][0] - records[0][0]:.1f}s -> {args.target} "
+          f"({'as fast as possible' if not args.speed else f'{args.speed:g}x original pacing'})")
+
+    # 2. Replay
+    runs = []
+    for run in range(args.repeat):
+        if args.target == TARGET_GATEWAY:
+            result = replay_gateway(records, args.speed, args.out, args.store, args.fsync, args.rollups,
+                                    args.ack_delay, args.freshness)
+        else:
+            result = replay_receiver(records, args.speed, args.tag_size)
+        runs.append(summarize(records, args.target, args.speed, *result))
+
+    # 3. Report (the best run: the one least disturbed by the rest of the machine)
+    summary = max(runs, key=lambda s: s["datagrams_per_s"] or 0)
+    summary["runs"] = [s["datagrams_per_s"] for s in runs]
+    os.makedirs(os.path.dirname(args.json) or ".", exist_ok=True)
+    with open(args.json, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    handle = summary["handle_us"]
+    print("\n" + "=" * 50)
+    print("   REPLAY RESULTS")
+    print("=" * 50)
+    print(f"Datagrams:     {summary['datagrams']} in {summary['elapsed_s']}s "
+          f"({summary['datagrams_per_s']}/s, trace {summary['trace_s']}s)")
+    if args.repeat > 1:
+        print(f"Runs:          {', '.join(f'{r:g}' for r in summary['runs'])} datagrams/s")
+    print(f"Per datagram:  mean {handle['mean']} us | p50 {handle['p50']} us | p99 {handle['p99']} us | "
+          f"p999 {handle['p999']} us | max {handle['max']} us")
+    print(f"ACKs:          {summary['acks']}")
+    if summary["late_s"] is not None:
+        late = summary["late_s"]
+        print(f"Behind pacing: p99 {late['p99'] * 1000:.1f} ms | max {late['max'] * 1000:.1f} ms")
+    if args.target == TARGET_GATEWAY:
+        print(f"Persisted:     {summary['written']} records ({summary['dropped']} dropped) in {summary['batches']} "
+              f"batches, {summary['records_per_s']}/s incl. {summary['drain_s']}s drain")
+    else:
+        print(f"Readings:      {summary['readings']}")
+    for name, h in summary["stages"].items():
+        print(f"  {name:<12} p50 {h['p50']:g} us | p99 {h['p99']:g} us")
+    print(f"Summary: {args.json}")
@@ -0,0 +1,346 @@
+import os
+import sys
+import time
+import glob
+import struct
+import argparse
+from array import array
+from collections import OrderedDict
+import numpy as np
+from segment_store import device_key
+
+# Rollup levels: (bucket seconds, buckets kept per device)
+RESOLUTIONS = ((60, 64), (3600, 48), (86400, 32))  # A bit over an hour of minutes, 2 days of hours, a month of days
+LATEST_N = 32  # Last readings kept per device
+MAX_DEVICES = 4096  # Devices kept in memory (~6 KB each); colder ones are only in the file until touched again
+CHECKPOINT_INTERVAL = 5.0  # Seconds between writes of the changed devices to the file
+
+# One device = one fixed-size array of float64, the same in memory and on disk:
+#   head      last_seen, battery, seq, next latest slot, latest count
+#   latest    timestamp[LATEST_N], value[LATEST_N]   (ring buffer)
+#   buckets   per level: [bucket number (time // seconds, -1 = empty), count, sum, min, max] * buckets kept
+F_SEEN, F_BATTERY, F_SEQ, F_POS, F_COUNT = range(5)
+HEAD = 5
+BUCKET_FIELDS = 5
+
+# File: <path> holds the records, <path>.idx the device of each record (uint32, record order) after a header
+IDX_HEADER = struct.Struct("<8sI")  # magic, doubles per record (a layout check)
+IDX_MAGIC = b"IOTROLL1"
+ROLLUP_EXT = ".roll"
+
+
+class RollupFile:
+    """
+    Compact on-disk rollups: one fixed-size record per device, rewritten in place,
+    so the file grows with the number of devices, never with history.
+    """
+
+    def __init__(self, path, record_doubles, readonly=False):
+        self.path = path
+        self.record_size = record_doubles * 8
+        self.record_doubles = record_doubles
+        self.readonly = readonly
+        self.records = {}  # device -> record number
+        self._data = None
+        self._idx = None
+
+    def open(self):
+        idx_path = self.path + ".idx"
+        if os.path.exists(idx_path):
+            with open(idx_path, 'rb') as f:
+                raw = f.read()
+            magic, doubles = IDX_HEADER.unpack_from(raw)
+            if magic != IDX_MAGIC or doubles != self.record_doubles:
+                raise ValueError(f"{self.path} was written with another rollup layout")
+            devices = np.frombuffer(raw, dtype="<u4", offset=IDX_HEADER.size)
+            self.records = {int(device): i for i, device in enumerate(devices)}
+        elif not self.readonly:
+            with open(idx_path, 'wb') as f:
+                f.write(IDX_HEADER.pack(IDX_MAGIC, self.record_doubles))
+        else:
+            raise FileNotFoundError(idx_path)
+
+        if self.readonly:
+            self._data = open(self.path, 'rb')
+        else:
+            self._data = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+            self._idx = open(idx_path, 'ab')
+
+    def read(self, device):
+        i = self.records.get(device)
+        if i is None:
+            return None
+        self._data.seek(i * self.record_size)
+        return self._data.read(self.record_size)
+
+    def write(self, device, record):
+        i = self.records.get(device)
+        if i is None:
+            i = len(self.records)
+            self.records[device] = i
+            self._idx.write(struct.pack("<I", device & 0xFFFFFFFF))
+        self._data.seek(i * self.record_size)
+        self._data.write(record)
+
+    def sync(self):
+        if not self.readonly:
+            # The index first: a record must never be on disk without its device
+            self._idx.flush()
+            os.fsync(self._idx.fileno())
+            self._data.flush()
+            os.fsync(self._data.fileno())
+
+    def close(self):
+        if self._data:
+            self.sync()
+            self._data.close()
+            self._data = None
+        if self._idx:
+            self._idx.close()
+            self._idx = None
+
+
+class RollupStore:
+    """
+    Per-device rollups (count/sum/min/max per minute, hour and day) and the last
+    LATEST_N readings, updated incrementally from the batches the log writer
+    decodes anyway. Answers "latest value" in O(1) and "min/mean/max over a window"
+    in O(buckets), without touching the log.
+
+    Memory is bounded: at most max_devices records stay in memory (LRU); an evicted
+    device is written to the file and read back the next time it shows up. Only
+    the log writer thread may update it; other processes query the file (see main).
+    """
+
+    def __init__(self, path=None, max_devices=MAX_DEVICES, resolutions=RESOLUTIONS, latest_n=LATEST_N,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, readonly=False):
+        self.max_devices = max_devices
+        self.resolutions = resolutions
+        self.latest_n = latest_n
+        self.checkpoint_interval = checkpoint_interval
+
+        # Where each level starts in a record
+        self.levels = []
+        pos = HEAD + 2 * latest_n
+        for seconds, n_buckets in resolutions:
+            self.levels.append((pos, seconds, n_buckets))
+            pos += n_buckets * BUCKET_FIELDS
+        self.record_doubles = pos
+        self.empty = array('d', [0.0] * pos)
+        for base, _, n_buckets in self.levels:
+            for at in range(base, base + n_buckets * BUCKET_FIELDS, BUCKET_FIELDS):
+                self.empty[at] = -1.0
+
+        self.cache = OrderedDict()  # device -> record (array('d')), least recently used first
+        self.dirty = set()
+        self.file = RollupFile(path, pos, readonly) if path else None
+        self._last_checkpoint = time.monotonic()
+
+        self.loads = 0  # Records read back from the file
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def open(self):
+        if self.file:
+            self.file.open()
+        return self
+
+    # --- INGEST (log writer thread) ---
+    def update(self, batch, values, offsets):
+        """
+        One written batch: log records (timestamp, ip, seq, budget, payload, device_id, codec)
+        and their decoded readings (values[offsets[i]:offsets[i + 1]] belong to record i).
+        """
+        offsets = np.asarray(offsets)
+        counts = np.diff(offsets)
+        # Sum/min/max of every record at once; empty records are left out (reduceat can't do empty ranges)
+        filled = np.flatnonzero(counts)
+        if len(filled):
+            starts = offsets[filled]
+            sums = np.add.reduceat(values, starts).tolist()
+            mins = np.minimum.reduceat(values, starts).tolist()
+            maxs = np.maximum.reduceat(values, starts).tolist()
+        values = values.tolist()
+        counts = counts.tolist()
+
+        j = 0
+        for i, (ts, ip, seq, budget, _, device_id, _) in enumerate(batch):
+            device = device_key(ip, device_id)
+            record = self._record(device)
+            record[F_SEEN] = ts
+            record[F_BATTERY] = budget
+            record[F_SEQ] = seq
+            n = counts[i]
+            if not n:
+                continue
+            for base, seconds, n_buckets in self.levels:
+                bucket = ts // seconds
+                at = base + int(bucket % n_buckets) * BUCKET_FIELDS
+                if record[at] == bucket:
+                    record[at + 1] += n
+                    record[at + 2] += sums[j]
+                    record[at + 3] = min(record[at + 3], mins[j])
+                    record[at + 4] = max(record[at + 4], maxs[j])
+                elif record[at] < bucket:  # A new bucket takes over the slot of one that fell out of range
+                    record[at:at + BUCKET_FIELDS] = array('d', (bucket, n, sums[j], mins[j], maxs[j]))
+            self._push_latest(record, ts, values[offsets[i]:offsets[i] + n])
+            j += 1
+
+    def _push_latest(self, record, ts, readings):
+        latest_n = self.latest_n
+        pos = int(record[F_POS])
+        for value in readings[-latest_n:]:
+            record[HEAD + pos] = ts
+            record[HEAD + latest_n + pos] = value
+            pos = (pos + 1) % latest_n
+        record[F_POS] = pos
+        record[F_COUNT] = min(latest_n, record[F_COUNT] + len(readings))
+
+    def _record(self, device):
+        record = self.cache.get(device)
+        if record is None:
+            record = self._load(device)
+            if record is None:
+                record = array('d', self.empty)
+            self.cache[device] = record
+            if len(self.cache) > self.max_devices:
+                self._evict()
+        else:
+            self.cache.move_to_end(device)
+        self.dirty.add(device)
+        return record
+
+    def _load(self, device):
+        raw = self.file.read(device) if self.file else None
+        if raw is None:
+            return None
+        self.loads += 1
+        record = array('d')
+        record.frombytes(raw)
+        return record
+
+    def _evict(self):
+        device, record = self.cache.popitem(last=False)
+        self.evictions += 1
+        if device in self.dirty:
+            self.dirty.discard(device)
+            if self.file:
+                self.file.write(device, record.tobytes())
+
+    def maybe_checkpoint(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+            self._last_checkpoint = now
+
+    def checkpoint(self):
+        """Writes every device changed since the last checkpoint to the file."""
+        if self.file and not self.file.readonly:
+            for device in self.dirty:
+                self.file.write(device, self.cache[device].tobytes())
+            self.file.sync()
+        self.dirty.clear()
+
+    def close(self):
+        if self.file:
+            self.checkpoint()
+            self.file.close()
+
+    # --- QUERIES ---
+    def devices(self):
+        known = set(self.cache)
+        if self.file:
+            known.update(self.file.records)
+        return sorted(known)
+
+    def get(self, device):
+        """The device's record without touching the LRU order, or None if it was never seen."""
+        record = self.cache.get(device)
+        return record if record is not None else self._load(device)
+
+    def latest(self, device, n=1):
+        """Status and the last n readings of a device (newest first), or None. O(n)."""
+        record = self.get(device)
+        if record is None:
+            return None
+        latest_n = self.latest_n
+        count = min(n, int(record[F_COUNT]))
+        pos = int(record[F_POS])
+        readings = []
+        for k in range(1, count + 1):
+            slot = (pos - k) % latest_n
+            readings.append((record[HEAD + slot], record[HEAD + latest_n + slot]))
+        return {"last_seen": record[F_SEEN], "battery": int(record[F_BATTERY]), "seq": int(record[F_SEQ]),
+                "readings": readings}
+
+    def window(self, device, start, end=None):
+        """
+        count/min/mean/max of a device's readings from start to end (Unix times), or None.
+        Uses the finest level that still keeps start, so the window snaps to its buckets:
+        minutes for the last hour, hours for the last two days, days beyond. O(buckets).
+        """
+        record = self.get(device)
+        if record is None:
+            return None
+        end = time.time() if end is None else end
+        for base, seconds, n_buckets in self.levels:
+            if end // seconds - start // seconds < n_buckets:
+                break
+        first, last = start // seconds, end // seconds
+
+        count, total, low, high = 0, 0.0, float("inf"), float("-inf")
+        for at in range(base, base + n_buckets * BUCKET_FIELDS, BUCKET_FIELDS):
+            if first <= record[at] <= last:
+                count += int(record[at + 1])
+                total += record[at + 2]
+                low = min(low, record[at + 3])
+                high = max(high, record[at + 4])
+        return {"resolution": seconds, "from": first * seconds, "to": (last + 1) * seconds, "count": count,
+                "min": low if count else None, "mean": total / count if count else None,
+                "max": high if count else None}
+
+
+def find_rollup_files(directory="."):
+    """Rollup files of a gateway (one per worker in multi-core mode)."""
+    return sorted(glob.glob(os.path.join(directory, f"*{ROLLUP_EXT}")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the gateway's per-device rollups")
+    parser.add_argument("files", nargs="*", help=f"Rollup files (default: every *{ROLLUP_EXT} here)")
+    parser.add_argument("--device", type=int, help="Device ID (default: list the devices)")
+    parser.add_argument("--latest", type=int, default=5, help="Last readings to show")
+    parser.add_argument("--window", type=float, nargs="*", default=[3600.0, 86400.0],
+                        help="Aggregates over the last N seconds")
+    args = parser.parse_args()
+
+    stores = [RollupStore(path, readonly=True).open() for path in args.files or find_rollup_files()]
+    if not stores:
+        sys.exit("No rollup files found")
+    if args.device is None:
+        for store in stores:
+            print(f"{store.file.path}: {len(store.file.records)} devices")
+            print("  " + " ".join(map(str, store.devices()[:50])))
+        return
+
+    # In multi-core mode a device lands on one worker, so only one file knows it
+    store = next((s for s in stores if s.get(args.device) is not None), None)
+    if store is None:
+        sys.exit(f"Device {args.device} not found")
+    status = store.latest(args.device, args.latest)
+    print(f"Device {args.device}: last seen {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(status['last_seen']))}"
+          f" | Bat {status['battery']}% | Seq {status['seq']}")
+    print("  Latest: " + ", ".join(f"{value:g}" for _, value in status["readings"]))
+    for seconds in args.window:
+        agg = store.window(args.device, time.time() - seconds)
+        if agg["count"]:
+            print(f"  Last {seconds:g}s ({agg['resolution']}s buckets): n={agg['count']} "
+                  f"min={agg['min']:g} mean={agg['mean']:.2f} max={agg['max']:g}")
+        else:
+            print(f"  Last {seconds:g}s: no readings")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import os
+import time
+import glob
+import struct
+import socket
+from array import array
+import numpy as np
+
+# --- SEGMENT FORMAT ---
+# Immutable, little-endian, every column padded to 8 bytes so it can be mapped as a NumPy array:
+#
+#   Header    magic(8) version(4) rows(4) n_readings(4) n_devices(4) t_min(8) t_max(8)
+#   ts        float64[rows]      arrival time, non-decreasing
+#   device    uint32[rows]       Device ID, or the IPv4 address for frames without one
+#   seq       uint32[rows]
+#   battery   uint8[rows]
+#   offsets   uint32[rows + 1]   readings of row i are readings[offsets[i]:offsets[i + 1]]
+#   readings  int32[n_readings]   decoded readings (float codecs are rounded)
+#   Index     idx_devices uint32[n_devices] (sorted), idx_offsets uint32[n_devices + 1],
+#             idx_rows uint32[rows] (row numbers grouped by device, ascending inside a group)
+SEG_MAGIC = b"IOTSEG\x00\x01"
+SEG_VERSION = 1
+SEG_HEADER = struct.Struct("<8sIIIIdd")
+SEG_EXT = ".seg"
+
+COLUMNS = ("timestamp", "device", "seq", "battery", "offsets", "readings")
+
+
+def _pad8(n):
+    return (n + 7) & ~7
+
+
+def _column_layout(rows, n_readings, n_devices):
+    """[(name, dtype, count, byte offset)] for a segment of the given shape."""
+    layout = []
+    pos = SEG_HEADER.size
+    for name, dtype, count in (("timestamp", "<f8", rows),
+                               ("device", "<u4", rows),
+                               ("seq", "<u4", rows),
+                               ("battery", "u1", rows),
+                               ("offsets", "<u4", rows + 1),
+                               ("readings", "<i4", n_readings),
+                               ("idx_devices", "<u4", n_devices),
+                               ("idx_offsets", "<u4", n_devices + 1),
+                               ("idx_rows", "<u4", rows)):
+        layout.append((name, dtype, count, pos))
+        pos = _pad8(pos + count * np.dtype(dtype).itemsize)
+    return layout, pos
+
+
+def device_key(ip, device_id):
+    if device_id is not None:
+        return device_id
+    try:
+        return struct.unpack("!I", socket.inet_aton(ip))[0]
+    except OSError:
+        return 0
+
+
+# --- WRITE SIDE ---
+class SegmentSink:
+    """
+    Append-only columnar storage for the gateway (a LogWriter sink).
+
+    Rows are appended to in-memory columns and sealed into an immutable
+    segment file once max_rows rows are buffered or the segment is max_age
+    seconds old. Unsealed rows are lost on a crash, so max_age bounds the loss.
+    """
+
+    def __init__(self, directory, max_rows=100_000, max_age=60.0, name_prefix="seg"):
+        self.directory = directory
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.name_prefix = name_prefix
+        self.sealed = 0
+        self._reset()
+
+    def _reset(self):
+        self.ts = array('d')
+        self.device = array('I')
+        self.seq = array('I')
+        self.battery = array('B')
+        self.offsets = array('I', [0])
+        self.readings = array('i')
+        self.started = time.time()
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write_batch(self, batch, values, offsets):
+        base = len(self.readings)
+        self.readings.frombytes(np.rint(values).astype(np.int32).tobytes())
+        self.offsets.extend((offsets[1:] + base).tolist())
+
+        last_ts = self.ts[-1] if self.ts else 0.0
+        for ts, ip, seq, budget, _, device_id, _ in batch:
+            last_ts = max(ts, last_ts)  # Keep the time column sorted even if the wall clock steps back
+            self.ts.append(last_ts)
+            self.device.append(device_key(ip, device_id))
+            self.seq.append(seq)
+            self.battery.append(budget)
+
+        if len(self.ts) >= self.max_rows or time.time() - self.started >= self.max_age:
+            self.seal()
+
+    def sync(self):
+        # Sealed segments are fsynced when written; the open one only lives in memory
+        pass
+
+    def close(self):
+        self.seal()
+
+    def seal(self):
+        """Writes the buffered rows as one immutable segment file. Returns its path."""
+        rows = len(self.ts)
+        if rows == 0:
+            self.started = time.time()
+            return None
+
+        device = np.frombuffer(self.device, dtype=np.uint32)
+        idx_rows = np.argsort(device, kind="stable").astype(np.uint32)
+        idx_devices, counts = np.unique(device, return_counts=True)
+        idx_offsets = np.zeros(len(idx_devices) + 1, dtype=np.uint32)
+        np.cumsum(counts, out=idx_offsets[1:])
+
+        columns = {
+            "timestamp": self.ts, "device": self.device, "seq": self.seq, "battery": self.battery,
+            "offsets": self.offsets, "readings": self.readings,
+            "idx_devices": idx_devices, "idx_offsets": idx_offsets, "idx_rows": idx_rows,
+        }
+        layout, size = _column_layout(rows, len(self.readings), len(idx_devices))
+
+        buf = bytearray(size)
+        SEG_HEADER.pack_into(buf, 0, SEG_MAGIC, SEG_VERSION, rows, len(self.readings), len(idx_devices),
+                             self.ts[0], self.ts[-1])
+        for name, dtype, count, pos in layout:
+            data = np.asarray(columns[name]).astype(dtype, copy=False)
+            buf[pos:pos + data.nbytes] = data.tobytes()
+
+        name = f"{self.name_prefix}-{int(self.ts[0] * 1000):013d}-{self.sealed:06d}{SEG_EXT}"
+        path = os.path.join(self.directory, name)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)  # Readers never see a half-written segment
+
+        self.sealed += 1
+        self._reset()
+        return path
+
+
+# --- READ SIDE ---
+class SegmentReader:
+    """Memory-mapped view of one sealed segment. Columns are zero-copy NumPy arrays."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mm = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, rows, n_readings, n_devices, t_min, t_max = SEG_HEADER.unpack_from(self.mm)
+        if magic != SEG_MAGIC or version != SEG_VERSION:
+            raise ValueError(f"{path}: not a v{SEG_VERSION} segment")
+
+        self.rows = rows
+        self.t_min = t_min
+        self.t_max = t_max
+        self.columns = {}
+        layout, _ = _column_layout(rows, n_readings, n_devices)
+        for name, dtype, count, pos in layout:
+            self.columns[name] = np.frombuffer(self.mm, dtype=dtype, count=count, offset=pos)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def row_range(self, t_start, t_end):
+        """[first, last) rows with t_start <= ts < t_end (binary search on the sorted time column)."""
+        ts = self.columns["timestamp"]
+        return int(np.searchsorted(ts, t_start, "left")), int(np.searchsorted(ts, t_end, "left"))
+
+    def device_rows(self, device):
+        """Row numbers of one device, ascending, via the device index."""
+        devices = self.columns["idx_devices"]
+        i = int(np.searchsorted(devices, device))
+        if i == len(devices) or devices[i] != device:
+            return self.columns["idx_rows"][:0]
+        offsets = self.columns["idx_offsets"]
+        return self.columns["idx_rows"][offsets[i]:offsets[i + 1]]
+
+    def select(self, rows):
+        """Materializes the given rows (a slice or an array of row numbers) as a column dict."""
+        offsets = self.columns["offsets"]
+        if isinstance(rows, slice):
+            starts, ends = offsets[rows.start:rows.stop], offsets[rows.start + 1:rows.stop + 1]
+        else:
+            starts, ends = offsets[rows], offsets[rows + 1]
+
+        lengths = (ends.astype(np.int64) - starts)
+        new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+        if isinstance(rows, slice) and len(starts):
+            readings = self.columns["readings"][starts[0]:ends[-1]]
+        else:
+            # Gather: index of every reading of every selected row
+            gather = np.repeat(starts.astype(np.int64) - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+            readings = self.columns["readings"][gather]
+
+        return {
+            "timestamp": self.columns["timestamp"][rows],
+            "device": self.columns["device"][rows],
+            "seq": self.columns["seq"][rows],
+            "battery": self.columns["battery"][rows],
+            "offsets": new_offsets,
+            "readings": readings,
+        }
+
+
+class SegmentStore:
+    """All sealed segments under a directory (recursively, so per-worker subdirectories are included)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.readers = {}
+
+    def refresh(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, "**", f"*{SEG_EXT}"), recursive=True))
+        for path in paths:
+            if path not in self.readers:
+                self.readers[path] = SegmentReader(path)
+        for path in set(self.readers) - set(paths):
+            del self.readers[path]
+        return sorted(self.readers.values(), key=lambda r: r.t_min)
+
+    def query(self, t_start, t_end, device=None):
+        """
+        All rows with t_start <= ts < t_end (optionally of one device), as a dict of
+        NumPy columns in time order per segment. Segments outside the range are skipped
+        by their header; inside a segment the time column is binary-searched.
+        """
+        parts = []
+        for reader in self.refresh():
+            if reader.t_max < t_start or reader.t_min >= t_end:
+                continue
+            first, last = reader.row_range(t_start, t_end)
+            if first == last:
+                continue
+            if device is None:
+                parts.append(reader.select(slice(first, last)))
+            else:
+                rows = reader.device_rows(device)
+                rows = rows[(rows >= first) & (rows < last)]
+                if len(rows):
+                    parts.append(reader.select(rows))
+        return concat_columns(parts)
+
+
+def concat_columns(parts):
+    if not parts:
+        return {
+            "timestamp": np.empty(0, "<f8"), "device": np.empty(0, "<u4"), "seq": np.empty(0, "<u4"),
+            "battery": np.empty(0, "u1"), "offsets": np.zeros(1, np.int64), "readings": np.empty(0, "<i4"),
+        }
+    if len(parts) == 1:
+        return parts[0]
+
+    result = {name: np.concatenate([p[name] for p in parts]) for name in COLUMNS if name != "offsets"}
+    offsets = [np.zeros(1, np.int64)]
+    base = 0
+    for p in parts:
+        offsets.append(p["offsets"][1:] + base)
+        base += p["offsets"][-1]
+    result["offsets"] = np.concatenate(offsets)
+    return result
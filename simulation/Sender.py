@@ -3,108 +3,322 @@ import time
 import os
 import csv
 import random
-import struct
-from utils import LISTEN_IP, LISTEN_PORT, Packet, FLAG_ACK, FLAG_AGGREGATED, simulate_network_loss, encrypt_payload
-from simulation.battery import Battery
+from array import array
+from utils import LISTEN_IP, LISTEN_PORT, HEADER_SIZE, DEVICE_ID_SIZE, TAG_SIZE, Packet, FLAG_ACK, FLAG_AGGREGATED, \
+    FLAG_DEVICE_ID, DEVICE_ID_STRUCT, DL_THRESHOLD, DL_RETRIES, DL_UNSET, DL_CONFIG_REV, PROTOCOL_V2, MTU, \
+    SACK_WIDTH, simulate_network_loss, encrypt_payload, crypto_overhead, fragmented_size
+from keystore import KeyRing, SeqStore
+from estimators import RttEstimator, LossEstimator, MAX_RTO
+from payload_codecs import encode, encode_smallest, codec_flags
+from strategy import STRATEGY_TIERS, MAX_AGE, URGENT_ABOVE, TRIGGER_COUNT, TRIGGER_URGENT, select_strategy, \
+    flush_trigger
+from battery import Battery
+from traffic import TrafficMeter, MeteredSocket
 
 LOG_FILE = "results/smart_sender_log.csv"
 os.makedirs("results", exist_ok=True)
+INTERVAL_ALPHA = 1 / 8  # EWMA weight of a new gap between readings (the deadline scheduler's look-ahead)
+
+
+class InFlight:
+    """A sent packet waiting for its ACK."""
+    __slots__ = ("seq", "packet", "mode", "max_retries", "attempts", "timeout", "sent_at", "deadline", "sampled",
+                 "trigger")
+
+    def __init__(self, seq, packet, mode, max_retries, timeout, sampled=(), trigger=TRIGGER_COUNT):
+        self.seq = seq
+        self.packet = packet  # The datagrams: [frame], or its fragments if it is bigger than the MTU
+        self.mode = mode
+        self.max_retries = max_retries  # Energy-aware budget from get_strategy, per packet
+        self.attempts = 0
+        self.timeout = timeout  # Current RTO of this packet, doubled on every timeout
+        self.sent_at = 0.0
+        self.deadline = 0.0
+        self.sampled = sampled  # Sample times of its readings, for their staleness once ACKed
+        self.trigger = trigger  # Why it was sent (strategy.TRIGGER_*)
 
 
 class SmartSender:
-    def __init__(self, target_ip=LISTEN_IP, target_port=LISTEN_PORT):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def __init__(self, target_ip=LISTEN_IP, target_port=LISTEN_PORT, device_id=1, keyring=None, window=1,
+                 codec=None, strategy=STRATEGY_TIERS, link_loss=0.2, version=PROTOCOL_V2, mtu=MTU, max_age=MAX_AGE,
+                 urgent_above=URGENT_ABOVE, meter=None, seq_store=None, log_file=LOG_FILE):
+        # Every datagram in and out is counted (traffic.py): the energy model uses what was really sent
+        self.traffic = meter or TrafficMeter()
+        self.sock = MeteredSocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), self.traffic, device_id)
         self.target = (target_ip, target_port)
         self.seq = 0
         self.buffer = []  # Stores Integers
+        self.sampled = []  # Sample time of each buffered reading (time.monotonic)
+        self.codec = codec  # Payload codec ID, or None to pick the smallest encoding per packet
+
+        # SECURITY: per-device key, set up once (on a real device it is provisioned at the factory)
+        # v2 frames don't carry the nonce and authenticate the header; v1 is kept for old gateways
+        keyring = keyring or KeyRing()
+        self.device_id = device_id
+        self.version = version
+        self.tag_size = keyring.tag_size_for(device_id) if version == PROTOCOL_V2 else TAG_SIZE
+        self.aead = keyring.cipher_v2(device_id) if version == PROTOCOL_V2 else keyring.cipher(device_id)
+        self.device_id_bytes = DEVICE_ID_STRUCT.pack(device_id)
+        # The v2 nonce is Device ID + seq: seqs come from a persistent counter and are never used twice,
+        # across runs too (v1 draws a random nonce per packet and can start from 0)
+        self.seqs = (seq_store or SeqStore()) if version == PROTOCOL_V2 else None
+        self.seq_end = None
+        if self.seqs is not None:
+            self.seq, self.seq_end = self.seqs.lease(device_id)
+            self.seqs.save()
+
+        # RELIABILITY: selective repeat with up to `window` packets in flight (1 = stop-and-wait).
+        # Never more than one SACK can speak for: older in-flight seqs would fall outside its bitmap
+        self.window = min(window, SACK_WIDTH)
+        self.in_flight = {}  # seq -> InFlight
+        self.acked_any = False  # One packet at a time until the first ACK (see window_open)
+        self.mtu = mtu  # A bigger frame goes out as fragments in the same wake-up (e.g. a backlog after an outage)
+
+        # LINK ESTIMATION: timeouts follow the measured RTT, loss feeds the strategy
+        self.rtt = RttEstimator()
+        self.loss = LossEstimator()
+
+        # STRATEGY: tiers for select_strategy; link_loss is the simulated drop probability of the radio
+        self.strategy = strategy
+        self.link_loss = link_loss
+
+        # DEADLINES: no reading waits longer than max_age[mode] for its packet; alarms go out at once
+        self.max_age = max_age
+        self.urgent_above = urgent_above
+        self.urgent = False  # An alarm is in the buffer
+        self.interval = 0.0  # EWMA of the time between readings
+        self.last_sample = None
+        self.staleness = array('d')  # Sample-to-ACK seconds of every delivered reading
+
+        # DOWNLINK: settings the gateway piggybacks on ACKs (no extra radio receive window)
+        self.threshold_hint = None  # Recommended aggregation threshold, replaces the tier's own
+        self.retry_hint = None  # Recommended retry budget, same
+        self.config_rev = None
 
         # PHYSICS ENGINE
         self.battery = Battery(initial_capacity=100.0, drain_idle=0.1, drain_tx=3.0)
         self.sock.settimeout(1.0)
 
-        with open(LOG_FILE, mode='w', newline='') as f:
-            csv.writer(f).writerow(["Timestamp", "Seq", "Battery", "Mode", "Event"])
+        self.log_file = log_file
+        with open(self.log_file, mode='w', newline='') as f:
+            csv.writer(f).writerow(["Timestamp", "Seq", "Battery", "Mode", "Event", "SRTT", "RTTVAR", "RTO", "Loss",
+                                    "Readings", "Trigger", "MaxStaleness", "MeanStaleness"])
 
     def get_strategy(self):
-        bat = self.battery.update_idle()
-        if bat > 70:
-            return 1, "REAL-TIME", 3
-        elif bat > 30:
-            return 5, "BALANCED", 1
-        else:
-            return 10, "SURVIVAL", 0
+        threshold, mode, max_retries = select_strategy(self.battery.update_idle(), self.loss.etx(), self.strategy)
+        if self.retry_hint is not None:
+            max_retries = self.retry_hint
+        return self.threshold_hint or threshold, mode, max_retries
+
+    def add_reading(self, reading, now=None):
+        """Buffers one sensor reading, with its sample time."""
+        now = time.monotonic() if now is None else now
+        if self.last_sample is not None:
+            gap = now - self.last_sample
+            self.interval = gap if not self.interval else self.interval + INTERVAL_ALPHA * (gap - self.interval)
+        self.last_sample = now
+        self.buffer.append(reading)
+        self.sampled.append(now)
+        if self.urgent_above is not None and reading > self.urgent_above:
+            self.urgent = True
+
+    def flush_trigger(self, threshold, mode, now=None):
+        """Why the buffer should be sent now (strategy.TRIGGER_*), or None to keep aggregating."""
+        if self.urgent:
+            return TRIGGER_URGENT
+        oldest_age = (time.monotonic() if now is None else now) - self.sampled[0] if self.sampled else 0.0
+        return flush_trigger(len(self.buffer), threshold, oldest_age, self.max_age.get(mode), self.interval,
+                             self.rtt.srtt or 0.0)
 
     def run(self):
         print(f"=== SECURE SENDER STARTED (Bat: {self.battery.current}%) ===")
         while not self.battery.is_dead:
             # 1. Simulate Sensor Reading (Binary)
             reading = random.randint(20, 30)
-            self.buffer.append(reading)
+            self.add_reading(reading)
 
             # 2. Decide Strategy
             threshold, mode, max_retries = self.get_strategy()
             print(f"[Sensor] Buffer: {len(self.buffer)}/{threshold} | Bat: {self.battery.current:.2f}% | Mode: {mode}")
 
-            # 3. Flush if threshold met
-            if len(self.buffer) >= threshold:
-                self.flush(mode, max_retries)
+            # 3. Flush if threshold met, the oldest reading's deadline is near, or on an alarm
+            trigger = self.flush_trigger(threshold, mode)
+            if trigger:
+                self.flush(mode, max_retries, trigger)
 
-            # 4. Wait
+            # 4. Wait (and pick up ACKs that arrived meanwhile)
             time.sleep(1.0)
             self.battery.update_idle()
+            self.pump()
+        self.drain()
         print("\n=== BATTERY DEAD. SYSTEM SHUTDOWN. ===")
+        if self.staleness:
+            ages = sorted(self.staleness)
+            print(f"Staleness (sample -> ACK): p50 {ages[len(ages) // 2]:.2f}s | max {ages[-1]:.2f}s "
+                  f"over {len(ages)} readings, {len(self.buffer)} never sent")
 
-    def flush(self, mode, max_retries):
+    def flush(self, mode, max_retries, trigger=TRIGGER_COUNT):
         if not self.buffer: return
 
-        # Binary packing
-        # Convert list of ints to bytes (e.g. [22, 23] -> b'\x16\x17')
-        pack_format = f"{len(self.buffer)}B"
-        raw_payload = struct.pack(pack_format, *self.buffer)
+        packet = self.build_packet()
+        pkt = InFlight(self.seq, Packet.fragment(packet, self.mtu), mode, max_retries, self.rtt.rto, self.sampled,
+                       trigger)
 
-        # Encryption (AES-GCM)
-        secure_payload = encrypt_payload(raw_payload)
+        if self.battery.is_dead:
+            self.log_result(pkt, "DROP")
+        else:
+            self.in_flight[self.seq] = pkt
+            self.transmit(pkt)
+
+        self.seq += 1
+        if self.seq_end is not None and self.seq >= self.seq_end:
+            self.seq, self.seq_end = self.seqs.lease(self.device_id, start=self.seq)  # OverflowError: re-key
+            self.seqs.save()
+        self.buffer = []
+        self.sampled = []
+        self.urgent = False
+
+        # Wait for a free slot in the window (with window=1: until this packet is ACKed or dropped)
+        self.pump(until=self.window_open)
+
+    def window_open(self):
+        """
+        Whether the next seq may go out: every packet in flight within `window` seqs of it (so fewer than
+        `window` of them), so the gateway's SACK and replay window still cover every one. Until the
+        first ACK, one packet at a time: the gateway's session then starts at a seq we really sent first.
+        """
+        if not self.in_flight:
+            return True
+        return self.acked_any and self.seq - min(self.in_flight) < self.window
+
+    def build_packet(self):
+        """The wire packet for the current buffer (packing + encryption, no I/O)."""
+        # Binary packing (codec ID travels in the flags byte)
+        codec, raw_payload = self.encode_payload()
 
         is_aggregated = FLAG_AGGREGATED if len(self.buffer) > 1 else 0
         budget_byte = int(self.battery.current)
+        flags = is_aggregated | FLAG_DEVICE_ID | codec_flags(codec)
 
-        # Create Packet
-        packet = Packet.pack(self.seq, is_aggregated, budget_byte, secure_payload)
+        # Encryption (AES-GCM with this device's key) + Packet: the Device ID tells the receiver which key to use
+        if self.version == PROTOCOL_V2:
+            return Packet.pack_v2(self.seq, flags, budget_byte, self.device_id, raw_payload, self.aead)
+        secure_payload = encrypt_payload(raw_payload, self.aead)
+        return Packet.pack(self.seq, flags, budget_byte, self.device_id_bytes + secure_payload)
 
-        attempts = 0
-        success = False
-        current_timeout = 0.5
+    def frame_size(self, payload_size):
+        """Bytes on the air for payload_size: Header + Device ID + crypto overhead + payload (+ fragmenting)."""
+        size = HEADER_SIZE + DEVICE_ID_SIZE + crypto_overhead(self.version, self.tag_size) + payload_size
+        return fragmented_size(size, HEADER_SIZE + DEVICE_ID_SIZE, self.mtu)
 
-        while attempts <= max_retries:
-            if self.battery.is_dead: break
+    def encode_payload(self):
+        """
+        Encodes the buffered readings. Returns (codec, bytes).
+        e.g. 10 readings of 20-30: RAW 10 bytes, BITPACK 8 bytes (4 bits each + 3 header bytes)
+        """
+        if self.codec is None:
+            return encode_smallest(self.buffer)
+        return self.codec, encode(self.codec, self.buffer)
 
-            try:
-                self.sock.settimeout(current_timeout)
+    def drain(self):
+        """Blocks until every in-flight packet is ACKed or has used up its retries."""
+        self.pump(until=lambda: not self.in_flight)
 
-                if simulate_network_loss():
-                    print(f"    [CHAOS] Packet #{self.seq} dropped.")
-                    self.battery.consume_tx(retries=attempts)
-                else:
-                    self.sock.sendto(packet, self.target)
-                    self.battery.consume_tx(retries=attempts)
+    def transmit(self, pkt):
+        # Every fragment is sent again on a retry: the gateway keeps the ones it has and fills the gaps
+        if pkt.attempts:
+            self.traffic.retransmitted(self.device_id)
+        for i, datagram in enumerate(pkt.packet):
+            if simulate_network_loss(self.link_loss):
+                part = f" (fragment {i + 1}/{len(pkt.packet)})" if len(pkt.packet) > 1 else ""
+                print(f"    [CHAOS] Packet #{pkt.seq}{part} dropped.")
+                self.sock.drop(datagram)  # Lost in the air, but the radio sent it
+            else:
+                self.sock.sendto(datagram, self.target)
+        self.battery.consume_tx(retries=pkt.attempts)
+        pkt.sent_at = time.monotonic()
+        pkt.deadline = pkt.sent_at + pkt.timeout
 
-                # Wait for ACK
-                ack_data, _ = self.sock.recvfrom(128)
-                ack_seq, flags, _, _ = Packet.unpack(ack_data)
+    def pump(self, until=None):
+        """
+        Handles ACKs and retransmission timers of the in-flight packets.
+        Blocks until until() is true; without a condition it only handles what is ready now.
+        """
+        while self.in_flight and not (until and until()):
+            # 1. Retransmission timers (each packet has its own)
+            now = time.monotonic()
+            for pkt in list(self.in_flight.values()):
+                if now >= pkt.deadline:
+                    self.on_timeout(pkt)
+            if not self.in_flight or (until and until()):
+                break
 
-                if (flags & FLAG_ACK) and (ack_seq == self.seq):
-                    success = True
+            # 2. Wait for an ACK, at most until the next timer fires
+            if until:
+                next_deadline = min(pkt.deadline for pkt in self.in_flight.values())
+                self.sock.settimeout(max(0.001, next_deadline - time.monotonic()))
+            else:
+                self.sock.settimeout(0.0)
+            try:
+                ack_data, _ = self.sock.recvfrom(128)
+            except (socket.timeout, BlockingIOError):
+                if not until:
                     break
+                continue
+            self.on_ack(ack_data)
 
-            except socket.timeout:
-                attempts += 1
-                if attempts <= max_retries:
-                    print(f"    !!! TIMEOUT. Retrying...")
-                    current_timeout *= 2
+    def on_ack(self, ack_data):
+        ack_seq, flags, _, payload = Packet.unpack(ack_data)
+        if ack_seq is None or not flags & FLAG_ACK:
+            return
+        downlink = Packet.downlink(flags, payload)
+        if downlink:
+            self.on_downlink(downlink)
+        # A selective ACK can clear several packets at once, including ones whose own ACK got lost
+        now = time.monotonic()
+        for seq in Packet.acked_seqs(ack_seq, flags, payload, self.in_flight):
+            self.acked_any = True
+            pkt = self.in_flight[seq]
+            # Karn's rule: a retransmitted packet's ACK can't be matched to one send, so no sample.
+            # Neither can a packet only covered by someone else's selective ACK.
+            if pkt.attempts == 0 and seq == ack_seq:
+                self.rtt.sample(now - pkt.sent_at)
+            self.loss.record(False)
+            self.resolve(pkt, "SENT")
 
-        with open(LOG_FILE, mode='a', newline='') as f:
-            status = "SENT" if success else "DROP"
-            csv.writer(f).writerow([time.time(), self.seq, self.battery.current, mode, status])
+    def on_downlink(self, items):
+        if DL_THRESHOLD in items:
+            self.threshold_hint = items[DL_THRESHOLD] or None  # 0 = back to the battery tiers
+        if DL_RETRIES in items:
+            self.retry_hint = None if items[DL_RETRIES] == DL_UNSET else items[DL_RETRIES]
+        if DL_CONFIG_REV in items and items[DL_CONFIG_REV] != self.config_rev:
+            self.config_rev = items[DL_CONFIG_REV]
+            print(f"    [DOWNLINK] Gateway config revision {self.config_rev}")
 
-        self.seq += 1
-        self.buffer = []
\ No newline at end of file
+    def on_timeout(self, pkt):
+        self.loss.record(True)
+        # Back off the shared RTO once per burst: packets sent with an older, smaller RTO don't compound it
+        if pkt.timeout >= self.rtt.rto:
+            self.rtt.backoff()
+        pkt.attempts += 1
+        if pkt.attempts > pkt.max_retries or self.battery.is_dead:
+            self.resolve(pkt, "DROP")
+            return
+        print(f"    !!! TIMEOUT (#{pkt.seq}, RTO {pkt.timeout * 1000:.0f}ms). Retrying...")
+        pkt.timeout = min(MAX_RTO, pkt.timeout * 2)
+        self.transmit(pkt)
+
+    def resolve(self, pkt, status):
+        del self.in_flight[pkt.seq]
+        self.log_result(pkt, status)
+
+    def log_result(self, pkt, status):
+        # End-to-end staleness of the packet's readings: from their sample time to the ACK
+        ages = [time.monotonic() - t for t in pkt.sampled] if status == "SENT" else []
+        self.staleness.extend(ages)
+        with open(self.log_file, mode='a', newline='') as f:
+            rtt = self.rtt
+            csv.writer(f).writerow([time.time(), pkt.seq, self.battery.current, pkt.mode, status,
+                                    f"{rtt.srtt or 0:.6f}", f"{rtt.rttvar or 0:.6f}", f"{rtt.rto:.6f}",
+                                    f"{self.loss.rate:.3f}", len(pkt.sampled), pkt.trigger,
+                                    f"{max(ages):.3f}" if ages else "", f"{sum(ages) / len(ages):.3f}" if ages else ""])
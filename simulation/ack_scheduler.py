@@ -0,0 +1,152 @@
+import time
+from collections import OrderedDict
+from utils import Packet, SACK_WIDTH
+
+# Delayed ACKs (in the spirit of TCP's, RFC 1122 / RFC 5681)
+ACK_DELAY = 0.005  # Seconds an ACK may wait for more packets of the same device (well below MIN_RTO)
+ACK_EVERY = 2  # ...but never more than this many packets: ACK at once when reached
+SOLO_MEMORY = 10.0  # Seconds a device whose held ACK covered a single packet is ACKed at once
+DOWNLINK_REPEAT = 3  # ACKs that carry a downlink item (ACKs get lost too)
+
+
+class DownlinkTable:
+    """
+    Small per-device settings waiting to ride on ACKs ({DL_* type: value}, see utils.py).
+    An item is piggybacked on the device's next `repeat` ACKs, then dropped.
+    """
+
+    def __init__(self, repeat=DOWNLINK_REPEAT):
+        self.repeat = repeat
+        self.items = {}  # key -> {type: value}
+        self.left = {}  # key -> ACKs that will still carry them
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, key, items):
+        self.items.setdefault(key, {}).update(items)
+        self.left[key] = self.repeat
+
+    def take(self, key):
+        """The items to put on this ACK for the device, or None."""
+        items = self.items.get(key)
+        if items is None:
+            return None
+        self.left[key] -= 1
+        if self.left[key] <= 0:
+            del self.items[key]
+            del self.left[key]
+        return items
+
+
+def sack_covers(sack, seq):
+    """Whether an ACK carrying this SACK state, (cumulative, bitmap), acknowledges seq."""
+    cumulative, bitmap = sack
+    return seq < cumulative or (0 <= seq - cumulative - 1 < SACK_WIDTH and (bitmap >> (seq - cumulative - 1)) & 1)
+
+
+class AckScheduler:
+    """
+    Turns "packet accepted" events into ACK datagrams, coalescing per device.
+
+    A device sending back-to-back (its previous packet arrived less than `delay`
+    ago: a window or a backlog) gets its ACK held for up to `delay`. Every packet
+    of that device arriving meanwhile is covered by the same ACK: the SACK state
+    (cumulative + bitmap) is read when the ACK is sent. The first packet of a
+    wake-up is ACKed at once, so a duty-cycled device never holds its radio
+    open for our delay. Duplicates are ACKed at once too, like TCP does.
+    A stop-and-wait device can't send more until it has its ACK, so holding is
+    pure delay: when a held ACK times out covering one packet, the device is
+    ACKed at once for the next `solo_memory` seconds. A held packet the SACK can't
+    speak for (an old hole keeps the cumulative point far behind) is ACKed on its
+    own before the next one takes its place.
+
+    Like GatewayIngest, it never touches the socket: ack() and due() return the
+    (datagram, addr) pairs to send now, so due ACKs go out together in one loop.
+    """
+
+    def __init__(self, sack, delay=ACK_DELAY, every=ACK_EVERY, downlink=None, solo_memory=SOLO_MEMORY,
+                 clock=time.monotonic):
+        self.sack = sack  # key -> (cumulative, bitmap), e.g. SessionTable.sack
+        self.delay = delay
+        self.every = every
+        self.solo_memory = solo_memory
+        self.downlink = downlink if downlink is not None else DownlinkTable()
+        self.clock = clock
+
+        # key -> [seq, addr, budget, packets, due]. Insertion order is due order (constant delay).
+        self.pending = OrderedDict()
+        self.last_rx = OrderedDict()  # key -> arrival time of its last packet, oldest first
+        self.solo = OrderedDict()  # key -> when a held ACK of the device covered one packet, oldest first
+
+        self.packets = 0  # Packets ACKed
+        self.sent = 0  # ACK datagrams built
+
+    def __len__(self):
+        return len(self.pending)
+
+    @property
+    def next_due(self):
+        """When the oldest held ACK must go out, or None if nothing is held."""
+        if not self.pending:
+            return None
+        return next(iter(self.pending.values()))[4]
+
+    def ack(self, key, seq, addr, budget=0, immediate=False):
+        """Registers an accepted packet. Returns the ACKs to send now."""
+        now = self.clock()
+        self.packets += 1
+        entry = self.pending.get(key)
+        if entry is not None:
+            ready = []
+            if not sack_covers(self.sack(key), entry[0]):
+                ready.append(self._build(key, entry))
+            entry[0], entry[1], entry[2] = seq, addr, budget
+            entry[3] += 1
+            if immediate or entry[3] >= self.every:
+                del self.pending[key]
+                ready.append(self._build(key, entry))
+            return ready
+
+        back_to_back = now - self.last_rx.get(key, float("-inf")) < self.delay
+        self.last_rx[key] = now
+        self.last_rx.move_to_end(key)
+        self._forget_old(self.last_rx, now, self.delay)
+        self._forget_old(self.solo, now, self.solo_memory)
+        if immediate or not back_to_back or self.delay <= 0 or key in self.solo:
+            return [self._build(key, [seq, addr, budget, 1, now])]
+
+        self.pending[key] = [seq, addr, budget, 1, now + self.delay]
+        return []
+
+    def due(self, now=None):
+        """The held ACKs whose delay is over."""
+        now = self.clock() if now is None else now
+        ready = []
+        while self.pending:
+            key, entry = next(iter(self.pending.items()))
+            if entry[4] > now:
+                break
+            del self.pending[key]
+            if entry[3] == 1:
+                self.solo[key] = entry[4]
+            ready.append(self._build(key, entry))
+        return ready
+
+    def flush(self):
+        """Every held ACK, now (e.g. on shutdown)."""
+        return self.due(float("inf"))
+
+    def _build(self, key, entry):
+        seq, addr, budget = entry[0], entry[1], entry[2]
+        self.sent += 1
+        return Packet.pack_ack(seq, budget, self.sack(key), self.downlink.take(key)), addr
+
+    @staticmethod
+    def _forget_old(table, now, age):
+        # Both tables only matter for a short while: they stay as small as the current burst
+        while table:
+            key, seen = next(iter(table.items()))
+            if now - seen < age:
+                break
+            del table[key]
@@ -1,20 +1,22 @@
 import time
+import numpy as np
 
 
 class Battery:
-    def __init__(self, initial_capacity=100.0, drain_idle=0.05, drain_tx=2.0):
+    def __init__(self, initial_capacity=100.0, drain_idle=0.05, drain_tx=2.0, clock=time.time):
         self.capacity = initial_capacity
         self.current = initial_capacity
         self.drain_idle = drain_idle  # Cost per second just to be alive
         self.drain_tx = drain_tx  # Cost to fire the radio (Expensive!)
-        self.last_update = time.time()
+        self.clock = clock  # Wall clock, or a simulator's virtual clock (see event_sim.py)
+        self.last_update = clock()
         self.is_dead = False
 
     def update_idle(self):
         """Calculates background drain since last check."""
         if self.is_dead: return 0
 
-        now = time.time()
+        now = self.clock()
         elapsed = now - self.last_update
         self.last_update = now
 
@@ -35,4 +37,66 @@ class Battery:
     def check_death(self):
         if self.current <= 0:
             self.current = 0
-            self.is_dead = True
\ No newline at end of file
+            self.is_dead = True
+
+
+class FleetBattery:
+    """
+    The Battery model for a whole fleet: one NumPy array per field instead of one
+    object per device. Every method takes the indices of the devices to update
+    (None = all of them) and does the work in a few array operations.
+    Per device, the results are the same as Battery's.
+    """
+
+    def __init__(self, n, initial_capacity=100.0, drain_idle=0.05, drain_tx=2.0, clock=time.time):
+        # Scalars apply to every device, arrays give each device its own value
+        self.capacity = np.full(n, initial_capacity, dtype=np.float64)
+        self.current = self.capacity.copy()
+        self.drain_idle = np.full(n, drain_idle, dtype=np.float64)
+        self.drain_tx = np.full(n, drain_tx, dtype=np.float64)
+        self.clock = clock
+        self.last_update = np.full(n, clock(), dtype=np.float64)
+        self.is_dead = np.zeros(n, dtype=bool)
+
+    def __len__(self):
+        return len(self.current)
+
+    def _select(self, idx):
+        return np.arange(len(self.current)) if idx is None else np.asarray(idx, dtype=np.int64)
+
+    def update_idle(self, idx=None):
+        """Background drain since each device's last check. Returns the levels of idx (0 for dead devices)."""
+        idx = self._select(idx)
+        alive = idx[~self.is_dead[idx]]
+
+        now = self.clock()
+        elapsed = now - self.last_update[alive]
+        self.last_update[alive] = now
+
+        self.current[alive] -= elapsed * self.drain_idle[alive]
+        self.check_death(alive)
+        return np.where(self.is_dead[idx], 0.0, self.current[idx])
+
+    def consume_tx(self, idx, retries=0):
+        """
+        Radio cost for every index in idx (repeat an index to transmit twice).
+        retries is a scalar or one value per index.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        retries = np.broadcast_to(np.asarray(retries, dtype=np.float64), idx.shape)
+        live = ~self.is_dead[idx]
+        idx, retries = idx[live], retries[live]
+
+        # Base cost + cost for every retry
+        drain_tx = self.drain_tx[idx]
+        total_cost = drain_tx + (retries * (drain_tx * 0.5))
+        np.subtract.at(self.current, idx, total_cost)  # Unbuffered: repeated indices all count
+        self.check_death(idx)
+
+    def check_death(self, idx=None):
+        """Marks depleted devices dead. Returns the indices that died in this call."""
+        idx = self._select(idx)
+        died = np.unique(idx[(self.current[idx] <= 0) & ~self.is_dead[idx]])
+        self.current[died] = 0
+        self.is_dead[died] = True
+        return died
@@ -1,14 +1,29 @@
-import asyncio
+import os
+import json
 import time
 import random
+import asyncio
 import logging
+import argparse
+import itertools
+from array import array
+import numpy as np
 from aiocoap import *
 import aiocoap.resource as resource
+from traffic import TrafficMeter, start_relay
 
 # Configuration
 HOST = "127.0.0.1"
 PORT = 5683
 
+# Fleet baseline (run_coap_fleet): N clients, each taking a reading every FLEET_INTERVAL seconds
+FLEET_CLIENTS = 50
+FLEET_INTERVAL = 1.0
+FLEET_DURATION = 10.0
+RESPONSE_TIMEOUT = 5.0  # Seconds a client waits for a response (a NON request is never retransmitted)
+FLEET_FILE = "results/coap_fleet.json"
+MESSAGE_TYPES = {"con": CON, "non": NON}
+
 
 # --- 1. THE STANDARD IOT SERVER (Receiver) ---
 class IoTResource(resource.Resource):
@@ -23,76 +38,218 @@ class IoTResource(resource.Resource):
         return Message(code=CHANGED, payload=b"")
 
 
-async def start_coap_server():
+async def start_coap_server(port=PORT):
     """Starts a real local CoAP server."""
     root = resource.Site()
     root.add_resource(['sensors', 'temp'], IoTResource())
 
     # Create server context
-    server_context = await Context.create_server_context(root, bind=(HOST, PORT))
+    server_context = await Context.create_server_context(root, bind=(HOST, port))
     return server_context
 
 
-# --- 2. THE HELPER TO MEASURE SIZE ---
-def measure_packet_size(msg):
-    """
-    Accurately measures the byte size of a CoAP packet 
-    by temporarily assigning a dummy ID.
-    """
-    # Create a clone/copy logic just for measurement
-    # We assign a dummy MID because .encode() requires it
-    msg.mid = 1234
-    size = len(msg.encode())
-    msg.mid = None  # Reset so the real sender can assign its own
-    return size
+# --- 2. TRAFFIC ACCOUNTING ---
+def coap_retransmit_key(data):
+    """Message ID of a Confirmable message (its retransmissions reuse it), None for the others."""
+    if len(data) < 4 or (data[0] >> 4) & 0x3 != 0:  # Byte 0: Ver (2 bits), Type (2 bits, 0 = CON), TKL (4 bits)
+        return None
+    return int.from_bytes(data[2:4], "big")
 
 
 # --- 3. THE STANDARD IOT CLIENT (Sender) ---
-async def run_coap_standard_device(n_readings=20):
+async def run_coap_standard_device(n_readings=20, port=PORT, pace=0.05, meter=None):
+    """Sends n_readings CON PUTs. Returns the measured traffic (TrafficMeter.totals())."""
     print(f"\n[CoAP] Starting Full Stack Simulation (Server + Client)...")
 
-    # A. Start the Server
-    server = await start_coap_server()
+    # A. Start the Server, behind a relay that counts every datagram on the wire (requests,
+    # responses, aiocoap's own retransmissions), as SmartSender's socket does
+    server = await start_coap_server(port)
+    meter = meter or TrafficMeter()
+    relay, relay_port = await start_relay((HOST, port), meter, coap_retransmit_key)
 
     # B. Start the Client
     client = await Context.create_client_context()
 
-    total_bytes = 0
     start_time = time.time()
 
-    print(f"[CoAP] Sending {n_readings} readings to coap://{HOST}:{PORT}/sensors/temp")
+    print(f"[CoAP] Sending {n_readings} readings to coap://{HOST}:{port}/sensors/temp (via :{relay_port})")
 
     for i in range(n_readings):
         payload = f"TEMP:{20 + i}".encode('utf-8')
 
         # Standard Confirmable (CON) PUT request
-        request = Message(code=PUT, payload=payload, uri=f"coap://{HOST}:{PORT}/sensors/temp")
+        request = Message(code=PUT, payload=payload, uri=f"coap://{HOST}:{relay_port}/sensors/temp")
         request.mtype = CON
 
-        # 1. Measure Size (Before sending)
-        packet_size = measure_packet_size(request)
-
         try:
-            # 2. Real Transmission
+            # Real Transmission
             # This will actually go to the server, get processed, and get an ACK back.
-            response = await client.request(request).response
-
-            # If we are here, we got an ACK!
-            # Total = Outgoing Packet + Incoming ACK (approx 4 bytes)
-            total_bytes += packet_size + 4
-
+            await client.request(request).response
         except Exception as e:
-            print(f"    [CoAP] Error: {e}")
-            total_bytes += packet_size  # We still paid the energy to send it
+            print(f"    [CoAP] Error: {e}")  # We still paid the energy to send it (it is counted)
 
         # Simulation Speed (Fast forward)
-        await asyncio.sleep(0.05)
+        await asyncio.sleep(pace)
 
     duration = time.time() - start_time
-    print(f"[CoAP] Test Complete. Traffic: {total_bytes} bytes in {duration:.2f}s")
+    traffic = meter.totals()
+    print(f"[CoAP] Test Complete. Traffic: {traffic['bytes']} bytes ({traffic['tx_datagrams']} sent, "
+          f"{traffic['rx_datagrams']} received, {traffic['wakeups']} wake-ups) in {duration:.2f}s")
 
     # C. Teardown
-    await server.shutdown()
     await client.shutdown()
+    relay.close()
+    await server.shutdown()
+
+    return traffic
 
-    return total_bytes, n_readings
\ No newline at end of file
+
+# --- 4. THE FLEET (N concurrent clients) ---
+def encode_readings(readings):
+    """The baseline's text payload: "TEMP:20" for one reading, "TEMP:20,21,22" for an aggregated PUT."""
+    return ("TEMP:" + ",".join(str(r) for r in readings)).encode('utf-8')
+
+
+class FleetStats:
+    """What the clients of one fleet run saw, from the application's side."""
+
+    def __init__(self):
+        self.readings = 0  # Taken
+        self.requests = 0
+        self.responses = 0
+        self.failed = 0  # No response (CON: after aiocoap's retransmissions; NON: after RESPONSE_TIMEOUT)
+        self.delivered = 0  # Readings in requests that got a response
+        self.latencies = array('d')  # Seconds from request to response (retransmissions included)
+        self.lag = array('d')  # How late readings were taken (a client still waiting on its last request)
+
+
+async def run_coap_client(context, uri, mtype, aggregate, interval, start, end, rng, stats):
+    """
+    One device: a reading every `interval` seconds from `start` to `end`, a PUT every `aggregate`
+    readings. Like a constrained device (and CoAP's NSTART = 1) it has one request outstanding at most.
+    What is left in the buffer at the end goes out in a last, smaller PUT.
+    """
+    async def put(readings):
+        request = Message(code=PUT, mtype=mtype, payload=encode_readings(readings), uri=uri)
+        stats.requests += 1
+        sent_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(context.request(request).response, RESPONSE_TIMEOUT)
+        except Exception:
+            stats.failed += 1
+            return
+        stats.latencies.append(time.perf_counter() - sent_at)
+        stats.responses += 1
+        stats.delivered += len(readings)
+
+    buffer = []
+    due = start
+    while due < end:
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        stats.lag.append(time.perf_counter() - due)
+        buffer.append(rng.randint(20, 30))
+        stats.readings += 1
+        due += interval
+        if len(buffer) >= aggregate:
+            await put(buffer)
+            buffer = []
+    if buffer:
+        await put(buffer)
+
+
+async def run_coap_fleet(n_clients=FLEET_CLIENTS, interval=FLEET_INTERVAL, duration=FLEET_DURATION, mtype=CON,
+                         aggregate=1, port=PORT, meter=None, seed=1):
+    """
+    N concurrent CoAP clients, each with its own endpoint (its own UDP port, as separate devices
+    would have), against one server behind the counting relay. Readings are spread over the first
+    interval, as in loadgen.py. Returns (FleetStats, elapsed s, TrafficMeter.totals()).
+    """
+    server = await start_coap_server(port)
+    meter = meter or TrafficMeter()
+    relay, relay_port = await start_relay((HOST, port), meter, coap_retransmit_key)
+    clients = [await Context.create_client_context() for _ in range(n_clients)]
+    uri = f"coap://{HOST}:{relay_port}/sensors/temp"
+
+    rng = random.Random(seed)
+    stats = FleetStats()
+    start = time.perf_counter()
+    end = start + duration
+    try:
+        await asyncio.gather(*(run_coap_client(client, uri, mtype, aggregate, interval,
+                                               start + rng.uniform(0, interval), end, rng, stats)
+                               for client in clients))
+        elapsed = time.perf_counter() - start
+    finally:
+        for client in clients:
+            await client.shutdown()
+        relay.close()
+        await server.shutdown()
+    return stats, elapsed, meter.totals()
+
+
+def latency_percentiles(seconds):
+    """Milliseconds: p50/p99/p999/max (None when there is nothing to measure)."""
+    ms = np.frombuffer(seconds, dtype=np.float64) * 1000
+    summary = {f"p{p}".replace(".", ""): float(np.percentile(ms, p)) if len(ms) else None for p in (50, 99, 99.9)}
+    summary["max"] = float(ms.max()) if len(ms) else None
+    return summary
+
+
+def summarize_fleet(stats, elapsed, traffic, n_clients, interval, mtype_name, aggregate):
+    return {
+        "clients": n_clients, "type": mtype_name, "aggregate": aggregate,
+        "elapsed_s": round(elapsed, 2),
+        "offered_readings_per_s": round(n_clients / interval, 1),
+        "requests_per_s": round(stats.requests / elapsed, 1),
+        "responses_per_s": round(stats.responses / elapsed, 1),
+        "delivered_readings_per_s": round(stats.delivered / elapsed, 1),
+        "readings": stats.readings, "delivered": stats.delivered,
+        "requests": stats.requests, "responses": stats.responses, "failed": stats.failed,
+        "latency_ms": latency_percentiles(stats.latencies),
+        "client_lag_ms": latency_percentiles(stats.lag),
+        "traffic": traffic,
+        "bytes_per_reading": round(traffic["bytes"] / stats.delivered, 1) if stats.delivered else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent CoAP baseline: N clients, CON/NON, aggregated or not")
+    parser.add_argument("--clients", type=int, default=FLEET_CLIENTS)
+    parser.add_argument("--interval", type=float, default=FLEET_INTERVAL, help="Seconds between readings per client")
+    parser.add_argument("--duration", type=float, default=FLEET_DURATION, help="Seconds")
+    parser.add_argument("--type", default="con,non", help="Message types to run: con, non or con,non")
+    parser.add_argument("--aggregate", default="1,5", help="Readings per PUT to run, e.g. 1,5,10")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--json", default=FLEET_FILE, help="Where to write the summaries")
+    args = parser.parse_args()
+    logging.getLogger("coap").setLevel(logging.ERROR)  # A NON request given up on is not an incident here
+
+    if os.name == 'nt':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    # 1. Every combination of message type and aggregation, at the same offered load
+    runs = []
+    for name, aggregate in itertools.product(args.type.split(","), (int(x) for x in args.aggregate.split(","))):
+        print(f"[CoAP] {args.clients} clients, {name.upper()}, {aggregate} reading(s) per PUT, "
+              f"a reading every {args.interval:g}s for {args.duration:g}s...")
+        result = asyncio.run(run_coap_fleet(args.clients, args.interval, args.duration, MESSAGE_TYPES[name],
+                                            aggregate, args.port))
+        runs.append(summarize_fleet(*result, args.clients, args.interval, name, aggregate))
+
+    # 2. Report
+    os.makedirs(os.path.dirname(args.json) or ".", exist_ok=True)
+    with open(args.json, 'w') as f:
+        json.dump(runs, f, indent=2)
+
+    print("\n" + "=" * 86)
+    print("   COAP FLEET RESULTS")
+    print("=" * 86)
+    print(f"{'Type':<5}{'Agg':>4}{'Req/s':>9}{'Readings/s':>12}{'Failed':>8}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'p999 ms':>9}{'Bytes':>9}{'B/reading':>11}")
+    fmt = lambda v: f"{v:9.2f}" if v is not None else f"{'-':>9}"
+    for run in runs:
+        latency = run["latency_ms"]
+        print(f"{run['type'].upper():<5}{run['aggregate']:>4}{run['requests_per_s']:>9}"
+              f"{run['delivered_readings_per_s']:>12}{run['failed']:>8}{fmt(latency['p50'])}{fmt(latency['p99'])}"
+              f"{fmt(latency['p999'])}{run['traffic']['bytes']:>9}{run['bytes_per_reading'] or '-':>11}")
+    print(f"Summary: {args.json}")
@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import heapq
+import socket
+import struct
+
+# --- TRACE FORMAT ---
+# A file header, then one record per datagram, exactly as it came off the socket:
+#   header   magic (8s), capture start (Unix time, f64)
+#   record   arrival (Unix time, f64), source IPv4 (4s), source port (u16), length (u16), datagram bytes
+# 16 bytes of overhead per datagram; little-endian. A restarted capture appends to the same file,
+# after cutting off a record the previous writer was killed in the middle of.
+TRACE_MAGIC = b"IOTTRC01"
+TRACE_HEADER = struct.Struct("<8sd")
+TRACE_RECORD = struct.Struct("<d4sHH")
+
+CAPTURE_MAX_BYTES = 1 << 30  # Capture stops (and counts what it skips) once a trace file reaches this
+CAPTURE_BUFFER = 1 << 20  # Write buffer: a crash loses at most this much of the trace (plus the record it cut)
+
+
+class TraceWriter:
+    """
+    Appends raw datagrams with their arrival time and source address to a binary trace.
+    Costs one struct pack and a buffered write per datagram, so it can stay on in the
+    receive path; the trace is replayed by server/replay.py. One writer per thread.
+    """
+
+    def __init__(self, path, max_bytes=CAPTURE_MAX_BYTES, buffering=CAPTURE_BUFFER):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buffering = buffering
+        self.records = 0
+        self.skipped = 0  # Datagrams not captured because the file is full
+        self._file = None
+        self._size = 0
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        complete = trace_length(self.path)
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size > complete:
+            # The last writer died in the middle of a record: appending behind it would shift every new one
+            print(f"[Capture] {self.path}: dropping {size - complete} bytes of a cut record")
+            os.truncate(self.path, complete)
+        self._file = open(self.path, 'ab', buffering=self.buffering)
+        self._size = self._file.tell()
+        if not self._size:
+            self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, time.time()))
+            self._size = TRACE_HEADER.size
+        return self
+
+    def write(self, data, addr, arrival=None):
+        size = TRACE_RECORD.size + len(data)
+        if self.max_bytes and self._size + size > self.max_bytes:
+            if not self.skipped:
+                print(f"[Capture] {self.path} reached {self.max_bytes} bytes, capture stopped")
+            self.skipped += 1
+            return
+        try:
+            ip = socket.inet_aton(addr[0])
+        except OSError:
+            ip = bytes(4)  # Not IPv4 (the gateway only binds AF_INET)
+        self._file.write(TRACE_RECORD.pack(time.time() if arrival is None else arrival, ip, addr[1], len(data)))
+        self._file.write(data)
+        self._size += size
+        self.records += 1
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def trace_length(path):
+    """Bytes of the trace at path that hold whole records (0 if there is no file, or not even a whole header)."""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return 0
+    with f:
+        end = os.fstat(f.fileno()).st_size
+        header = f.read(TRACE_HEADER.size)
+        if len(header) < TRACE_HEADER.size:
+            return 0
+        if TRACE_HEADER.unpack(header)[0] != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a datagram trace")
+        # Walk the record headers only: the datagrams are skipped, not read
+        pos = TRACE_HEADER.size
+        while pos + TRACE_RECORD.size <= end:
+            f.seek(pos)
+            length = TRACE_RECORD.unpack(f.read(TRACE_RECORD.size))[3]
+            if pos + TRACE_RECORD.size + length > end:
+                break
+            pos += TRACE_RECORD.size + length
+        return pos
+
+
+def read_trace(path):
+    """All datagrams of a trace: [(arrival, (ip, port), data)], data being bytes. A cut last record is left out."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    magic, _ = TRACE_HEADER.unpack_from(raw)
+    if magic != TRACE_MAGIC:
+        raise ValueError(f"{path} is not a datagram trace")
+
+    records = []
+    pos = TRACE_HEADER.size
+    end = len(raw)
+    while pos + TRACE_RECORD.size <= end:
+        arrival, ip, port, length = TRACE_RECORD.unpack_from(raw, pos)
+        pos += TRACE_RECORD.size
+        if pos + length > end:
+            break
+        records.append((arrival, (socket.inet_ntoa(ip), port), raw[pos:pos + length]))
+        pos += length
+    return records
+
+
+def merge_traces(paths):
+    """The datagrams of several traces (e.g. one per gateway worker) in arrival order."""
+    return list(heapq.merge(*(read_trace(path) for path in paths), key=lambda record: record[0]))
+
+
+if __name__ == "__main__":
+    # python datagram_trace.py capture.trace [...] -> what a trace holds
+    records = merge_traces(sys.argv[1:])
+    if not records:
+        sys.exit("Empty trace")
+    duration = records[-1][0] - records[0][0]
+    sizes = [len(data) for _, _, data in records]
+    print(f"{len(records)} datagrams from {len({addr for _, addr, _ in records})} addresses "
+          f"over {duration:.1f}s ({len(records) / max(duration, 1e-9):.0f}/s)")
+    print(f"Started {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(records[0][0]))} | "
+          f"{sum(sizes)} bytes, {min(sizes)}-{max(sizes)} per datagram (mean {sum(sizes) / len(sizes):.1f})")
@@ -0,0 +1,64 @@
+from collections import deque
+
+# RTO bounds (seconds). RFC 6298 uses a 1s floor; we go lower so a LAN link is not slowed down.
+MIN_RTO = 0.02
+MAX_RTO = 10.0
+INITIAL_RTO = 0.5  # Until the first RTT sample arrives
+
+
+class RttEstimator:
+    """
+    Retransmission timeout from measured round trips (RFC 6298, Jacobson/Karels):
+        RTTVAR = 3/4 RTTVAR + 1/4 |SRTT - R|
+        SRTT   = 7/8 SRTT + 1/8 R
+        RTO    = SRTT + 4 RTTVAR
+    Only packets ACKed on their first transmission give samples (Karn's rule), and
+    every timeout doubles the RTO until the next valid sample.
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.samples = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + self.K * self.rttvar))
+        self.samples += 1
+
+    def backoff(self):
+        self.rto = min(self.max_rto, self.rto * 2)
+
+
+class LossEstimator:
+    """Loss rate over the last `window` transmissions (lost = no ACK before the timer fired)."""
+
+    def __init__(self, window=32):
+        self.outcomes = deque(maxlen=window)
+        self.lost = 0
+
+    def record(self, lost):
+        if len(self.outcomes) == self.outcomes.maxlen:
+            self.lost -= self.outcomes[0]
+        self.outcomes.append(lost)
+        self.lost += lost
+
+    @property
+    def rate(self):
+        return self.lost / len(self.outcomes) if self.outcomes else 0.0
+
+    def etx(self):
+        """Expected transmissions per delivered packet: 1 / (1 - loss), capped so a dead link stays finite."""
+        return 1.0 / max(0.1, 1.0 - self.rate)
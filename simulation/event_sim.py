@@ -0,0 +1,463 @@
+import os
+import csv
+import math
+import time
+import heapq
+import random
+import argparse
+import itertools
+from collections import Counter
+from utils import HEADER_SIZE, DEVICE_ID_SIZE, PROTOCOL_V2, SACK_WIDTH, crypto_overhead, \
+    simulate_network_loss
+from sessions import SessionTable, SEQ_DUPLICATE, SEQ_REPLAY
+from ack_scheduler import sack_covers
+from estimators import RttEstimator, LossEstimator, MAX_RTO
+from payload_codecs import CODEC_RAW, encode, encode_smallest
+from Sender import InFlight
+from strategy import MAX_AGE, select_strategy, flush_trigger
+from battery import Battery
+
+RESULTS_FILE = "results/event_sim_devices.csv"
+DAY = 86400.0
+FRAME_OVERHEAD = HEADER_SIZE + DEVICE_ID_SIZE + crypto_overhead(PROTOCOL_V2)  # v2 frames, as SmartSender's
+
+# Defaults for a deployment that lives for weeks (the live demo drains a battery in minutes)
+READING_INTERVAL = 300.0  # Seconds between sensor readings
+DRAIN_IDLE = 2e-5  # % per second (~58 days on idle alone)
+DRAIN_TX = 0.01  # % per transmission
+LATENCY = 0.05  # One-way delay (seconds)
+JITTER = 0.02  # Extra random delay, uniform in [0, JITTER)
+SESSION_SWEEP_INTERVAL = 3600.0
+SIZE_SAMPLES = 32  # Encoded buffers per (codec, readings) whose sizes the packets draw from
+
+
+class Simulator:
+    """
+    Discrete-event engine: a virtual clock and a queue of (time, order, callback, args).
+    Time only moves when the next event is popped, so idle periods cost nothing.
+    Events scheduled for the same instant run in the order they were scheduled.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.queue = []
+        self.order = itertools.count()
+        self.events = 0
+
+    def clock(self):
+        return self.now
+
+    def schedule(self, at, callback, *args):
+        heapq.heappush(self.queue, (at, next(self.order), callback, args))
+
+    def run(self, until=math.inf):
+        queue = self.queue
+        while queue and queue[0][0] <= until:
+            self.now, _, callback, args = heapq.heappop(queue)
+            callback(*args)
+            self.events += 1
+        if until != math.inf:
+            self.now = until
+
+
+class SimLink:
+    """The radio link: uplink loss (the same model as the live sender), optional ACK loss and latency."""
+
+    def __init__(self, sim, gateway, loss=0.2, ack_loss=0.0, latency=LATENCY, jitter=JITTER, rng=random):
+        self.sim = sim
+        self.gateway = gateway
+        self.loss = loss
+        self.ack_loss = ack_loss
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = rng
+
+    def delay(self):
+        return self.latency + self.rng.random() * self.jitter
+
+    def send(self, device, pkt):
+        up, down = self.delay(), self.delay()
+        delivered = not simulate_network_loss(self.loss, self.rng)
+        ack_delivered = delivered and not (self.ack_loss and simulate_network_loss(self.ack_loss, self.rng))
+
+        if delivered:
+            self.sim.schedule(self.sim.now + up, self.gateway.on_uplink, device, pkt.seq, pkt.packet,
+                              down if ack_delivered else None)
+        # The timer only needs an event if it will actually fire before the ACK is back
+        if not ack_delivered or up + down >= pkt.timeout:
+            self.sim.schedule(pkt.deadline, device.on_timer, pkt, pkt.attempts)
+
+
+class PayloadSizes:
+    """
+    Encoded payload sizes for buffers of random readings (20-30, like the live sender's), per codec
+    and number of readings. Encoding every packet (NumPy through three codecs for the smallest) would
+    dominate the run, so the first packet of a (codec, readings) encodes `samples` random buffers and
+    every packet after it draws one of their sizes. One per run: the samples come from its rng.
+    """
+
+    def __init__(self, rng=random, samples=SIZE_SAMPLES):
+        self.rng = rng
+        self.samples = samples
+        self.sizes = {}  # (codec, readings) -> [size]
+
+    def size(self, codec, readings):
+        if codec == CODEC_RAW:
+            return readings  # One byte per reading
+        sizes = self.sizes.get((codec, readings))
+        if sizes is None:
+            sizes = self.sizes[(codec, readings)] = [self.encoded_size(codec, readings) for _ in range(self.samples)]
+        return sizes[int(self.rng.random() * self.samples)]
+
+    def encoded_size(self, codec, readings):
+        values = [self.rng.randint(20, 30) for _ in range(readings)]
+        if codec is None:
+            return len(encode_smallest(values)[1])
+        return len(encode(codec, values))
+
+
+class SimGateway:
+    """Gateway side: the same per-device session windows and selective ACKs as the real one."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.sessions = SessionTable(idle_timeout=7 * DAY)
+        self.last_sweep = 0.0
+        self.packets = 0
+        self.duplicates = 0
+        self.readings = 0
+        self.bytes = 0
+
+    def on_uplink(self, device, seq, packet, ack_delay):
+        readings, size = packet
+        now = self.sim.now
+        key = device.device_id
+
+        verdict = self.sessions.check(key, seq)
+        if verdict == SEQ_DUPLICATE:
+            self.duplicates += 1
+        else:
+            if verdict == SEQ_REPLAY:
+                self.sessions.forget(key)
+            self.sessions.update(key, seq, now)
+            self.packets += 1
+            self.readings += readings
+            self.bytes += size
+
+        if now - self.last_sweep >= SESSION_SWEEP_INTERVAL:
+            self.sessions.evict_idle(now)
+            self.last_sweep = now
+
+        if ack_delay is not None:
+            # The ACK's content, not its bytes: packing it only for the device to parse it back costs more
+            # than the rest of the uplink
+            self.sim.schedule(now + ack_delay, device.on_ack, seq, self.sessions.sack(key))
+
+
+class SimDevice:
+    """
+    SmartSender on the virtual clock: same strategy, battery, windowed ARQ and
+    link estimators, but no socket, no sleeps and no per-packet log.
+
+    Instead of one event per reading, the device jumps straight to the reading
+    that can fill the buffer, or to the one where the oldest reading's deadline
+    (MAX_AGE of the mode) forces a flush, whichever comes first. Between two
+    decisions the battery only drains, so the threshold can only go up and no
+    reading in between could have flushed; an ACK or timeout changes the loss
+    and RTT estimates, so the decision is then recomputed.
+    """
+
+    def __init__(self, device_id, sim, link, battery, interval=READING_INTERVAL, window=1, codec=CODEC_RAW,
+                 start=0.0, rng=random, max_age=MAX_AGE, sizes=None):
+        self.device_id = device_id
+        self.sim = sim
+        self.link = link
+        self.battery = battery
+        self.interval = interval
+        self.window = min(window, SACK_WIDTH)  # As SmartSender
+        self.codec = codec  # Payload codec ID, or None for the smallest encoding per packet
+        self.rng = rng
+        self.max_age = max_age
+        self.sizes = sizes or PayloadSizes(rng)  # Shared by the fleet
+
+        self.seq = 0
+        self.buffer = []  # Sample times of the buffered readings
+        self.next_sample = start
+        self.in_flight = {}
+        self.acked_any = False
+        self.blocked = False  # Window full: the sender loop waits, so no readings are taken
+        self.decision_at = None
+        self.generation = 0  # Invalidates decisions scheduled before a reschedule
+        self.died_at = None
+
+        self.rtt = RttEstimator()
+        self.loss = LossEstimator()
+
+        self.packets = 0
+        self.transmissions = 0
+        self.bytes_sent = 0
+        self.acked = 0
+        self.dropped = 0
+        self.readings_sent = 0
+        self.readings_lost = 0
+        self.staleness_total = 0.0  # Sample-to-ACK seconds, summed over the delivered readings
+        self.staleness_max = 0.0
+        self.modes = Counter()
+        self.triggers = Counter()
+
+    def get_strategy(self):
+        return select_strategy(self.battery.update_idle(), self.loss.etx())
+
+    # --- SENSOR LOOP ---
+    def schedule_next(self):
+        """Schedules the next reading where a flush is possible (or the moment the battery runs out)."""
+        if self.died_at is not None or self.blocked:
+            return
+        threshold, mode, _ = self.get_strategy()
+        if self.battery.is_dead:
+            self.die()
+            return
+
+        now = self.sim.now
+        at = self.next_sample + max(0, threshold - len(self.buffer) - 1) * self.interval
+        max_age = self.max_age.get(mode)
+        if max_age is not None:
+            # First reading at which flush_trigger's deadline rule fires
+            oldest = self.buffer[0] if self.buffer else self.next_sample
+            limit = oldest + max_age - self.interval - (self.rtt.srtt or 0.0)
+            readings = max(0, math.ceil((limit - self.next_sample) / self.interval))
+            at = min(at, self.next_sample + readings * self.interval)
+        if at < now:
+            # The threshold just dropped (better link): the next reading decides
+            at = self.next_sample + math.ceil((now - self.next_sample) / self.interval) * self.interval
+        if self.battery.drain_idle > 0:
+            at = min(at, now + self.battery.current / self.battery.drain_idle * (1 + 1e-9) + 1e-3)
+
+        if at == self.decision_at:
+            return
+        self.generation += 1
+        self.decision_at = at
+        self.sim.schedule(at, self.on_decision, self.generation)
+
+    def on_decision(self, generation):
+        if generation != self.generation or self.died_at is not None or self.blocked:
+            return
+        self.decision_at = None
+
+        # 1. Every reading sampled since the last decision
+        now = self.sim.now
+        if self.next_sample <= now:
+            n = int((now - self.next_sample) / self.interval + 1e-9) + 1
+            self.buffer.extend(self.next_sample + k * self.interval for k in range(n))
+            self.next_sample += n * self.interval
+
+        # 2. Decide Strategy
+        threshold, mode, max_retries = self.get_strategy()
+        if self.battery.is_dead:
+            self.die()
+            return
+
+        # 3. Flush if threshold met or the oldest reading's deadline is near (a hair of slack for the
+        # float error of the time schedule_next computed for this reading)
+        trigger = flush_trigger(len(self.buffer), threshold, now - self.buffer[0], self.max_age.get(mode),
+                                self.interval, (self.rtt.srtt or 0.0) + 1e-6)
+        if trigger:
+            self.flush(mode, max_retries, trigger)
+        self.schedule_next()
+
+    def die(self):
+        self.died_at = self.sim.now
+        self.readings_lost += len(self.buffer)
+        self.buffer = []
+
+    # --- TRANSMISSION ---
+    def flush(self, mode, max_retries, trigger):
+        size = FRAME_OVERHEAD + self.payload_size()
+        pkt = InFlight(self.seq, (len(self.buffer), size), mode, max_retries, self.rtt.rto, self.buffer, trigger)
+        self.packets += 1
+        self.modes[mode] += 1
+        self.triggers[trigger] += 1
+
+        if self.battery.is_dead:
+            self.resolve(pkt, "DROP")
+        else:
+            self.in_flight[self.seq] = pkt
+            self.transmit(pkt)
+
+        self.seq += 1
+        self.buffer = []
+        if not self.window_open():
+            self.blocked = True
+
+    def window_open(self):
+        """As SmartSender.window_open."""
+        if not self.in_flight:
+            return True
+        return self.acked_any and self.seq - min(self.in_flight) < self.window
+
+    def payload_size(self):
+        return self.sizes.size(self.codec, len(self.buffer))
+
+    def transmit(self, pkt):
+        self.transmissions += 1
+        self.bytes_sent += pkt.packet[1]
+        self.battery.consume_tx(retries=pkt.attempts)
+        pkt.sent_at = self.sim.now
+        pkt.deadline = pkt.sent_at + pkt.timeout
+        self.link.send(self, pkt)
+
+    def on_ack(self, ack_seq, sack):
+        """An ACK for ack_seq carrying the gateway's SACK state (as Packet.acked_seqs reads it on the wire)."""
+        now = self.sim.now
+        for seq in [s for s in self.in_flight if s == ack_seq or sack_covers(sack, s)]:
+            self.acked_any = True
+            pkt = self.in_flight[seq]
+            if pkt.attempts == 0 and seq == ack_seq:
+                self.rtt.sample(now - pkt.sent_at)
+            self.loss.record(False)
+            self.resolve(pkt, "SENT")
+        self.schedule_next()
+
+    def on_timer(self, pkt, attempts):
+        # Stale if the packet was ACKed or already retransmitted since this timer was set
+        if self.in_flight.get(pkt.seq) is pkt and pkt.attempts == attempts:
+            self.on_timeout(pkt)
+            self.schedule_next()
+
+    def on_timeout(self, pkt):
+        self.loss.record(True)
+        if pkt.timeout >= self.rtt.rto:
+            self.rtt.backoff()
+        pkt.attempts += 1
+        if pkt.attempts > pkt.max_retries or self.battery.is_dead:
+            self.resolve(pkt, "DROP")
+            return
+        pkt.timeout = min(MAX_RTO, pkt.timeout * 2)
+        self.transmit(pkt)
+
+    def resolve(self, pkt, status):
+        self.in_flight.pop(pkt.seq, None)
+        readings = pkt.packet[0]
+        if status == "SENT":
+            self.acked += 1
+            self.readings_sent += readings
+            now = self.sim.now
+            self.staleness_total += readings * now - sum(pkt.sampled)
+            self.staleness_max = max(self.staleness_max, now - pkt.sampled[0])
+        else:
+            self.dropped += 1
+            self.readings_lost += readings
+
+        # A free slot in the window: the sender loop resumes (sleep, then the next reading)
+        if self.blocked and self.window_open():
+            self.blocked = False
+            self.next_sample = self.sim.now + self.interval
+
+
+def run_fleet(n_devices=1000, days=14.0, interval=READING_INTERVAL, loss=0.2, ack_loss=0.0, window=1,
+              codec=CODEC_RAW, battery_range=(30.0, 100.0), drain_idle=DRAIN_IDLE, drain_tx=DRAIN_TX,
+              latency=LATENCY, jitter=JITTER, seed=1, max_age=MAX_AGE):
+    """Simulates a fleet for `days` of virtual time. Returns (summary, devices, gateway)."""
+    rng = random.Random(seed)
+    sim = Simulator()
+    gateway = SimGateway(sim)
+    link = SimLink(sim, gateway, loss, ack_loss, latency, jitter, rng)
+    sizes = PayloadSizes(rng)
+
+    devices = []
+    for device_id in range(1, n_devices + 1):
+        battery = Battery(initial_capacity=100.0, drain_idle=drain_idle, drain_tx=drain_tx, clock=sim.clock)
+        battery.current = rng.uniform(*battery_range)
+        # Random phase so the fleet doesn't sample in lockstep
+        device = SimDevice(device_id, sim, link, battery, interval, window, codec,
+                           start=rng.uniform(0, interval), rng=rng, max_age=max_age, sizes=sizes)
+        devices.append(device)
+        device.schedule_next()
+
+    started = time.perf_counter()
+    sim.run(until=days * DAY)
+    wall = time.perf_counter() - started
+
+    dead = [d for d in devices if d.died_at is not None]
+    modes = Counter()
+    triggers = Counter()
+    for d in devices:
+        modes.update(d.modes)
+        triggers.update(d.triggers)
+    readings_sent = sum(d.readings_sent for d in devices)
+    summary = {
+        "devices": n_devices,
+        "virtual_days": days,
+        "wall_seconds": wall,
+        "events": sim.events,
+        "events_per_second": sim.events / wall if wall > 0 else 0.0,
+        "dead": len(dead),
+        "mean_lifetime_days": sum(d.died_at for d in dead) / len(dead) / DAY if dead else None,
+        "packets": sum(d.packets for d in devices),
+        "transmissions": sum(d.transmissions for d in devices),
+        "bytes_sent": sum(d.bytes_sent for d in devices),
+        "acked": sum(d.acked for d in devices),
+        "dropped": sum(d.dropped for d in devices),
+        "readings_delivered": gateway.readings,
+        "readings_lost": sum(d.readings_lost for d in devices),
+        "gateway_duplicates": gateway.duplicates,
+        "modes": dict(modes),
+        "triggers": dict(triggers),
+        "mean_staleness": sum(d.staleness_total for d in devices) / readings_sent if readings_sent else None,
+        "max_staleness": max(d.staleness_max for d in devices),
+    }
+    return summary, devices, gateway
+
+
+def write_device_log(devices, path=RESULTS_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Device", "Battery", "DiedAt", "Packets", "Transmissions", "Bytes", "Acked", "Dropped",
+                         "ReadingsSent", "ReadingsLost", "SRTT", "Loss", "MeanStaleness", "MaxStaleness"])
+        for d in devices:
+            writer.writerow([d.device_id, f"{d.battery.current:.3f}",
+                             "" if d.died_at is None else f"{d.died_at:.1f}",
+                             d.packets, d.transmissions, d.bytes_sent, d.acked, d.dropped,
+                             d.readings_sent, d.readings_lost, f"{d.rtt.srtt or 0:.6f}", f"{d.loss.rate:.3f}",
+                             f"{d.staleness_total / d.readings_sent:.1f}" if d.readings_sent else "",
+                             f"{d.staleness_max:.1f}"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discrete-event fleet simulation (virtual clock)")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--days", type=float, default=14.0, help="Virtual time to simulate")
+    parser.add_argument("--interval", type=float, default=READING_INTERVAL, help="Seconds between readings")
+    parser.add_argument("--loss", type=float, default=0.2, help="Uplink loss probability")
+    parser.add_argument("--ack-loss", type=float, default=0.0, help="Downlink (ACK) loss probability")
+    parser.add_argument("--window", type=int, default=1, help="Packets in flight per device (1 = stop-and-wait)")
+    parser.add_argument("--codec", type=int, default=CODEC_RAW, help="Payload codec ID (-1 = smallest per packet)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-deadline", action="store_true",
+                        help="Aggregate on the threshold alone (no maximum buffering age per mode)")
+    args = parser.parse_args()
+
+    summary, devices, _ = run_fleet(args.devices, args.days, args.interval, args.loss, args.ack_loss,
+                                    args.window, None if args.codec < 0 else args.codec, seed=args.seed,
+                                    max_age={} if args.no_deadline else MAX_AGE)
+    write_device_log(devices)
+
+    print("=" * 50)
+    print("   FLEET SIMULATION (VIRTUAL CLOCK)")
+    print("=" * 50)
+    print(f"{summary['devices']} devices, {summary['virtual_days']:g} days in {summary['wall_seconds']:.1f}s "
+          f"({summary['events']} events, {summary['events_per_second']:.0f}/s)")
+    lifetime = summary["mean_lifetime_days"]
+    print(f"  - Dead devices:  {summary['dead']}"
+          + (f" (mean lifetime {lifetime:.1f} days)" if lifetime is not None else ""))
+    print(f"  - Packets:       {summary['packets']} ({summary['transmissions']} transmissions)")
+    print(f"  - Bytes:         {summary['bytes_sent']}")
+    print(f"  - ACKed/Dropped: {summary['acked']}/{summary['dropped']}")
+    print(f"  - Readings:      {summary['readings_delivered']} delivered, {summary['readings_lost']} lost")
+    print(f"  - Modes:         {summary['modes']}")
+    print(f"  - Triggers:      {summary['triggers']}")
+    if summary["mean_staleness"] is not None:
+        print(f"  - Staleness:     mean {summary['mean_staleness']:.0f}s | max {summary['max_staleness']:.0f}s "
+              f"(sample to ACK)")
+    print(f"Per-device results: {RESULTS_FILE}")
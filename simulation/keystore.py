@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from utils import MASTER_KEY, TAG_SIZE, TruncatedGCM
+
+KEY_SIZE = 32  # AES-256
+KDF_LABEL = b"iot-protocol device key v1"
+
+# v2 sequence numbers (the nonce is Device ID + seq under a fixed key: see utils.py)
+SEQ_STATE_FILE = "results/seq_state.json"
+SEQ_LEASE = 1024  # Seqs reserved on disk at a time: a crash skips the rest of a lease, it never reuses one
+SEQ_LIMIT = 1 << 32  # The header's 4-byte seq
+LOCK_TIMEOUT = 5.0  # Seconds to wait for another process's save before taking its (stale) lock
+
+
+def derive_device_key(master_secret, device_id):
+    """HKDF-SHA256(master_secret, info=label || device_id) -> 32-byte device key."""
+    info = KDF_LABEL + int(device_id).to_bytes(4, "big")
+    return HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=None, info=info).derive(master_secret)
+
+
+class KeyRing:
+    """
+    Per-device AES-GCM keys.
+
+    Every device has its own key: either provisioned explicitly or derived
+    from the master secret with HKDF. Building the AESGCM context (key
+    derivation + key schedule) is the expensive part, so ready-to-use cipher
+    objects are kept in a bounded LRU: the per-packet cost is one dict
+    lookup, and memory stays flat no matter how many devices are provisioned.
+
+    The v2 tag length is part of a key's parameters (fixed per key, as GCM
+    requires): tag_size for every device, unless provisioned otherwise.
+
+    Thread-safe: the receiver's decrypt workers share one KeyRing, and every
+    lookup reorders the LRU. The lock only covers the cache; the AEAD
+    contexts themselves can be used from several threads at once.
+    """
+
+    def __init__(self, master_secret=MASTER_KEY, cache_size=4096, tag_size=TAG_SIZE):
+        self.master_secret = master_secret
+        self.cache_size = cache_size
+        self.tag_size = tag_size
+        self.keys = {}  # device_id -> provisioned key (overrides derivation)
+        self.tag_sizes = {}  # device_id -> provisioned v2 tag length (overrides tag_size)
+        # device_id -> AESGCM, or (device_id, tag_size) -> TruncatedGCM; least recently used first
+        self.ciphers = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Cache statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def provision(self, device_id, key=None, tag_size=None):
+        """Registers a device. Without an explicit key, the derived key is stored."""
+        if key is None:
+            key = derive_device_key(self.master_secret, device_id)
+        if len(key) != KEY_SIZE:
+            raise ValueError(f"Device key must be {KEY_SIZE} bytes, got {len(key)}")
+        self._drop_contexts(device_id)  # Built from the old key
+        self.keys[device_id] = bytes(key)
+        if tag_size is not None:
+            self.tag_sizes[device_id] = tag_size
+
+    def revoke(self, device_id):
+        self.keys.pop(device_id, None)
+        self.tag_sizes.pop(device_id, None)
+        self._drop_contexts(device_id)
+
+    def key_for(self, device_id):
+        key = self.keys.get(device_id)
+        if key is None:
+            key = derive_device_key(self.master_secret, device_id)
+        return key
+
+    def tag_size_for(self, device_id):
+        return self.tag_sizes.get(device_id, self.tag_size)
+
+    def cipher(self, device_id, tag_size=TAG_SIZE):
+        """Returns the cached AEAD context for a device, building it on a miss (TruncatedGCM for short tags)."""
+        slot = device_id if tag_size == TAG_SIZE else (device_id, tag_size)
+        with self.lock:
+            aead = self.ciphers.get(slot)
+            if aead is not None:
+                self.hits += 1
+                self.ciphers.move_to_end(slot)
+                return aead
+
+            self.misses += 1
+            key = self.key_for(device_id)
+            aead = AESGCM(key) if tag_size == TAG_SIZE else TruncatedGCM(key, tag_size)
+            self.ciphers[slot] = aead
+            if len(self.ciphers) > self.cache_size:
+                self.ciphers.popitem(last=False)
+                self.evictions += 1
+            return aead
+
+    def cipher_v2(self, device_id):
+        """The context for the device's v2 frames, with its tag length."""
+        return self.cipher(device_id, self.tag_size_for(device_id))
+
+    def _drop_contexts(self, device_id):
+        with self.lock:
+            self.ciphers.pop(device_id, None)
+            for tag_size in set(self.tag_sizes.values()) | {self.tag_size}:
+                self.ciphers.pop((device_id, tag_size), None)
+
+    def warm(self, device_ids):
+        """Pre-builds contexts (e.g. for devices expected to wake up on the hour)."""
+        for device_id in device_ids:
+            self.cipher(device_id)
+
+
+class SeqStore:
+    """
+    Persistent per-device sequence counters. A v2 nonce is Device ID + seq under a fixed
+    key, so a device must never send two frames with one seq: not after a restart, not
+    after a crash. Seqs are handed out in leases, and the end of a lease is on disk
+    (save()) before any seq of it is used. A restart continues after the last lease; a
+    crash skips what was left of it. Past `limit` there is nothing left: re-key the device.
+
+    Several processes may share one file, for different devices: save() merges under a
+    lock file and keeps the highest value per device. Two processes running the same
+    device would still collide: give them different Device IDs.
+    """
+
+    def __init__(self, path=SEQ_STATE_FILE, lease=SEQ_LEASE, limit=SEQ_LIMIT):
+        self.path = path
+        self.lease_size = lease
+        self.limit = limit
+        self.reserved = self._load()  # device_id -> end of its lease (first seq not reserved yet)
+
+    def lease(self, device_id, count=None, start=0):
+        """
+        Reserves the device's next `count` seqs (default: one lease), from `start` at the earliest.
+        Returns (first, end): use first .. end - 1, then lease again. Call save() before using them.
+        Raises OverflowError when the device has used up its seq space.
+        """
+        first = max(self.reserved.get(device_id, 0), start)
+        if first >= self.limit:
+            raise OverflowError(f"Device {device_id} has used all {self.limit} sequence numbers: re-key it")
+        end = min(first + (count or self.lease_size), self.limit)
+        self.reserved[device_id] = end
+        return first, end
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock = self.path + ".lock"
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while True:
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                if time.monotonic() > deadline:
+                    print(f"[SeqStore] Taking over stale lock {lock}")
+                    break
+                time.sleep(0.01)
+        try:
+            # Other processes may have leased seqs of their own devices since we loaded
+            for device_id, end in self._load().items():
+                if end > self.reserved.get(device_id, 0):
+                    self.reserved[device_id] = end
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump({str(device_id): end for device_id, end in self.reserved.items()}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        finally:
+            os.remove(lock)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return {int(device_id): end for device_id, end in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
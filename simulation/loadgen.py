@@ -0,0 +1,448 @@
+import os
+import json
+import math
+import time
+import heapq
+import random
+import asyncio
+import argparse
+import multiprocessing
+from array import array
+import numpy as np
+from utils import LISTEN_IP, LISTEN_PORT, TAG_SIZE, Packet, FLAG_ACK, FLAG_AGGREGATED, FLAG_DEVICE_ID, \
+    DEVICE_ID_STRUCT, DL_THRESHOLD, DL_RETRIES, DL_UNSET, PROTOCOL_V2, encrypt_payload, simulate_network_loss
+from keystore import KeyRing, SeqStore
+from strategy import select_strategy
+
+# Devices share a few sockets, and an ACK only echoes the seq: every device gets its own
+# range of 2^SEQ_BITS sequence numbers, so (socket, seq) always points at one device.
+SEQ_BITS = 16
+SEQ_MASK = (1 << SEQ_BITS) - 1
+# Under v2 (nonce = Device ID + seq) a device never reuses a seq, across runs too: where each device's
+# range stands is kept here. A device that has used up its range falls back to v1 (random nonces).
+SEQ_FILE = "results/loadgen_seq.json"
+FIRST_ID = 100000  # Default Device IDs start here, away from SmartSender's (same keys, separate seq files)
+LEASE_PER_READING = 4  # Seqs reserved per reading of the run: the first send and up to 3 retries
+
+ADAPTIVE = "adaptive"  # Threshold and retries from the battery (or the gateway's downlink), like SmartSender
+# How the devices' reading intervals spread around --interval (each device keeps its own for the run)
+INTERVAL_FIXED = "fixed"  # Every device reads every --interval seconds
+INTERVAL_UNIFORM = "uniform"  # interval * U(1 - spread, 1 + spread)
+INTERVAL_LOGNORMAL = "lognormal"  # interval * lognormal(sigma=spread), mean interval: a few chatty devices
+INTERVAL_DISTS = (INTERVAL_FIXED, INTERVAL_UNIFORM, INTERVAL_LOGNORMAL)
+MIN_INTERVAL = 0.01  # Floor for drawn intervals (s)
+BATCH = 1000  # Events handled before yielding to the socket callbacks
+REPORT_INTERVAL = 5.0
+RESULTS_FILE = "results/loadgen.json"
+
+
+class LoadDevice:
+    """One emulated device: its own key, seq range and reading rate, stop-and-wait like SmartSender(window=1)."""
+    __slots__ = ("device_id", "aead", "id_bytes", "sock", "seq", "seq_end", "v2", "buffer", "battery", "interval",
+                 "packet", "sent_at", "attempts", "max_retries", "threshold_hint", "retry_hint")
+
+    def __init__(self, device_id, aead, sock, seq, battery, interval, seq_end=None, v2=False):
+        self.device_id = device_id
+        self.aead = aead
+        self.id_bytes = DEVICE_ID_STRUCT.pack(device_id)
+        self.sock = sock
+        self.seq = seq
+        self.seq_end = seq_end  # v2: end of the seqs leased for this run (in the device's range)
+        self.v2 = v2
+        self.buffer = 0  # Readings waiting to be sent
+        self.battery = battery
+        self.interval = interval  # Seconds between readings
+        self.packet = None  # In flight, waiting for its ACK
+        self.sent_at = 0.0
+        self.attempts = 0
+        self.max_retries = 0
+        self.threshold_hint = None  # From the gateway's downlink (ADAPTIVE devices only)
+        self.retry_hint = None
+
+
+class AckProtocol(asyncio.DatagramProtocol):
+    def __init__(self, generator, index):
+        self.generator = generator
+        self.index = index
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.generator.on_ack(self.index, data)
+
+    def error_received(self, exc):
+        self.generator.socket_errors += 1
+
+
+class LoadGenerator:
+    """
+    Emulates many devices from one event loop. Readings and retransmission timers
+    live in two heaps driven by a single scheduler, not one task per device.
+    """
+
+    def __init__(self, n_devices, first_id=FIRST_ID, target=(LISTEN_IP, LISTEN_PORT), n_sockets=64, interval=10.0,
+                 interval_dist=INTERVAL_FIXED, interval_spread=0.5, aggregation=ADAPTIVE, retries=1,
+                 battery_range=(20.0, 100.0), battery_drain=0.1, battery_drain_tx=0.2, loss=0.0, timeout=1.0,
+                 sync=False, seed=1, version=PROTOCOL_V2, tag_size=TAG_SIZE):
+        self.n_devices = n_devices
+        self.first_id = first_id
+        self.target = target
+        self.n_sockets = n_sockets
+        self.interval = interval  # Mean seconds between readings
+        self.interval_dist = interval_dist  # INTERVAL_*: how each device's own interval is drawn
+        self.interval_spread = interval_spread
+        self.aggregation = aggregation  # ADAPTIVE or a fixed threshold
+        self.retries = retries  # For fixed thresholds
+        self.battery_range = battery_range
+        self.battery_drain = battery_drain  # % per reading (sensing)
+        self.battery_drain_tx = battery_drain_tx  # % per transmission, retries at half cost (as Battery.consume_tx)
+        self.loss = loss  # Simulated uplink drop probability (the packet is not sent)
+        self.timeout = timeout
+        self.sync = sync  # Every device reads at the same instant (the "on the hour" burst)
+        self.version = version  # Frame format (the gateway must be provisioned with the same v2 tag_size)
+        self.tag_size = tag_size
+        self.rng = random.Random(seed)
+
+        self.devices = []
+        self.transports = []
+        self.pending = []  # Per socket: seq -> device
+        self.readings = []  # Heap of (due, device index)
+        self.timers = []  # Heap of (deadline, device index, seq, attempt)
+
+        self.readings_taken = 0
+        self.sent = 0
+        self.retransmits = 0
+        self.acked = 0
+        self.timeouts = 0
+        self.dropped = 0
+        self.socket_errors = 0
+        self.v1_fallbacks = 0  # Devices whose v2 seqs ran out (sent v1 from then on)
+        self.latencies = array('d')  # Seconds, first transmissions only (Karn's rule)
+        self.lag = array('d')  # How late the scheduler fired readings (generator saturation)
+
+    async def open(self, duration, seq_file=SEQ_FILE):
+        loop = asyncio.get_running_loop()
+        for index in range(self.n_sockets):
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda i=index: AckProtocol(self, i), remote_addr=self.target)
+            self.transports.append(transport)
+            self.pending.append({})
+
+        self.keyring = KeyRing(cache_size=self.n_devices, tag_size=self.tag_size)
+        store = SeqStore(seq_file, limit=1 << SEQ_BITS) if self.version == PROTOCOL_V2 else None
+        for i in range(self.n_devices):
+            device_id = self.first_id + i
+            slot = i // self.n_sockets
+            interval = self.draw_interval()
+            first, end = 0, None
+            if store is not None:
+                try:
+                    first, end = store.lease(device_id, (math.ceil(duration / interval) + 1) * LEASE_PER_READING)
+                except OverflowError:
+                    pass  # Range used up by earlier runs
+            device = LoadDevice(device_id, None, i % self.n_sockets, (slot << SEQ_BITS) | first,
+                                self.rng.uniform(*self.battery_range), interval, end, end is not None)
+            if store is not None and not device.v2:
+                self.fall_back_v1(device)
+            else:
+                device.aead = self.keyring.cipher_v2(device_id) if device.v2 else self.keyring.cipher(device_id)
+            self.devices.append(device)
+        if store is not None:
+            store.save()  # Before any of the leased seqs goes out
+
+    def draw_interval(self):
+        if self.interval_dist == INTERVAL_UNIFORM:
+            factor = self.rng.uniform(1 - self.interval_spread, 1 + self.interval_spread)
+        elif self.interval_dist == INTERVAL_LOGNORMAL:
+            sigma = self.interval_spread
+            factor = self.rng.lognormvariate(-sigma * sigma / 2, sigma)  # Mean 1
+        else:
+            factor = 1.0
+        return max(MIN_INTERVAL, self.interval * factor)
+
+    def fall_back_v1(self, device):
+        """The device's v2 seqs are used up: from now on it sends v1 frames (random nonce per packet)."""
+        device.v2 = False
+        device.seq_end = None
+        device.aead = self.keyring.cipher(device.device_id)
+        self.v1_fallbacks += 1
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+
+    def strategy(self, device):
+        if self.aggregation == ADAPTIVE:
+            threshold, _, max_retries = select_strategy(device.battery)
+            return (device.threshold_hint or threshold,
+                    max_retries if device.retry_hint is None else device.retry_hint)
+        return self.aggregation, self.retries
+
+    # --- DEVICE LOGIC ---
+    def on_reading(self, index):
+        device = self.devices[index]
+        device.buffer += 1
+        self.readings_taken += 1
+        device.battery = max(0.0, device.battery - self.battery_drain)
+
+        threshold, max_retries = self.strategy(device)
+        if device.buffer >= threshold and device.packet is None:
+            self.flush(index, device, max_retries)
+
+    def flush(self, index, device, max_retries):
+        n = device.buffer
+        payload = bytes(self.rng.choices(range(20, 31), k=n))
+        flags = FLAG_DEVICE_ID | (FLAG_AGGREGATED if n > 1 else 0)
+        seq = device.seq
+        if device.v2:
+            device.packet = Packet.pack_v2(seq, flags, int(device.battery), device.device_id, payload, device.aead)
+        else:
+            device.packet = Packet.pack(seq, flags, int(device.battery),
+                                        device.id_bytes + encrypt_payload(payload, device.aead))
+        device.buffer = 0
+        device.attempts = 0
+        device.max_retries = max_retries
+        self.pending[device.sock][seq] = index
+        self.transmit(index, device)
+
+    def transmit(self, index, device):
+        device.sent_at = time.perf_counter()
+        # The radio costs the same whether or not the packet makes it
+        cost = self.battery_drain_tx if device.attempts == 0 else self.battery_drain_tx * 0.5
+        device.battery = max(0.0, device.battery - cost)
+        if not simulate_network_loss(self.loss, self.rng):
+            self.transports[device.sock].sendto(device.packet)
+        self.sent += 1
+        heapq.heappush(self.timers, (device.sent_at + self.timeout * 2 ** device.attempts, index,
+                                     device.seq, device.attempts))
+
+    def on_ack(self, sock, data):
+        seq, flags, _, payload = Packet.unpack(data)
+        if seq is None or not flags & FLAG_ACK:
+            return
+        index = self.pending[sock].pop(seq, None)
+        if index is None:
+            return  # Late ACK of a packet we already gave up on
+        device = self.devices[index]
+        downlink = Packet.downlink(flags, payload)
+        if downlink:
+            self.on_downlink(device, downlink)
+        if device.attempts == 0:
+            self.latencies.append(time.perf_counter() - device.sent_at)
+        self.acked += 1
+        self.resolve(device)
+
+    def on_downlink(self, device, items):
+        if DL_THRESHOLD in items:
+            device.threshold_hint = items[DL_THRESHOLD] or None
+        if DL_RETRIES in items:
+            device.retry_hint = None if items[DL_RETRIES] == DL_UNSET else items[DL_RETRIES]
+
+    def on_timer(self, index, seq, attempt):
+        device = self.devices[index]
+        if device.packet is None or device.seq != seq or device.attempts != attempt:
+            return  # ACKed or already retransmitted
+        self.timeouts += 1
+        if device.attempts >= device.max_retries:
+            self.pending[device.sock].pop(seq, None)
+            self.dropped += 1
+            self.resolve(device)
+            return
+        device.attempts += 1
+        self.retransmits += 1
+        self.transmit(index, device)
+
+    def resolve(self, device):
+        device.packet = None
+        low = (device.seq & SEQ_MASK) + 1
+        if device.seq_end is not None and low >= device.seq_end:
+            self.fall_back_v1(device)  # A v2 seq is never wrapped or reused
+        device.seq = (device.seq & ~SEQ_MASK) | (low & SEQ_MASK)
+
+    # --- SCHEDULER ---
+    async def run(self, duration):
+        start = time.perf_counter()
+        for index in range(self.n_devices):
+            phase = 0.0 if self.sync else self.rng.uniform(0, self.devices[index].interval)
+            heapq.heappush(self.readings, (start + phase, index))
+
+        end = start + duration
+        next_report = start + REPORT_INTERVAL
+        last = (0, 0)
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+
+            handled = 0
+            while self.readings and self.readings[0][0] <= now and handled < BATCH:
+                due, index = heapq.heappop(self.readings)
+                self.lag.append(now - due)
+                self.on_reading(index)
+                heapq.heappush(self.readings, (due + self.devices[index].interval, index))
+                handled += 1
+            while self.timers and self.timers[0][0] <= now and handled < BATCH:
+                _, index, seq, attempt = heapq.heappop(self.timers)
+                self.on_timer(index, seq, attempt)
+                handled += 1
+
+            if now >= next_report:
+                sent, acked = self.sent - last[0], self.acked - last[1]
+                print(f"[LoadGen] {now - start:5.0f}s | TX {sent / REPORT_INTERVAL:8.0f}/s | "
+                      f"ACK {acked / REPORT_INTERVAL:8.0f}/s | in flight {sum(map(len, self.pending))}")
+                last = (self.sent, self.acked)
+                next_report += REPORT_INTERVAL
+
+            if handled >= BATCH:
+                await asyncio.sleep(0)  # Let the ACK callbacks run
+                continue
+            heads = [end]
+            if self.readings:
+                heads.append(self.readings[0][0])
+            if self.timers:
+                heads.append(self.timers[0][0])
+            await asyncio.sleep(max(0.0, min(heads) - time.perf_counter()))
+
+        # Give the last ACKs a moment to come back
+        await asyncio.sleep(min(self.timeout, 0.5))
+        return time.perf_counter() - start
+
+    def stats(self, elapsed):
+        return {
+            "devices": self.n_devices, "offered": sum(1.0 / d.interval for d in self.devices), "elapsed": elapsed,
+            "readings": self.readings_taken,
+            "sent": self.sent, "retransmits": self.retransmits, "acked": self.acked,
+            "timeouts": self.timeouts, "dropped": self.dropped, "socket_errors": self.socket_errors,
+            "v1_fallbacks": self.v1_fallbacks, "latencies": np.frombuffer(self.latencies, dtype=np.float64),
+            "lag": np.frombuffer(self.lag, dtype=np.float64),
+        }
+
+
+async def run_generator(options, n_devices, first_id, duration):
+    generator = LoadGenerator(n_devices, first_id, **options)
+    await generator.open(duration)
+    try:
+        elapsed = await generator.run(duration)
+    finally:
+        generator.close()
+    return generator.stats(elapsed)
+
+
+def run_process(job):
+    options, n_devices, first_id, duration = job
+    return asyncio.run(run_generator(options, n_devices, first_id, duration))
+
+
+def merge(parts):
+    total = {key: sum(p[key] for p in parts) for key in ("devices", "offered", "readings", "sent", "retransmits",
+                                                          "acked", "timeouts", "dropped", "socket_errors",
+                                                          "v1_fallbacks")}
+    total["elapsed"] = max(p["elapsed"] for p in parts)
+    total["latencies"] = np.concatenate([p["latencies"] for p in parts])
+    total["lag"] = np.concatenate([p["lag"] for p in parts])
+    return total
+
+
+def summarize(total):
+    latencies, lag = total["latencies"] * 1000, total["lag"] * 1000
+    percentiles = (lambda a: {f"p{p}".replace(".", ""): float(np.percentile(a, p)) if len(a) else None
+                              for p in (50, 99, 99.9)})
+    return {
+        "devices": total["devices"],
+        "elapsed_s": round(total["elapsed"], 2),
+        "offered_readings_per_s": round(total["offered"], 1),
+        "tx_per_s": round(total["sent"] / total["elapsed"], 1),
+        "acked_per_s": round(total["acked"] / total["elapsed"], 1),
+        "readings": total["readings"],
+        "readings_per_packet": round(total["readings"] / max(1, total["sent"] - total["retransmits"]), 2),
+        "sent": total["sent"], "retransmits": total["retransmits"], "acked": total["acked"],
+        "timeouts": total["timeouts"], "dropped": total["dropped"], "socket_errors": total["socket_errors"],
+        "v1_fallbacks": total["v1_fallbacks"],
+        "ack_latency_ms": {**percentiles(latencies), "max": float(latencies.max()) if len(latencies) else None},
+        "scheduler_lag_ms": percentiles(lag),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fleet load generator for the gateway")
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--procs", type=int, default=1, help="Generator processes (devices are split evenly)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds")
+    parser.add_argument("--host", default=LISTEN_IP)
+    parser.add_argument("--port", type=int, default=LISTEN_PORT)
+    parser.add_argument("--sockets", type=int, default=64, help="UDP sockets per process (devices share them)")
+    parser.add_argument("--interval", type=float, default=10.0, help="Mean seconds between readings per device")
+    parser.add_argument("--interval-dist", choices=INTERVAL_DISTS, default=INTERVAL_FIXED,
+                        help="How each device's own interval is drawn around --interval")
+    parser.add_argument("--interval-spread", type=float, default=0.5,
+                        help="uniform: +/- fraction of --interval; lognormal: sigma")
+    parser.add_argument("--aggregation", default=ADAPTIVE,
+                        help="'adaptive' (battery-driven modes) or a fixed threshold, e.g. 5")
+    parser.add_argument("--retries", type=int, default=1, help="Retries with a fixed threshold")
+    parser.add_argument("--battery", default="20,100", help="Starting battery range %%, e.g. 20,100")
+    parser.add_argument("--drain", type=float, default=0.1, help="Battery %% used per reading")
+    parser.add_argument("--drain-tx", type=float, default=0.2, help="Battery %% used per transmission (retries: half)")
+    parser.add_argument("--loss", type=float, default=0.0, help="Simulated uplink loss probability")
+    parser.add_argument("--timeout", type=float, default=1.0, help="ACK timeout (doubles per retry)")
+    parser.add_argument("--sync", action="store_true", help="All devices wake at the same instant")
+    parser.add_argument("--first-id", type=int, default=FIRST_ID, help="Device ID of the first device")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=PROTOCOL_V2, help="Frame format version")
+    parser.add_argument("--tag-size", type=int, default=TAG_SIZE, help="v2 auth tag bytes (as provisioned)")
+    parser.add_argument("--json", default=RESULTS_FILE, help="Where to write the summary")
+    args = parser.parse_args()
+    if args.interval_dist == INTERVAL_UNIFORM and not 0 <= args.interval_spread < 1:
+        parser.error("--interval-spread must be in [0, 1) with --interval-dist uniform")
+
+    low, high = (float(x) for x in args.battery.split(","))
+    options = {
+        "target": (args.host, args.port), "n_sockets": args.sockets, "interval": args.interval,
+        "interval_dist": args.interval_dist, "interval_spread": args.interval_spread,
+        "aggregation": ADAPTIVE if args.aggregation == ADAPTIVE else int(args.aggregation),
+        "retries": args.retries, "battery_range": (low, high), "battery_drain": args.drain,
+        "battery_drain_tx": args.drain_tx,
+        "loss": args.loss, "timeout": args.timeout, "sync": args.sync,
+        "version": args.protocol, "tag_size": args.tag_size,
+    }
+
+    per_proc = -(-args.devices // args.procs)
+    jobs = []
+    for p in range(args.procs):
+        n = min(per_proc, args.devices - p * per_proc)
+        if n > 0:
+            jobs.append(({**options, "seed": p + 1}, n, args.first_id + p * per_proc, args.duration))
+
+    print(f"[LoadGen] {args.devices} devices -> {args.host}:{args.port} "
+          f"({len(jobs)} process(es), reading every {args.interval:g}s, {args.interval_dist})")
+    if len(jobs) == 1:
+        parts = [run_process(jobs[0])]
+    else:
+        with multiprocessing.Pool(len(jobs)) as pool:
+            parts = pool.map(run_process, jobs)
+
+    summary = summarize(merge(parts))
+    os.makedirs(os.path.dirname(args.json) or ".", exist_ok=True)
+    with open(args.json, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    latency = summary["ack_latency_ms"]
+    print("\n" + "=" * 50)
+    print("   LOAD TEST RESULTS")
+    print("=" * 50)
+    print(f"Devices:       {summary['devices']} over {summary['elapsed_s']}s")
+    print(f"Throughput:    {summary['tx_per_s']} pkt/s sent, {summary['acked_per_s']} ACK/s")
+    print(f"Packets:       {summary['sent']} sent ({summary['retransmits']} retransmits), "
+          f"{summary['acked']} ACKed, {summary['dropped']} given up")
+    print(f"Readings:      {summary['readings']} ({summary['readings_per_packet']} per packet)")
+    if summary["v1_fallbacks"]:
+        print(f"v1 fallback:   {summary['v1_fallbacks']} devices used up their v2 seq range "
+              f"({SEQ_FILE}; give them new Device IDs with --first-id to re-key)")
+    if latency["p50"] is not None:
+        print(f"ACK latency:   p50 {latency['p50']:.2f} ms | p99 {latency['p99']:.2f} ms | "
+              f"p999 {latency['p999']:.2f} ms | max {latency['max']:.2f} ms")
+    lag = summary["scheduler_lag_ms"]
+    if lag["p99"] is not None and lag["p99"] > 10:
+        print(f"WARNING: generator lag p99 {lag['p99']:.0f} ms - the generator itself is saturated, "
+              f"add --procs to measure the gateway")
+    print(f"Summary: {args.json}")
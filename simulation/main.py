@@ -2,78 +2,219 @@ import asyncio
 import threading
 import time
 import os
+import csv
+import argparse
 from Sender import SmartSender
+from strategy import STRATEGY_TIERS, TRIGGER_FINAL
 from Receiver import EnergyProtocolReceiver
+from keystore import KeyRing
+from utils import LISTEN_IP, LISTEN_PORT, TAG_SIZE, PROTOCOL_V1, PROTOCOL_V2, crypto_overhead
+from traffic import TrafficMeter, start_relay
+from loadgen import run_generator, FIRST_ID
 import coap_competitor
 
 # --- ENERGY MODEL ---
 E_WAKEUP = 15.0
 E_BYTE = 0.1
 
+# --- SCENARIO ---
+N_READINGS = 50
+START_BATTERY = 50.0
+LINK_LOSS = 0.2
+READING_PACE = 0.05  # Wall-clock seconds between readings ("fast forward")
+PROTOCOL_VERSION = PROTOCOL_V2  # Frame format of the sender (the receiver takes both)
+V2_TAG_SIZE = TAG_SIZE  # v2 auth tag length, provisioned on both ends (e.g. 8 for a truncated tag)
 
-def calculate_energy(n_packets, total_bytes):
-    return (n_packets * E_WAKEUP) + (total_bytes * E_BYTE)
+# Results in the format plot_results.py loads (sweep.py writes the same columns)
+HEAD_TO_HEAD_FILE = "results/head_to_head.csv"
+# Traffic is measured at each contender's socket (traffic.py): packets = datagrams sent (retransmissions
+# included), bytes = bytes sent + received (ACKs/responses included)
+RESULT_FIELDS = ["n_readings", "battery", "loss", "thresholds", "retries",
+                 "smart_packets", "smart_bytes", "smart_energy",
+                 "coap_packets", "coap_bytes", "coap_energy", "gain",
+                 "smart_wakeups", "smart_retransmits", "coap_wakeups", "coap_retransmits"]
 
+# --- FLEET (--fleet N): both protocols at the same offered load, N devices reading every FLEET_INTERVAL ---
+FLEET_INTERVAL = 1.0
+FLEET_DURATION = 30.0
+FLEET_AGGREGATE = 5  # Readings per PUT of the aggregated CoAP variants
+FLEET_FILE = "results/fleet_head_to_head.csv"
+FLEET_FIELDS = ["protocol", "devices", "offered_per_s", "readings", "delivered", "delivered_per_s",
+                "packets", "packets_per_s", "failed", "p50_ms", "p99_ms", "p999_ms", "max_ms",
+                "bytes", "wakeups", "retransmits", "energy", "mj_per_reading"]
 
-def run_my_protocol_experiment(n_readings):
-    print(f"\n[MY PROTOCOL] Starting Secure Sender ({n_readings} readings)...")
 
-    sender = SmartSender()
-    sender.battery.current = 50.0
+def calculate_energy(n_wakeups, total_bytes):
+    return (n_wakeups * E_WAKEUP) + (total_bytes * E_BYTE)
 
-    packets_sent = 0
-    bytes_sent = 0
 
-    # Overhead Constants
-    HEADER_SIZE = 6
-    CRYPTO_OVERHEAD = 12 + 16  # Nonce (12) + AuthTag (16)
+def traffic_energy(traffic):
+    """Energy of measured traffic (TrafficMeter.totals()): every radio wake-up, every byte sent or received."""
+    return calculate_energy(traffic["wakeups"], traffic["bytes"])
+
+
+def framing_savings(n_packets, version=PROTOCOL_VERSION, tag_size=V2_TAG_SIZE):
+    """Bytes saved over the same packets framed as v1 (12-byte nonce on the wire, 16-byte tag)."""
+    return n_packets * (crypto_overhead(PROTOCOL_V1) - crypto_overhead(version, tag_size))
+
+
+def result_row(n_readings, battery, loss, strategy, smart, coap):
+    """One results row from the measured traffic of both contenders."""
+    smart_energy = traffic_energy(smart)
+    coap_energy = traffic_energy(coap)
+    return {
+        "n_readings": n_readings, "battery": battery, "loss": loss,
+        "thresholds": "/".join(str(tier[1]) for tier in strategy),
+        "retries": "/".join(str(tier[3]) for tier in strategy),
+        "smart_packets": smart["tx_datagrams"], "smart_bytes": smart["bytes"],
+        "smart_energy": round(smart_energy, 1),
+        "coap_packets": coap["tx_datagrams"], "coap_bytes": coap["bytes"], "coap_energy": round(coap_energy, 1),
+        "gain": round((coap_energy - smart_energy) / coap_energy * 100, 2) if coap_energy > 0 else 0.0,
+        "smart_wakeups": smart["wakeups"], "smart_retransmits": smart["retransmits"],
+        "coap_wakeups": coap["wakeups"], "coap_retransmits": coap["retransmits"],
+    }
+
+
+def save_results(rows, path=HEAD_TO_HEAD_FILE, fields=RESULT_FIELDS):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def run_my_protocol_experiment(n_readings, battery=START_BATTERY, port=LISTEN_PORT, strategy=STRATEGY_TIERS,
+                               link_loss=LINK_LOSS, pace=READING_PACE, version=PROTOCOL_VERSION, keyring=None,
+                               device_id=1):
+    """Sends n_readings through a SmartSender. Returns its measured traffic (TrafficMeter.totals())."""
+    print(f"\n[MY PROTOCOL] Starting Secure Sender ({n_readings} readings, protocol v{version})...")
+
+    # The readings here are a counter (20, 21, ...), not a sensor: no alarm thresholds
+    sender = SmartSender(target_port=port, device_id=device_id, strategy=strategy, link_loss=link_loss,
+                         version=version, keyring=keyring, urgent_above=None)
+    sender.battery.current = battery
 
     for i in range(n_readings):
-        sender.buffer.append(20 + i)
+        sender.add_reading(20 + i)
 
         thresh, mode, retries = sender.get_strategy()
 
-        if len(sender.buffer) >= thresh:
-            # Size = Header + Crypto Overhead + Payload (1 byte per int)
-            pkg_size = HEADER_SIZE + CRYPTO_OVERHEAD + len(sender.buffer)
-
-            sender.flush(mode, retries)
-            packets_sent += 1
-            bytes_sent += pkg_size
+        trigger = sender.flush_trigger(thresh, mode)
+        if trigger:
+            sender.flush(mode, retries, trigger)
 
-        time.sleep(0.05)
+        time.sleep(pace)
 
     if sender.buffer:
-        pkg_size = HEADER_SIZE + CRYPTO_OVERHEAD + len(sender.buffer)
-        sender.flush("FINAL", 1)
-        packets_sent += 1
-        bytes_sent += pkg_size
+        sender.flush("FINAL", 1, TRIGGER_FINAL)
+    sender.drain()
+
+    return sender.traffic.totals()
+
+
+def print_traffic(traffic, energy):
+    print(f"  - Packets:  {traffic['tx_datagrams']} sent ({traffic['retransmits']} retransmissions, "
+          f"{traffic['lost']} lost), {traffic['rx_datagrams']} received")
+    print(f"  - Bytes:    {traffic['bytes']} ({traffic['tx_bytes']} sent + {traffic['rx_bytes']} received)")
+    print(f"  - Wake-ups: {traffic['wakeups']}")
+    print(f"  - ENERGY:   {energy:.1f} mJ")
 
-    return packets_sent, bytes_sent
 
+def fleet_row(protocol, n_devices, interval, elapsed, readings, delivered, packets, failed, latency, traffic):
+    """One fleet results row. latency: ms percentiles (coap_competitor.latency_percentiles)."""
+    energy = traffic_energy(traffic)
+    return {
+        "protocol": protocol, "devices": n_devices, "offered_per_s": round(n_devices / interval, 1),
+        "readings": readings, "delivered": delivered, "delivered_per_s": round(delivered / elapsed, 1),
+        "packets": packets, "packets_per_s": round(packets / elapsed, 1), "failed": failed,
+        **{f"{key}_ms": None if value is None else round(value, 2) for key, value in latency.items()},
+        "bytes": traffic["bytes"], "wakeups": traffic["wakeups"], "retransmits": traffic["retransmits"],
+        "energy": round(energy, 1), "mj_per_reading": round(energy / delivered, 2) if delivered else None,
+    }
 
-async def main():
-    n_readings = 50
+
+async def run_smart_fleet(n_devices, interval, duration, keyring):
+    """
+    loadgen.py's devices (adaptive aggregation, stop-and-wait) against the receiver, through the same
+    counting relay as the CoAP fleet. One socket per device, so the relay sees one address per device.
+    """
+    delivered = [0]
+
+    def count_readings(device_id, seq, budget, values, size):
+        delivered[0] += len(values)
+
+    receiver = EnergyProtocolReceiver(keyring, port=0, sink=count_readings)
+    threading.Thread(target=receiver.start, daemon=True).start()
+    meter = TrafficMeter()
+    relay, relay_port = await start_relay((LISTEN_IP, receiver.sock.getsockname()[1]), meter)
+    options = {"target": (LISTEN_IP, relay_port), "n_sockets": n_devices, "interval": interval,
+               "tag_size": keyring.tag_size}
+    try:
+        stats = await run_generator(options, n_devices, FIRST_ID, duration)
+    finally:
+        relay.close()
+        receiver.stop()
+
+    traffic = meter.totals()
+    traffic["retransmits"] = stats["retransmits"]  # The relay can't tell them apart in ciphertext; loadgen knows
+    latency = coap_competitor.latency_percentiles(stats["latencies"])
+    return fleet_row("Smart (adaptive)", n_devices, interval, stats["elapsed"], stats["readings"], delivered[0],
+                     stats["sent"], stats["dropped"], latency, traffic)
+
+
+async def run_fleet_comparison(n_devices, interval=FLEET_INTERVAL, duration=FLEET_DURATION, keyring=None):
+    """Every contender with n_devices taking a reading every `interval` seconds for `duration` seconds."""
+    print(f"\n[FLEET] {n_devices} devices, a reading every {interval:g}s each ({n_devices / interval:g} readings/s), "
+          f"{duration:g}s per contender")
+    rows = [await run_smart_fleet(n_devices, interval, duration, keyring or KeyRing(tag_size=V2_TAG_SIZE))]
+    for name, aggregate in (("con", 1), ("non", 1), ("con", FLEET_AGGREGATE), ("non", FLEET_AGGREGATE)):
+        print(f"[FLEET] CoAP {name.upper()}, {aggregate} reading(s) per PUT...")
+        stats, elapsed, traffic = await coap_competitor.run_coap_fleet(
+            n_devices, interval, duration, coap_competitor.MESSAGE_TYPES[name], aggregate)
+        rows.append(fleet_row(f"CoAP {name.upper()} x{aggregate}", n_devices, interval, elapsed, stats.readings,
+                              stats.delivered, stats.requests, stats.failed,
+                              coap_competitor.latency_percentiles(stats.latencies), traffic))
+    save_results(rows, FLEET_FILE, FLEET_FIELDS)
+
+    print("\n" + "=" * 92)
+    print(f"      FLEET RESULTS ({n_devices / interval:g} readings/s offered)")
+    print("=" * 92)
+    print(f"{'Contender':<18}{'Readings/s':>11}{'Packets/s':>10}{'Failed':>7}{'p50 ms':>8}{'p99 ms':>8}"
+          f"{'Bytes':>8}{'Wake-ups':>9}{'Energy mJ':>11}{'mJ/reading':>11}")
+    fmt = lambda v: f"{v:8.2f}" if v is not None else f"{'-':>8}"
+    for row in rows:
+        print(f"{row['protocol']:<18}{row['delivered_per_s']:>11}{row['packets_per_s']:>10}{row['failed']:>7}"
+              f"{fmt(row['p50_ms'])}{fmt(row['p99_ms'])}{row['bytes']:>8}{row['wakeups']:>9}"
+              f"{row['energy']:>11}{row['mj_per_reading'] or '-':>11}")
+    print(f"Results saved to {FLEET_FILE}")
+    print("=" * 92)
+
+
+async def main(fleet=0, interval=FLEET_INTERVAL, duration=FLEET_DURATION):
+    n_readings = N_READINGS
 
     print("=" * 50)
     print("   IOT BATTLE: SECURE BINARY vs STANDARD COAP")
     print("=" * 50)
 
     # --- ROUND 1: YOUR PROTOCOL ---
-    my_rx = EnergyProtocolReceiver()
+    keyring = KeyRing(tag_size=V2_TAG_SIZE)
+    my_rx = EnergyProtocolReceiver(keyring)
     t = threading.Thread(target=my_rx.start)
     t.daemon = True
     t.start()
 
-    my_pkts, my_bytes = run_my_protocol_experiment(n_readings)
-    my_energy = calculate_energy(my_pkts, my_bytes)
+    mine = run_my_protocol_experiment(n_readings, keyring=keyring)
+    my_energy = traffic_energy(mine)
+    saved_bytes = framing_savings(mine["tx_datagrams"])
 
     my_rx.stop()
 
     # --- ROUND 2: STANDARD COAP ---
-    coap_bytes, _ = await coap_competitor.run_coap_standard_device(n_readings)
-    coap_pkts = n_readings
-    coap_energy = calculate_energy(coap_pkts, coap_bytes)
+    coap = await coap_competitor.run_coap_standard_device(n_readings)
+    coap_energy = traffic_energy(coap)
+
+    save_results([result_row(n_readings, START_BATTERY, LINK_LOSS, STRATEGY_TIERS, mine, coap)])
 
     # --- FINAL RESULTS ---
     print("\n\n" + "=" * 40)
@@ -82,23 +223,34 @@ async def main():
     print(f"SCENARIO: Sending {n_readings} sensor readings.\n")
 
     print(f"CANDIDATE 1: Standard CoAP (Text/JSON, No Encryption)")
-    print(f"  - Packets: {coap_pkts}")
-    print(f"  - Bytes:   {coap_bytes}")
-    print(f"  - ENERGY:  {coap_energy:.1f} mJ")
+    print_traffic(coap, coap_energy)
 
     print(f"\nCANDIDATE 2: Smart Protocol (Binary + AES-GCM)")
-    print(f"  - Packets: {my_pkts}")
-    print(f"  - Bytes:   {my_bytes}")
-    print(f"  - ENERGY:  {my_energy:.1f} mJ")
+    print_traffic(mine, my_energy)
+    if saved_bytes:
+        print(f"  - Framing: v{PROTOCOL_VERSION} saved {saved_bytes} bytes ({saved_bytes * E_BYTE:.1f} mJ, "
+              f"{saved_bytes / (mine['bytes'] + saved_bytes) * 100:.1f}% of the bytes) over v1")
 
     if coap_energy > 0:
         savings = ((coap_energy - my_energy) / coap_energy) * 100
         print(f"\n>>> EFFICIENCY GAIN: {savings:.1f}% <<<")
         print("(Even with encryption overhead, we win!)")
+    print(f"Results saved to {HEAD_TO_HEAD_FILE} (python plot_results.py)")
     print("=" * 40)
 
+    # --- ROUND 3: THE FLEET, AT EQUAL OFFERED LOAD ---
+    if fleet:
+        await run_fleet_comparison(fleet, interval, duration, keyring)
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Head-to-head: Smart Protocol vs standard CoAP")
+    parser.add_argument("--fleet", type=int, default=0,
+                        help="Also compare N concurrent devices of each protocol at equal offered load (0 = off)")
+    parser.add_argument("--interval", type=float, default=FLEET_INTERVAL, help="Fleet: seconds between readings")
+    parser.add_argument("--duration", type=float, default=FLEET_DURATION, help="Fleet: seconds per contender")
+    args = parser.parse_args()
+
     if os.name == 'nt':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(args.fleet, args.interval, args.duration))
\ No newline at end of file
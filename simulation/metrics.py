@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+from array import array
+
+# Histogram bucket upper bounds in microseconds (1-2-5 steps, 1us .. 1s); one overflow bucket above
+LATENCY_BOUNDS_US = [m * 10 ** e for e in range(7) for m in (1, 2, 5)][:19]
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram: recording is one bisect and one increment, memory never grows.
+    Percentiles are bucket upper bounds (capped at the max seen), i.e. accurate to the bucket.
+    Stage times are recorded in microseconds.
+    """
+    __slots__ = ("bounds", "counts", "total", "count", "max")
+
+    def __init__(self, bounds=LATENCY_BOUNDS_US):
+        self.bounds = bounds
+        self.counts = array('Q', [0] * (len(bounds) + 1))
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def record_ns(self, ns):
+        self.record(ns / 1000)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50), "p99": self.percentile(99), "p999": self.percentile(99.9),
+            "max": self.max if self.count else None,
+            "buckets": dict(zip([str(b) for b in self.bounds] + ["inf"], self.counts.tolist())),
+        }
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of one gateway process.
+
+    No locks: every counter and histogram has a single writer (the receive loop or
+    the log writer thread), and the snapshot thread only reads them. A snapshot can
+    be a few increments behind, never corrupt.
+    """
+
+    def __init__(self, name="gateway"):
+        self.name = name
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}  # name -> callable, read at snapshot time (e.g. queue depths)
+
+    def counter(self, *names):
+        """Registers counters so they show up (as 0) before their first increment."""
+        for name in names:
+            self.counters.setdefault(name, 0)
+        return self.counters
+
+    def histogram(self, name, bounds=LATENCY_BOUNDS_US):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds)
+        return self.histograms[name]
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        now = time.time()
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            "name": self.name,
+            "pid": os.getpid(),
+            "time": now,
+            "uptime": now - self.started,
+            "counters": dict(self.counters),
+            "gauges": gauges,
+            "histograms": {name: h.snapshot() for name, h in list(self.histograms.items())},
+        }
+
+
+class SnapshotWriter:
+    """Writes metrics.snapshot() to a JSON file every `interval` seconds (atomically: tmp file + rename)."""
+
+    def __init__(self, metrics, path, interval=5.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def write(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.metrics.snapshot(), f, indent=1)
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.write()  # Final numbers on shutdown
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"[Metrics] Snapshot failed: {e}")
+
+
+class RateLimitedLog:
+    """
+    Console logging that can't become the bottleneck: at most `burst` lines per
+    `interval` seconds, then one line saying how many were suppressed.
+    Check allow() before formatting the message, so suppressed lines cost nothing.
+    """
+
+    def __init__(self, burst=10, interval=1.0):
+        self.burst = burst
+        self.interval = interval
+        self.window_start = 0.0
+        self.printed = 0
+        self.suppressed = 0
+
+    def allow(self):
+        now = time.monotonic()
+        if now - self.window_start >= self.interval:
+            if self.suppressed:
+                print(f"[{time.strftime('%H:%M:%S')}] ... {self.suppressed} log lines suppressed "
+                      f"in the last {self.interval:g}s")
+            self.window_start = now
+            self.printed = 0
+            self.suppressed = 0
+        if self.printed < self.burst:
+            self.printed += 1
+            return True
+        self.suppressed += 1
+        return False
+
+
+def kernel_udp_stats(sock):
+    """
+    Kernel-side state of a UDP socket from /proc/net/udp (Linux): bytes waiting in the
+    receive queue and datagrams dropped because it was full. None where unavailable.
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        for table in ("/proc/net/udp", "/proc/net/udp6"):
+            with open(table) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return {"rx_queue": int(fields[4].split(":")[1], 16), "drops": int(fields[12])}
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def merge_snapshots(snapshots):
+    """Sums counters and numeric gauges, and histogram buckets, across worker snapshots."""
+    counters, gauges, buckets = {}, {}, {}
+    for snap in snapshots:
+        for name, value in snap["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, value in snap["gauges"].items():
+            if isinstance(value, (int, float)):
+                gauges[name] = gauges.get(name, 0) + value
+        for name, h in snap["histograms"].items():
+            merged = buckets.setdefault(name, {})
+            for bound, n in h["buckets"].items():
+                merged[bound] = merged.get(bound, 0) + n
+
+    histograms = {}
+    for name, merged in buckets.items():
+        h = Histogram([float(b) for b in merged if b != "inf"])
+        h.counts = array('Q', merged.values())
+        h.count = sum(merged.values())
+        h.max = max((s["histograms"][name]["max"] or 0) for s in snapshots if name in s["histograms"])
+        histograms[name] = h
+    return counters, gauges, histograms
+
+
+if __name__ == "__main__":
+    # python metrics.py iot_gateway_stats*.json -> one table for all workers
+    paths = sys.argv[1:] or ["iot_gateway_stats.json"]
+    snapshots = []
+    for path in paths:
+        with open(path) as f:
+            snapshots.append(json.load(f))
+    counters, gauges, histograms = merge_snapshots(snapshots)
+
+    uptime = max(s["uptime"] for s in snapshots)
+    print(f"{len(snapshots)} snapshot(s), uptime {uptime:.0f}s")
+    for name, value in sorted(counters.items()):
+        rate = f"  ({value / uptime:.1f}/s)" if uptime > 0 else ""
+        print(f"  {name:<24}{value:>14}{rate}")
+    for name, value in sorted(gauges.items()):
+        print(f"  {name:<24}{value:>14}")
+    print(f"  {'histogram':<24}{'count':>10}{'p50':>10}{'p99':>10}{'p999':>10}{'max':>12}")
+    for name, h in histograms.items():
+        if h.count:
+            print(f"  {name:<24}{h.count:>10}{h.percentile(50):>10g}{h.percentile(99):>10g}"
+                  f"{h.percentile(99.9):>10g}{h.max:>12.1f}")
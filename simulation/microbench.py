@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import timeit
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+from contextlib import redirect_stdout
+from utils import Packet, HEADER_STRUCT, TAG_SIZE, FLAG_DEVICE_ID, FLAG_V2, DEVICE_ID_STRUCT, encrypt_payload, \
+    decrypt_payload, encrypt_payload_v2, decrypt_payload_v2
+from keystore import KeyRing, SeqStore
+from sessions import SessionTable
+from Sender import SmartSender
+from Receiver import EnergyProtocolReceiver
+
+BASELINE_FILE = "results/bench_baseline.json"
+LATEST_FILE = "results/bench_latest.json"
+SIZES = [1, 10, 64, 256]  # Payload bytes (readings for the sender benchmark)
+REGRESSION_THRESHOLD = 10.0  # % slower than the baseline that fails the run
+BENCH_PORT = 5099  # The receiver benchmark binds its own port, away from a running demo
+REPEATS = 5
+ALLOC_SAMPLES = 50
+
+DEVICE_ID = 0xFFFF0000  # No simulated device has it: the v2 benchmarks encrypt made-up seqs under its key
+
+# State the benchmarks can't help writing (sender log, seq leases) goes here, not to results/
+SCRATCH = tempfile.TemporaryDirectory(prefix="microbench-")
+
+
+# --- BENCHMARKS ---
+# Each one takes a payload size and returns (op, bytes handled per op); op is timed with no arguments.
+def bench_pack(size):
+    payload = os.urandom(size)
+    return lambda: Packet.pack(1234, FLAG_DEVICE_ID, 80, payload), size
+
+
+def bench_unpack(size):
+    frame = Packet.pack(1234, FLAG_DEVICE_ID, 80, os.urandom(size))
+    return lambda: Packet.unpack(frame), len(frame)
+
+
+def bench_unpack_pooled(size):
+    # What the receive loops hand over: a view of the datagram in its pooled bytearray
+    frame = Packet.pack(1234, FLAG_DEVICE_ID, 80, os.urandom(size))
+    data = memoryview(bytearray(frame) + bytearray(64))[:len(frame)]
+    return lambda: Packet.unpack(data), len(frame)
+
+
+def bench_encrypt(size):
+    aead = KeyRing().cipher(DEVICE_ID)
+    plaintext = os.urandom(size)
+    return lambda: encrypt_payload(plaintext, aead), size
+
+
+def bench_decrypt(size):
+    aead = KeyRing().cipher(DEVICE_ID)
+    ciphertext = encrypt_payload(os.urandom(size), aead)
+    return lambda: decrypt_payload(ciphertext, aead), len(ciphertext)
+
+
+def bench_encrypt_v2(size):
+    aead = KeyRing().cipher_v2(DEVICE_ID)
+    plaintext = os.urandom(size)
+    header = HEADER_STRUCT.pack(1234, FLAG_V2 | FLAG_DEVICE_ID, 80)
+    return lambda: encrypt_payload_v2(plaintext, aead, DEVICE_ID, 1234, header), size
+
+
+def bench_decrypt_v2(size, tag_size=TAG_SIZE):
+    aead = KeyRing(tag_size=tag_size).cipher_v2(DEVICE_ID)
+    header = HEADER_STRUCT.pack(1234, FLAG_V2 | FLAG_DEVICE_ID, 80)
+    ciphertext = encrypt_payload_v2(os.urandom(size), aead, DEVICE_ID, 1234, header)
+    return lambda: decrypt_payload_v2(ciphertext, aead, DEVICE_ID, 1234, header), len(ciphertext)
+
+
+def bench_decrypt_v2_tag8(size):
+    # Truncated tags go through the slower Cipher API
+    return bench_decrypt_v2(size, tag_size=8)
+
+
+def bench_sender_pack(size):
+    # What SmartSender.flush does before the radio: codec selection, encryption, framing
+    sender = SmartSender(target_port=BENCH_PORT, device_id=DEVICE_ID,
+                         seq_store=SeqStore(os.path.join(SCRATCH.name, "seq_state.json")),
+                         log_file=os.path.join(SCRATCH.name, "smart_sender_log.csv"))
+    sender.buffer = [random.randint(20, 30) for _ in range(size)]
+    return sender.build_packet, size
+
+
+def bench_process_packet(size, n_frames=4096):
+    """
+    The full receiver path (parse, replay check, decrypt, decode, log line, ACK) on pre-built v2 frames.
+    Every frame has a new seq; the session table is reset when the frames wrap around.
+    """
+    keyring = KeyRing()
+    aead = keyring.cipher_v2(DEVICE_ID)
+    payload = bytes(random.randint(20, 30) for _ in range(size))
+    frames = [Packet.pack_v2(seq, 0, 80, DEVICE_ID, payload, aead) for seq in range(n_frames)]
+    return replay_frames(get_receiver(keyring), frames), len(frames[0])
+
+
+def bench_process_packet_v1(size, n_frames=4096):
+    """Same with v1 frames: no replay window, the nonce cache catches duplicates instead."""
+    keyring = KeyRing()
+    aead = keyring.cipher(DEVICE_ID)
+    device_id = DEVICE_ID_STRUCT.pack(DEVICE_ID)
+    payload = bytes(random.randint(20, 30) for _ in range(size))
+    frames = [Packet.pack(seq, FLAG_DEVICE_ID, 80, device_id + encrypt_payload(payload, aead))
+              for seq in range(n_frames)]
+    return replay_frames(get_receiver(keyring), frames), len(frames[0])
+
+
+def replay_frames(receiver, frames):
+    """An op feeding the frames to the receiver in turn, forgetting what it has seen when they wrap around."""
+    addr = ack_sink.getsockname()
+    position = [0]
+
+    def op():
+        i = position[0]
+        if i == len(frames):
+            receiver.sessions = SessionTable()
+            receiver.v1_nonces.clear()
+            i = 0
+        position[0] = i + 1
+        receiver.process_packet(frames[i], addr)
+
+    return op
+
+
+BENCHMARKS = {
+    "pack": bench_pack,
+    "unpack": bench_unpack,
+    "unpack_pooled": bench_unpack_pooled,
+    "encrypt": bench_encrypt,
+    "decrypt": bench_decrypt,
+    "encrypt_v2": bench_encrypt_v2,
+    "decrypt_v2": bench_decrypt_v2,
+    "decrypt_v2_tag8": bench_decrypt_v2_tag8,
+    "sender_pack": bench_sender_pack,
+    "process_packet": bench_process_packet,
+    "process_packet_v1": bench_process_packet_v1,
+}
+
+_receiver = None
+ack_sink = None  # Receives (and ignores) the ACKs of the process_packet benchmark
+
+
+def get_receiver(keyring):
+    global _receiver, ack_sink
+    if _receiver is None:
+        _receiver = EnergyProtocolReceiver(port=BENCH_PORT)
+        ack_sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        ack_sink.bind(("127.0.0.1", 0))
+    _receiver.keyring = keyring
+    _receiver.sessions = SessionTable()
+    _receiver.v1_nonces.clear()
+    return _receiver
+
+
+# --- MEASUREMENT ---
+def time_op(op, repeats=REPEATS):
+    """ns per call: timeit picks a loop count (>= 0.2s per loop), the best of `repeats` loops wins."""
+    timer = timeit.Timer(op)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeats, number)) / number * 1e9
+
+
+def alloc_op(op, samples=ALLOC_SAMPLES):
+    """Peak bytes allocated during one call (median over samples), from tracemalloc."""
+    op()  # Warm up caches and lazy imports outside the trace
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            op()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return statistics.median(peaks)
+
+
+def run_benchmarks(names, sizes):
+    results = {}
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):  # Receiver/sender prints
+        for name in names:
+            for size in sizes:
+                op, nbytes = BENCHMARKS[name](size)
+                ns = time_op(op)
+                results[f"{name}/{size}"] = {
+                    "ns_per_op": round(ns, 1),
+                    "alloc_bytes": alloc_op(op),
+                    "ops_per_sec": round(1e9 / ns, 1),
+                    "mb_per_sec": round(nbytes * 1e9 / ns / 1e6, 3),
+                }
+                print(f"{name}/{size} done", file=sys.stderr)
+    return results
+
+
+def save(results, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def compare(results, baseline, threshold):
+    """Prints the table and returns the benchmarks slower than the baseline by more than threshold %."""
+    print(f"{'Benchmark':<22}{'ns/op':>12}{'baseline':>12}{'change':>9}{'alloc B':>10}{'ops/s':>14}{'MB/s':>10}")
+    regressions = []
+    for key, r in results.items():
+        base = baseline.get(key)
+        line = f"{key:<22}{r['ns_per_op']:>12.1f}"
+        if base:
+            change = (r["ns_per_op"] - base["ns_per_op"]) / base["ns_per_op"] * 100
+            flag = ""
+            if change > threshold:
+                regressions.append(key)
+                flag = " <<< REGRESSION"
+            line += f"{base['ns_per_op']:>12.1f}{change:>+8.1f}%"
+        else:
+            line += f"{'-':>12}{'-':>9}"
+            flag = ""
+        line += f"{r['alloc_bytes']:>10.0f}{r['ops_per_sec']:>14.0f}{r['mb_per_sec']:>10.2f}{flag}"
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the protocol hot paths")
+    parser.add_argument("--bench", default=",".join(BENCHMARKS), help=f"Comma-separated subset of {list(BENCHMARKS)}")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="Payload sizes in bytes")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline JSON to compare against")
+    parser.add_argument("--save", action="store_true", help="Write this run as the new baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Fail if a benchmark is this many %% slower than the baseline")
+    args = parser.parse_args()
+
+    names = args.bench.split(",")
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmark(s): {unknown}")
+
+    results = run_benchmarks(names, [int(s) for s in args.sizes.split(",")])
+    save(results, LATEST_FILE)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        save(results, args.baseline)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif not baseline:
+        print(f"\nNo baseline at {args.baseline}: run with --save to create one")
+    elif regressions:
+        print(f"\nFAIL: {len(regressions)} benchmark(s) more than {args.threshold:g}% slower than the baseline: "
+              f"{', '.join(regressions)}")
+        sys.exit(1)
+    else:
+        print(f"\nOK: nothing more than {args.threshold:g}% slower than the baseline")
@@ -0,0 +1,281 @@
+import numpy as np
+
+# --- CODEC REGISTRY ---
+# The codec ID lives in bits 4-5 of the flags byte. 0 is the original format
+# (one unsigned byte per reading), so old devices keep working unchanged.
+CODEC_SHIFT = 4
+CODEC_MASK = 0x30
+
+CODEC_RAW = 0  # uint8 per reading (0-255)
+CODEC_DELTA_VARINT = 1  # Deltas, zigzag-mapped, as LEB128 varints
+CODEC_BITPACK = 2  # count, min, width, then (value - min) packed in `width` bits each
+CODEC_FLOAT_XOR = 3  # Gorilla-style: XOR with the previous float64, zero bytes elided
+
+CODEC_NAMES = {CODEC_RAW: "RAW", CODEC_DELTA_VARINT: "DELTA", CODEC_BITPACK: "BITPACK", CODEC_FLOAT_XOR: "XOR"}
+
+
+def codec_flags(codec):
+    return (codec << CODEC_SHIFT) & CODEC_MASK
+
+
+def codec_of(flags):
+    return (flags & CODEC_MASK) >> CODEC_SHIFT
+
+
+# --- PRIMITIVES (vectorized) ---
+def zigzag_encode(values):
+    v = np.asarray(values, dtype=np.int64)
+    return ((v << 1) ^ (v >> 63)).astype(np.uint64)
+
+
+def zigzag_decode(values):
+    v = np.asarray(values, dtype=np.uint64)
+    return ((v >> np.uint64(1)).astype(np.int64)) ^ -((v & np.uint64(1)).astype(np.int64))
+
+
+def varint_encode(values):
+    """LEB128: 7 bits per byte, high bit set on every byte except a value's last."""
+    v = np.asarray(values, dtype=np.uint64)
+    if len(v) == 0:
+        return b""
+    # Bytes needed per value (1..10)
+    nbytes = np.ones(len(v), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += v >= np.uint64(1 << (7 * k))
+
+    starts = np.zeros(len(v), dtype=np.int64)
+    np.cumsum(nbytes[:-1], out=starts[1:])
+    out = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max())):
+        sel = nbytes > k
+        group = (v[sel] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (nbytes[sel] > k + 1).astype(np.uint8) << 7
+        out[starts[sel] + k] = group.astype(np.uint8) | more
+    return out.tobytes()
+
+
+def varint_decode(data):
+    """Decodes a whole stream of varints at once. Returns (values, value index of every input byte)."""
+    b = np.frombuffer(data, dtype=np.uint8)
+    if len(b) == 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    last = (b & 0x80) == 0
+    if not last[-1]:
+        raise ValueError("Truncated varint")
+
+    ends = np.flatnonzero(last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    owner = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    position = np.arange(len(b)) - starts[owner]
+    if position.max() > 9:
+        raise ValueError("Varint longer than 10 bytes")
+
+    groups = (b & 0x7F).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.add.reduceat(groups, starts), owner  # Groups don't overlap, so add == or
+
+
+# --- CODECS ---
+def encode_raw(values):
+    v = np.asarray(values, dtype=np.int64)
+    if len(v) and (v.min() < 0 or v.max() > 255):
+        raise ValueError("RAW codec only carries 0-255")
+    return v.astype(np.uint8).tobytes()
+
+
+def decode_raw(data):
+    return np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+
+
+def encode_delta_varint(values):
+    v = np.asarray(values, dtype=np.int64)
+    return varint_encode(zigzag_encode(np.diff(v, prepend=0)))
+
+
+def decode_delta_varint(data):
+    values, _ = varint_decode(data)
+    return np.cumsum(zigzag_decode(values))
+
+
+def encode_bitpack(values):
+    v = np.asarray(values, dtype=np.int64)
+    base = int(v.min()) if len(v) else 0
+    span = int(v.max()) - base if len(v) else 0  # In Python ints: max - min can overflow int64
+    if span >= 1 << 63:
+        raise ValueError("BITPACK only carries ranges below 2**63")
+    width = span.bit_length()
+    head = varint_encode(np.concatenate((np.array([len(v)], dtype=np.uint64), zigzag_encode([base])))) + bytes([width])
+    if width == 0:
+        return head
+    shifted = (v - base).astype(np.uint64)
+    bits = ((shifted[:, None] >> np.arange(width, dtype=np.uint64)) & np.uint64(1)).astype(np.uint8)
+    return head + np.packbits(bits.ravel(), bitorder="little").tobytes()
+
+
+def decode_bitpack(data):
+    b = np.frombuffer(data, dtype=np.uint8)
+    # Header: two varints then the width byte
+    ends = np.flatnonzero((b & 0x80) == 0)
+    if len(ends) < 2 or len(b) < ends[1] + 2:
+        raise ValueError("Truncated BITPACK header")
+    (count, zz_base), _ = varint_decode(b[:ends[1] + 1].tobytes())
+    count = int(count)
+    base = int(zigzag_decode([zz_base])[0])
+    width = int(b[ends[1] + 1])
+    if width == 0:
+        return np.full(count, base, dtype=np.int64)
+
+    bits = np.unpackbits(b[ends[1] + 2:], bitorder="little")
+    if len(bits) < count * width:
+        raise ValueError("Truncated BITPACK body")
+    bits = bits[:count * width].reshape(count, width).astype(np.uint64)
+    return (bits << np.arange(width, dtype=np.uint64)).sum(axis=1).astype(np.int64) + base
+
+
+def encode_float_xor(values):
+    """
+    Gorilla-style float compression, byte-aligned so it vectorizes: every value is XORed
+    with the previous one, then stored as one control byte (leading zero bytes << 4 |
+    trailing zero bytes) followed only by the bytes in between.
+    """
+    v = np.asarray(values, dtype=">f8").view(">u8")
+    if len(v) == 0:
+        return b""
+    xor = v ^ np.concatenate((np.zeros(1, dtype=">u8"), v[:-1]))
+    raw = xor.view(np.uint8).reshape(-1, 8)  # Big-endian: column 0 is the most significant byte
+
+    nonzero = raw != 0
+    any_nonzero = nonzero.any(axis=1)
+    lead = np.where(any_nonzero, nonzero.argmax(axis=1), 8)
+    trail = np.where(any_nonzero, nonzero[:, ::-1].argmax(axis=1), 0)
+    length = 8 - lead - trail
+
+    starts = np.zeros(len(v), dtype=np.int64)
+    np.cumsum(length[:-1] + 1, out=starts[1:])
+    out = np.zeros(int((length + 1).sum()), dtype=np.uint8)
+    out[starts] = ((np.minimum(lead, 8) << 4) | trail).astype(np.uint8)
+
+    cols = np.arange(8)
+    keep = (cols >= lead[:, None]) & (cols < (8 - trail)[:, None])
+    rows, kept_cols = np.nonzero(keep)
+    out[starts[rows] + 1 + kept_cols - lead[rows]] = raw[keep]
+    return out.tobytes()
+
+
+def decode_float_xor(data):
+    b = np.frombuffer(data, dtype=np.uint8)
+    # Control bytes chain (each one says how far the next is), so this scan stays in Python
+    controls, lengths, pos = [], [], 0
+    while pos < len(b):
+        lead, trail = b[pos] >> 4, b[pos] & 0x0F
+        length = max(0, 8 - lead - trail)
+        if lead > 8 or trail > 8 or pos + 1 + length > len(b):
+            raise ValueError("Corrupt XOR stream")
+        controls.append(pos)
+        lengths.append(length)
+        pos += 1 + length
+
+    controls = np.asarray(controls, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    lead = (b[controls] >> 4).astype(np.int64)
+
+    raw = np.zeros((len(controls), 8), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(controls)), lengths)
+    offset = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    raw[rows, lead[rows] + offset] = b[controls[rows] + 1 + offset]
+
+    xor = raw.view(">u8").ravel()
+    return np.bitwise_xor.accumulate(xor).view(">f8").astype(np.float64)
+
+
+CODECS = {
+    CODEC_RAW: (encode_raw, decode_raw),
+    CODEC_DELTA_VARINT: (encode_delta_varint, decode_delta_varint),
+    CODEC_BITPACK: (encode_bitpack, decode_bitpack),
+    CODEC_FLOAT_XOR: (encode_float_xor, decode_float_xor),
+}
+INTEGER_CODECS = (CODEC_RAW, CODEC_DELTA_VARINT, CODEC_BITPACK)
+
+
+def encode(codec, values):
+    return CODECS[codec][0](values)
+
+
+def decode(codec, data):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}")
+    return CODECS[codec][1](data)
+
+
+def encode_smallest(values, candidates=INTEGER_CODECS):
+    """Tries every candidate codec and keeps the shortest encoding. Returns (codec, bytes)."""
+    best = None
+    for codec in candidates:
+        try:
+            data = encode(codec, values)
+        except ValueError:
+            continue
+        if best is None or len(data) < len(best[1]):
+            best = (codec, data)
+    return best
+
+
+def decode_batch(codecs, payloads):
+    """
+    Decodes many payloads at once (gateway side). Returns (values, offsets):
+    the readings of payload i are values[offsets[i]:offsets[i + 1]].
+
+    RAW and DELTA_VARINT payloads are concatenated and decoded in one vectorized pass;
+    the others are decoded one by one. A payload that fails to decode yields its raw bytes.
+    """
+    n = len(payloads)
+    parts = [None] * n
+    codecs = np.asarray(codecs, dtype=np.int64)
+
+    # 1. RAW: one conversion for the lot, then slice per payload
+    idx = np.flatnonzero(codecs == CODEC_RAW)
+    if len(idx):
+        chunks = [bytes(payloads[i]) for i in idx]
+        values = decode_raw(b"".join(chunks))
+        bounds = np.cumsum([0] + [len(c) for c in chunks])
+        for j, i in enumerate(idx):
+            parts[i] = values[bounds[j]:bounds[j + 1]]
+
+    # 2. DELTA_VARINT: decode the concatenated stream, then undo the deltas per payload.
+    # Only valid if every payload ends on a complete varint, otherwise one would bleed into the next.
+    idx = np.flatnonzero(codecs == CODEC_DELTA_VARINT)
+    chunks = [bytes(payloads[i]) for i in idx]
+    if len(idx) and all(not c or c[-1] < 0x80 for c in chunks):
+        stream = b"".join(chunks)
+        try:
+            values, _ = varint_decode(stream)
+        except ValueError:
+            values = None  # Handled one by one below
+        if values is not None and len(values):
+            ends = np.flatnonzero((np.frombuffer(stream, dtype=np.uint8) & 0x80) == 0)
+            byte_owner = np.repeat(np.arange(len(idx)), [len(c) for c in chunks])
+            counts = np.bincount(byte_owner[ends], minlength=len(idx))
+            first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+            # One running sum over the whole stream, rebased at the start of every payload
+            totals = np.cumsum(zigzag_decode(values))
+            base = np.where(first > 0, totals[np.maximum(first - 1, 0)], 0)
+            local = totals - np.repeat(base, counts)
+            for j, i in enumerate(idx):
+                parts[i] = local[first[j]:first[j] + counts[j]]
+
+    # 3. Everything else (and any fallback)
+    for i in range(n):
+        if parts[i] is None:
+            try:
+                parts[i] = decode(int(codecs[i]), payloads[i])
+            except ValueError:
+                parts[i] = decode_raw(payloads[i])
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    if n:
+        np.cumsum([len(p) for p in parts], out=offsets[1:])
+        values = np.concatenate(parts) if offsets[-1] else np.empty(0, dtype=np.int64)
+    else:
+        values = np.empty(0, dtype=np.int64)
+    return values, offsets
+
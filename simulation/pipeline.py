@@ -0,0 +1,62 @@
+import queue
+
+# What put() does when the stage is full
+OVERFLOW_DROP = "drop"  # Drop the new batch and count it (the producer never waits)
+OVERFLOW_DROP_OLDEST = "drop-oldest"  # Make room by dropping the oldest queued batch (freshest data wins)
+OVERFLOW_BLOCK = "block"  # Wait for room: backpressure on the producer
+
+POLL_INTERVAL = 0.1  # Seconds a blocked put()/get() waits before re-checking that the pipeline still runs
+
+
+class Stage:
+    """
+    Bounded queue between two pipeline stages.
+
+    Items are batches, so one queue hop is paid per batch, not per packet.
+    Drops are counted in records: size(item) says how many a batch holds.
+    When the stage is full, `overflow` decides who pays: the new batch, the
+    oldest one, or the producer (by waiting).
+    """
+
+    def __init__(self, name, max_batches=1024, overflow=OVERFLOW_DROP, running=lambda: True, size=len):
+        self.name = name
+        self.overflow = overflow
+        self.size = size
+        self.running = running  # A blocked producer gives up once this returns False
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.dropped = 0  # Records; written by producers only
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def put(self, batch):
+        """Queues a batch. Returns False if it was dropped."""
+        if self.overflow == OVERFLOW_BLOCK:
+            while self.running():
+                try:
+                    self.queue.put(batch, timeout=POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            self.dropped += self.size(batch)
+            return False
+
+        while True:
+            try:
+                self.queue.put_nowait(batch)
+                return True
+            except queue.Full:
+                if self.overflow != OVERFLOW_DROP_OLDEST:
+                    self.dropped += self.size(batch)
+                    return False
+            try:
+                self.dropped += self.size(self.queue.get_nowait())
+            except queue.Empty:
+                pass  # A consumer got there first: there's room now
+
+    def get(self, timeout=POLL_INTERVAL):
+        """Next batch, or None if nothing arrived within timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
@@ -1,28 +1,36 @@
 import matplotlib.pyplot as plt
 import os
+import csv
+from collections import defaultdict
 
 # Ensure results directory exists
 os.makedirs("results", exist_ok=True)
 
 # --- CONFIGURATION ---
-# Enter the results from your main.py console output here
-# (Example values based on your recent 50-reading test)
-labels = ['Standard CoAP', 'Smart Protocol']
+# Written by main.py (one head-to-head run) and sweep.py (one row per grid point)
+HEAD_TO_HEAD_FILE = "results/head_to_head.csv"
+SWEEP_FILE = "results/sweep_results.csv"
+TEXT_FIELDS = ("thresholds", "retries")
 
-# Metric 1: Packets Sent (Lower is better)
-packets = [50, 8]
+labels = ['Standard CoAP', 'Smart Protocol']
 
-# Metric 2: Bytes Transferred (Lower is better)
-bytes_transferred = [1450, 401]
 
-# Metric 3: Energy Consumed (Lower is better)
-energy = [895.0, 160.1]
+def load_results(path):
+    with open(path, newline='') as f:
+        return [{k: v if k in TEXT_FIELDS else float(v) for k, v in row.items()} for row in csv.DictReader(f)]
 
 
 # --- PLOTTING ---
-def create_comparison_chart():
+def create_comparison_chart(row):
     print("Generating Head-to-Head Comparison Graph...")
 
+    # Metric 1: Packets Sent (Lower is better)
+    packets = [int(row["coap_packets"]), int(row["smart_packets"])]
+    # Metric 2: Bytes Transferred (Lower is better)
+    bytes_transferred = [int(row["coap_bytes"]), int(row["smart_bytes"])]
+    # Metric 3: Energy Consumed (Lower is better)
+    energy = [row["coap_energy"], row["smart_energy"]]
+
     fig, axes = plt.subplots(1, 3, figsize=(16, 6))
 
     # Colors: Red = Standard/Expensive, Green = Smart/Efficient
@@ -53,7 +61,8 @@ def create_comparison_chart():
         axes[2].text(i, v + 20, f"{v:.1f} mJ", ha='center', fontweight='bold', fontsize=11)
 
     # Global Title
-    plt.suptitle('Benchmark Results: Standard CoAP vs. Smart Protocol\n(Scenario: 50 Sensor Readings, 20% Packet Loss)',
+    plt.suptitle(f'Benchmark Results: Standard CoAP vs. Smart Protocol\n'
+                 f'(Scenario: {int(row["n_readings"])} Sensor Readings, {row["loss"]:.0%} Packet Loss)',
                  fontsize=16)
 
     plt.tight_layout(rect=[0, 0.03, 1, 0.95])  # Make room for suptitle
@@ -64,5 +73,54 @@ def create_comparison_chart():
     plt.show()
 
 
+def create_sweep_chart(rows):
+    print(f"Generating Sweep Graph ({len(rows)} points)...")
+
+    fig, axes = plt.subplots(1, 2, figsize=(14, 6))
+
+    # Plot 1: Energy gain vs loss, one line per starting battery (mean over the other parameters)
+    gains = defaultdict(list)
+    for row in rows:
+        gains[(row["battery"], row["loss"])].append(row["gain"])
+    for battery in sorted({b for b, _ in gains}):
+        losses = sorted(loss for b, loss in gains if b == battery)
+        axes[0].plot([loss * 100 for loss in losses],
+                     [sum(gains[(battery, loss)]) / len(gains[(battery, loss)]) for loss in losses],
+                     marker='o', label=f"Battery {battery:.0f}%")
+    axes[0].set_title('Energy Savings vs. CoAP', fontsize=12, fontweight='bold')
+    axes[0].set_xlabel('Packet Loss (%)')
+    axes[0].set_ylabel('Gain (%)')
+
+    # Plot 2: Smart Protocol energy per reading vs loss, one line per threshold set
+    energy = defaultdict(list)
+    for row in rows:
+        energy[(row["thresholds"], row["loss"])].append(row["smart_energy"] / row["n_readings"])
+    for thresholds in sorted({t for t, _ in energy}):
+        losses = sorted(loss for t, loss in energy if t == thresholds)
+        axes[1].plot([loss * 100 for loss in losses],
+                     [sum(energy[(thresholds, loss)]) / len(energy[(thresholds, loss)]) for loss in losses],
+                     marker='o', label=f"Thresholds {thresholds}")
+    axes[1].set_title('Smart Protocol Energy per Reading', fontsize=12, fontweight='bold')
+    axes[1].set_xlabel('Packet Loss (%)')
+    axes[1].set_ylabel('Energy (mJ / reading)')
+
+    for ax in axes:
+        ax.grid(linestyle='--', alpha=0.5)
+        ax.legend()
+
+    plt.suptitle('Parameter Sweep: Smart Protocol vs. Standard CoAP', fontsize=16)
+    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
+
+    output_path = "results/sweep_graph.png"
+    plt.savefig(output_path, dpi=300)
+    print(f"Graph saved successfully to: {output_path}")
+    plt.show()
+
+
 if __name__ == "__main__":
-    create_comparison_chart()
\ No newline at end of file
+    if os.path.exists(HEAD_TO_HEAD_FILE):
+        create_comparison_chart(load_results(HEAD_TO_HEAD_FILE)[-1])
+    if os.path.exists(SWEEP_FILE):
+        create_sweep_chart(load_results(SWEEP_FILE))
+    if not (os.path.exists(HEAD_TO_HEAD_FILE) or os.path.exists(SWEEP_FILE)):
+        print(f"No results yet: run main.py (-> {HEAD_TO_HEAD_FILE}) or sweep.py (-> {SWEEP_FILE}) first.")
\ No newline at end of file
@@ -0,0 +1,167 @@
+import time
+from array import array
+from collections import OrderedDict
+from utils import HEADER_STRUCT, HEADER_SIZE, FLAG_ACK, FLAG_DEVICE_ID, FLAG_FRAGMENT, DEVICE_ID_STRUCT, \
+    DEVICE_ID_SIZE, FRAGMENT_STRUCT, MAX_FRAME
+
+# Memory caps: everything is allocated up front, slots * max_frame bytes whatever the traffic
+REASSEMBLY_SLOTS = 64  # Frames being rebuilt at once, all devices together (64 x 16 KB = 1 MB)
+PER_DEVICE = 4  # Frames being rebuilt at once for one device, so a single device can't take every slot
+REASSEMBLY_TIMEOUT = 30.0  # Seconds a partial frame is kept: the sender's retransmissions can fill its gaps
+
+
+class Reassembler:
+    """
+    Rebuilds the frames senders split with Packet.fragment.
+
+    Partial frames are tracked per (device, seq) in fixed slots of one preallocated
+    buffer: a fragment is copied straight to its offset, and the frame is copied out
+    once, when its last byte is in. A retransmitted frame (same seq) fills the gaps
+    of the partial one, so a lost fragment costs one more attempt, not a restart.
+
+    Bounded: frames over max_frame are refused, a device over its share of slots
+    and a full table give up their oldest partial frame, and partial frames expire
+    after `timeout`. Overlapping fragments aren't checked: the AEAD tag rejects
+    whatever they produce.
+
+    A fragment of a frame the session layer already has (`delivered(device, seq)`, e.g.
+    SessionTable.check == SEQ_DUPLICATE) doesn't open a slot: a late duplicate or a
+    retransmission would only sit there until it expires. The first fragment of such a
+    retransmission comes back as the bare header, so the frame is ACKed again.
+    """
+
+    def __init__(self, slots=REASSEMBLY_SLOTS, max_frame=MAX_FRAME, per_device=PER_DEVICE,
+                 timeout=REASSEMBLY_TIMEOUT, delivered=None, clock=time.monotonic):
+        self.max_frame = max_frame
+        self.per_device = per_device
+        self.timeout = timeout
+        self.delivered = delivered  # (device, seq) -> True if that frame was delivered already
+        self.clock = clock
+
+        self.memory = memoryview(bytearray(slots * max_frame))
+        self.index = OrderedDict()  # (device, seq) -> slot, oldest first
+        self.free = list(range(slots))
+        self.prefix = array('l', [0] * slots)  # Header (+ Device ID) bytes at the start of the slot
+        self.total = array('l', [0] * slots)  # Body bytes expected
+        self.received = array('l', [0] * slots)
+        self.started = array('d', [0.0] * slots)
+        self.offsets = [None] * slots  # Offsets of the fragments in, to skip duplicates
+        self.devices = {}  # device -> partial frames
+
+        self.fragments = 0
+        self.completed = 0
+        self.duplicates = 0
+        self.late = 0  # Fragments of frames delivered already
+        self.expired = 0
+        self.evicted = 0
+        self.refused = 0  # Malformed or over max_frame
+
+    def __len__(self):
+        return len(self.index)
+
+    def feed(self, data, addr):
+        """
+        One received datagram. Whole frames come back as they are; a fragment returns None,
+        except the one completing its frame, which returns the whole frame (bytes).
+        """
+        if len(data) < HEADER_SIZE or data[4] & (FLAG_FRAGMENT | FLAG_ACK) != FLAG_FRAGMENT:
+            return data
+        return self.add(data, addr)
+
+    def add(self, data, addr):
+        """Stores one fragment. Returns the rebuilt frame once it is complete, else None."""
+        self.fragments += 1
+        seq, flags, budget = HEADER_STRUCT.unpack_from(data)
+        prefix = HEADER_SIZE + (DEVICE_ID_SIZE if flags & FLAG_DEVICE_ID else 0)
+        chunk_start = prefix + FRAGMENT_STRUCT.size
+        if len(data) <= chunk_start:
+            self.refused += 1
+            return None
+        device = DEVICE_ID_STRUCT.unpack_from(data, HEADER_SIZE)[0] if flags & FLAG_DEVICE_ID else addr
+        offset, total = FRAGMENT_STRUCT.unpack_from(data, prefix)
+        size = len(data) - chunk_start
+        if prefix + total > self.max_frame or offset + size > total:
+            self.refused += 1
+            return None
+
+        now = self.clock()
+        self.expire(now)
+        key = (device, seq)
+        slot = self.index.get(key)
+        if slot is None and self.delivered is not None and self.delivered(device, seq):
+            # Sent again after we delivered it (our ACK was lost): only the header is needed to ACK it
+            self.late += 1
+            if offset:
+                return None
+            return HEADER_STRUCT.pack(seq, flags & ~FLAG_FRAGMENT, budget) + bytes(data[HEADER_SIZE:prefix])
+        if slot is None:
+            slot = self._open(key, device, now)
+            base = slot * self.max_frame
+            # The rebuilt frame starts with the header as the sender built it, before fragmenting
+            HEADER_STRUCT.pack_into(self.memory, base, seq, flags & ~FLAG_FRAGMENT, budget)
+            self.memory[base + HEADER_SIZE:base + prefix] = data[HEADER_SIZE:prefix]
+            self.prefix[slot] = prefix
+            self.total[slot] = total
+        elif total != self.total[slot] or prefix != self.prefix[slot]:
+            self.refused += 1
+            return None
+        elif offset in self.offsets[slot]:
+            self.duplicates += 1  # The frame was sent again: this part is already in
+            return None
+
+        start = slot * self.max_frame + prefix + offset
+        self.memory[start:start + size] = data[chunk_start:]
+        self.offsets[slot].add(offset)
+        self.received[slot] += size
+        if self.received[slot] < total:
+            return None
+
+        base = slot * self.max_frame
+        frame = bytes(self.memory[base:base + prefix + total])
+        self._close(key, slot)
+        self.completed += 1
+        return frame
+
+    def expire(self, now=None):
+        """Drops the partial frames older than the timeout. Returns how many."""
+        now = self.clock() if now is None else now
+        cutoff = now - self.timeout
+        count = 0
+        while self.index:
+            key, slot = next(iter(self.index.items()))
+            if self.started[slot] >= cutoff:
+                break
+            self._close(key, slot)
+            count += 1
+        self.expired += count
+        return count
+
+    def _open(self, key, device, now):
+        if self.devices.get(device, 0) >= self.per_device:
+            # Give up the device's own oldest partial frame (index order is age order)
+            oldest = next(k for k in self.index if k[0] == device)
+            self._close(oldest, self.index[oldest])
+            self.evicted += 1
+        if not self.free:
+            oldest, slot = next(iter(self.index.items()))
+            self._close(oldest, slot)
+            self.evicted += 1
+
+        slot = self.free.pop()
+        self.index[key] = slot
+        self.devices[device] = self.devices.get(device, 0) + 1
+        self.received[slot] = 0
+        self.started[slot] = now
+        self.offsets[slot] = set()
+        return slot
+
+    def _close(self, key, slot):
+        del self.index[key]
+        self.offsets[slot] = None
+        self.free.append(slot)
+        device = key[0]
+        left = self.devices[device] - 1
+        if left:
+            self.devices[device] = left
+        else:
+            del self.devices[device]
@@ -0,0 +1,159 @@
+import time
+from array import array
+
+# Anti-replay window (IPsec-style, RFC 4303 / RFC 6479): the highest sequence number
+# seen plus a bitmap of which of the WINDOW_SIZE numbers below it have arrived.
+WINDOW_SIZE = 64
+WINDOW_MASK = (1 << WINDOW_SIZE) - 1
+
+# Verdicts
+SEQ_NEW = "NEW"  # Ahead of everything seen so far (or first packet of the device)
+SEQ_REORDERED = "REORDERED"  # Late, but inside the window and not seen before
+SEQ_DUPLICATE = "DUPLICATE"  # Inside the window and already seen (retransmission or replay)
+SEQ_REPLAY = "REPLAY"  # Older than the window: can no longer be told apart from a replay
+
+FIRST_SEQ = 0  # Devices number their packets from 0 after boot: a new session this close to it expects it first
+
+
+class SessionTable:
+    """
+    Per-device sequence state, keyed by device identity (Device ID, or the
+    source address for legacy frames).
+
+    State lives in parallel arrays (8 bytes per field per device) instead of
+    one Python object per device, so hundreds of thousands of sessions fit
+    in a few MB. Every classification is O(1).
+
+    The cumulative point (see sack()) starts at FIRST_SEQ for a device fresh
+    from boot, else at the first seq authenticated for the session: persistent
+    v2 counters carry on across runs, and the table forgets sessions (restart,
+    idle eviction). SmartSender sends one packet at a time until its first ACK,
+    so that seq is one the device really sent first. The point moves over seqs
+    that arrived, and past holes once they slide out of the window: those can
+    never be accepted any more, and a sender (whose window spans at most
+    SACK_WIDTH seqs) no longer has them in flight.
+    """
+
+    __slots__ = ("slots", "highest", "cumulative", "bitmap", "last_seen", "free",
+                 "idle_timeout", "max_sessions", "evictions")
+
+    def __init__(self, idle_timeout=3600.0, max_sessions=1_000_000):
+        self.slots = {}  # device key -> index into the arrays
+        self.highest = array('q')
+        self.cumulative = array('q')  # Oldest seq not received: every seq below it arrived (or can't any more)
+        self.bitmap = array('Q')
+        self.last_seen = array('d')
+        self.free = []  # Indexes released by eviction, reused before growing the arrays
+
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def check(self, key, seq):
+        """Classifies seq without changing any state (safe to call before authentication)."""
+        i = self.slots.get(key)
+        if i is None:
+            return SEQ_NEW
+
+        highest = self.highest[i]
+        if seq > highest:
+            return SEQ_NEW
+
+        diff = highest - seq
+        if diff >= WINDOW_SIZE:
+            return SEQ_REPLAY
+        if (self.bitmap[i] >> diff) & 1:
+            return SEQ_DUPLICATE
+        return SEQ_REORDERED
+
+    def update(self, key, seq, now=None):
+        """Marks seq as received. Only call this once the packet has been authenticated."""
+        now = time.monotonic() if now is None else now
+
+        i = self.slots.get(key)
+        if i is None:
+            i = self._allocate(key, now)
+            self.highest[i] = seq
+            self.cumulative[i] = FIRST_SEQ if FIRST_SEQ <= seq < FIRST_SEQ + WINDOW_SIZE else seq
+            self.bitmap[i] = 1
+        else:
+            highest = self.highest[i]
+            if seq > highest:
+                shift = seq - highest
+                self.bitmap[i] = ((self.bitmap[i] << shift) | 1) & WINDOW_MASK if shift < WINDOW_SIZE else 1
+                self.highest[i] = seq
+            elif highest - seq < WINDOW_SIZE:
+                self.bitmap[i] |= 1 << (highest - seq)
+
+        # The cumulative point moves over seqs that really arrived, and past holes the window has
+        # forgotten (they would be refused as replays now)
+        cumulative = self.cumulative[i]
+        highest = self.highest[i]
+        if seq == cumulative or highest - cumulative >= WINDOW_SIZE:
+            cumulative = max(cumulative, highest - WINDOW_SIZE + 1)
+            bitmap = self.bitmap[i]
+            while cumulative <= highest and (bitmap >> (highest - cumulative)) & 1:
+                cumulative += 1
+            self.cumulative[i] = cumulative
+
+        self.last_seen[i] = now
+
+    def sack(self, key, width=32):
+        """
+        Selective ACK state for a device: (cumulative, bitmap).
+        Every seq below cumulative has arrived (or is too old to be accepted); bit j of
+        bitmap means cumulative + 1 + j has arrived too.
+        """
+        i = self.slots.get(key)
+        if i is None:
+            return FIRST_SEQ, 0
+
+        cumulative = self.cumulative[i]
+        highest = self.highest[i]
+        span = highest - cumulative  # Seqs from cumulative + 1 to highest, all inside the window
+        if span <= 0:
+            return cumulative, 0  # Nothing above the hole
+
+        # Window bit (highest - s) becomes SACK bit (s - cumulative - 1): the binary string of
+        # the bits above the hole reads cumulative + 1 first, so reversing it gives the SACK bitmap
+        bits = format(self.bitmap[i] & ((1 << span) - 1), f"0{span}b")[:width]
+        return cumulative, int(bits[::-1], 2)
+
+    def forget(self, key):
+        i = self.slots.pop(key, None)
+        if i is not None:
+            self.free.append(i)
+
+    def evict_idle(self, now=None):
+        """Drops sessions that have been silent for idle_timeout. Returns how many were dropped."""
+        now = time.monotonic() if now is None else now
+        cutoff = now - self.idle_timeout
+        last_seen = self.last_seen
+
+        stale = [key for key, i in self.slots.items() if last_seen[i] < cutoff]
+        for key in stale:
+            self.forget(key)
+        self.evictions += len(stale)
+        return len(stale)
+
+    def _allocate(self, key, now):
+        if len(self.slots) >= self.max_sessions and not self.evict_idle(now):
+            # Table full of active devices: sacrifice the least recently seen one
+            oldest = min(self.slots, key=lambda k: self.last_seen[self.slots[k]])
+            self.forget(oldest)
+            self.evictions += 1
+
+        if self.free:
+            i = self.free.pop()
+        else:
+            i = len(self.highest)
+            self.highest.append(0)
+            self.cumulative.append(0)
+            self.bitmap.append(0)
+            self.last_seen.append(0.0)
+
+        self.slots[key] = i
+        return i
@@ -0,0 +1,53 @@
+# Device-side strategy, shared by SmartSender, the load generator, the simulator and the gateway's
+# aggregation controller (firmware/main.py keeps its own copy: it runs on MicroPython).
+
+# Strategy tiers: (battery above %, aggregation threshold, mode, max retries), checked top to bottom
+STRATEGY_TIERS = (
+    (70, 1, "REAL-TIME", 3),
+    (30, 5, "BALANCED", 1),
+    (float("-inf"), 10, "SURVIVAL", 0),
+)
+
+# Maximum buffering age per mode (seconds): however high the threshold (or the gateway's recommendation),
+# the oldest reading of a packet is delivered before it is this old. Frugal modes may wait longer, never forever.
+MAX_AGE = {"REAL-TIME": 60.0, "BALANCED": 1800.0, "SURVIVAL": 3600.0}
+URGENT_ABOVE = 40  # A reading above this (an alarm) is sent at once, whatever the mode (None = never)
+
+# Why a packet was sent (sender logs)
+TRIGGER_COUNT = "COUNT"  # Threshold reached
+TRIGGER_DEADLINE = "DEADLINE"  # Oldest reading about to exceed MAX_AGE
+TRIGGER_URGENT = "URGENT"  # Reading above URGENT_ABOVE
+TRIGGER_FINAL = "FINAL"  # Leftovers at the end of a run
+
+
+def make_tiers(thresholds, retries, tiers=STRATEGY_TIERS):
+    """Same battery levels and modes, other thresholds/retries (one per tier), e.g. for parameter sweeps."""
+    return tuple((above, threshold, mode, max_retries)
+                 for (above, _, mode, _), threshold, max_retries in zip(tiers, thresholds, retries))
+
+
+def select_strategy(battery_level, etx=1.0, tiers=STRATEGY_TIERS):
+    """
+    Energy-aware strategy: (aggregation threshold, mode, max retries).
+    A lossy link multiplies the cost of every packet (expected transmissions = 1 / (1 - loss)),
+    so it pushes the device towards the frugal modes as if the battery were lower.
+    """
+    bat = battery_level / etx
+    for above, threshold, mode, max_retries in tiers:
+        if bat > above:
+            return threshold, mode, max_retries
+    return tiers[-1][1:]
+
+
+def flush_trigger(count, threshold, oldest_age, max_age, interval=0.0, margin=0.0):
+    """
+    Whether a buffer of `count` readings goes out now: TRIGGER_COUNT, TRIGGER_DEADLINE or None.
+    The device wakes up for every reading anyway, so the cheapest moment to meet the deadline is
+    the last of those wake-ups that still makes it: flush now if the next reading (`interval` away)
+    plus delivery (`margin`, about one RTT) would take the oldest reading past max_age.
+    """
+    if count >= threshold:
+        return TRIGGER_COUNT
+    if count and max_age is not None and oldest_age + interval + margin >= max_age:
+        return TRIGGER_DEADLINE
+    return None
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import itertools
+import threading
+import multiprocessing
+from strategy import make_tiers
+from Receiver import EnergyProtocolReceiver
+import coap_competitor
+from main import run_my_protocol_experiment, result_row, save_results, READING_PACE
+
+SWEEP_FILE = "results/sweep_results.csv"
+SWEEP_DIR = "results/sweep"  # One working directory per worker process
+
+# Every worker gets its own pair of ports (Smart receiver, CoAP server), so runs never collide
+PORT_BASE = 6000
+# ...and its own Device ID: workers run at the same time, and a v2 device must never send a seq twice
+DEVICE_BASE = 1000
+
+# --- DEFAULT GRID (5 x 4 x 3 x 3 x 2 = 360 points) ---
+LOSSES = [0.0, 0.1, 0.2, 0.3, 0.4]
+THRESHOLDS = [(1, 5, 10), (2, 5, 10), (1, 10, 20), (5, 10, 20)]  # REAL-TIME / BALANCED / SURVIVAL
+RETRIES = [(3, 1, 0), (1, 1, 0), (3, 3, 1)]
+BATTERIES = [20.0, 50.0, 90.0]
+READINGS = [50, 100]
+
+_slot = None  # Worker number, set by init_worker
+
+
+def init_worker(counter, sweep_dir):
+    """Gives the worker a slot number, then moves it into its own results directory and log file."""
+    global _slot
+    with counter.get_lock():
+        _slot = counter.value
+        counter.value += 1
+
+    workdir = os.path.abspath(os.path.join(sweep_dir, f"w{_slot}"))
+    os.makedirs(os.path.join(workdir, "results"), exist_ok=True)
+    os.chdir(workdir)  # SmartSender writes results/smart_sender_log.csv relative to here
+    sys.stdout = open("worker.log", "a", buffering=1)  # Per-packet prints would flood the console
+
+
+def worker_ports():
+    return PORT_BASE + 2 * _slot, PORT_BASE + 2 * _slot + 1
+
+
+def run_smart_point(point):
+    """One Smart Protocol run: (n_readings, battery, loss, thresholds, retries) -> (point, traffic)."""
+    n_readings, battery, loss, thresholds, retries, pace = point
+    smart_port, _ = worker_ports()
+
+    receiver = EnergyProtocolReceiver(port=smart_port)
+    threading.Thread(target=receiver.start, daemon=True).start()
+    try:
+        traffic = run_my_protocol_experiment(n_readings, battery, smart_port, make_tiers(thresholds, retries),
+                                             loss, pace, device_id=DEVICE_BASE + _slot)
+    finally:
+        receiver.stop()
+    return point, traffic
+
+
+def run_coap_point(point):
+    """CoAP baseline: depends only on the number of readings, so it runs once per value."""
+    n_readings, pace = point
+    _, coap_port = worker_ports()
+    traffic = asyncio.run(coap_competitor.run_coap_standard_device(n_readings, coap_port, pace))
+    return point, traffic
+
+
+def run_task(task):
+    kind, point = task
+    return kind, (run_smart_point if kind == "smart" else run_coap_point)(point)
+
+
+def build_grid(losses, thresholds, retries, batteries, readings):
+    return [(n, battery, loss, tuple(th), tuple(rt))
+            for loss, th, rt, battery, n in itertools.product(losses, thresholds, retries, batteries, readings)]
+
+
+def run_sweep(grid, workers=None, pace=READING_PACE, sweep_dir=SWEEP_DIR, out_file=SWEEP_FILE):
+    workers = workers or os.cpu_count() or 1
+    tasks = [("coap", (n, pace)) for n in sorted({point[0] for point in grid})]
+    tasks += [("smart", point + (pace,)) for point in grid]
+
+    print(f"[Sweep] {len(grid)} points ({len(tasks)} runs) on {workers} workers. Worker logs: {sweep_dir}/w<N>/")
+    started = time.time()
+    smart, coap = {}, {}
+
+    counter = multiprocessing.Value('i', 0)
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(counter, sweep_dir)) as pool:
+        for done, (kind, (point, traffic)) in enumerate(pool.imap_unordered(run_task, tasks), 1):
+            (smart if kind == "smart" else coap)[point[:-1]] = traffic
+            if done % 10 == 0 or done == len(tasks):
+                print(f"[Sweep] {done}/{len(tasks)} runs done ({time.time() - started:.0f}s)")
+
+    rows = []
+    for point in grid:
+        n_readings, battery, loss, thresholds, retries = point
+        rows.append(result_row(n_readings, battery, loss, make_tiers(thresholds, retries),
+                               smart[point], coap[(n_readings,)]))
+    save_results(rows, out_file)
+    print(f"[Sweep] Done in {time.time() - started:.0f}s. Results: {out_file} (python plot_results.py)")
+    return rows
+
+
+def parse_list(text, cast=float):
+    return [cast(x) for x in text.split(",")]
+
+
+def parse_tiers(text):
+    # "1/5/10,2/5/10" -> [(1, 5, 10), (2, 5, 10)]
+    return [tuple(int(x) for x in group.split("/")) for group in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel parameter sweep of the head-to-head benchmark")
+    parser.add_argument("--loss", type=parse_list, default=LOSSES, help="e.g. 0,0.1,0.2")
+    parser.add_argument("--thresholds", type=parse_tiers, default=THRESHOLDS,
+                        help="Aggregation thresholds per mode (REAL-TIME/BALANCED/SURVIVAL), e.g. 1/5/10,2/5/10")
+    parser.add_argument("--retries", type=parse_tiers, default=RETRIES, help="Retry budgets per mode, e.g. 3/1/0")
+    parser.add_argument("--battery", type=parse_list, default=BATTERIES, help="Starting battery %%, e.g. 20,50,90")
+    parser.add_argument("--readings", type=lambda t: parse_list(t, int), default=READINGS, help="e.g. 50,100")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes (0 = one per core)")
+    parser.add_argument("--pace", type=float, default=READING_PACE, help="Seconds between readings")
+    args = parser.parse_args()
+
+    run_sweep(build_grid(args.loss, args.thresholds, args.retries, args.battery, args.readings),
+              args.workers or None, args.pace)
@@ -0,0 +1,166 @@
+import time
+import asyncio
+
+RADIO_TAIL = 0.01  # Seconds the radio stays up after its last datagram; a send after that is a new wake-up
+
+TRAFFIC_FIELDS = ("tx_datagrams", "tx_bytes", "rx_datagrams", "rx_bytes", "retransmits", "lost", "wakeups")
+
+
+class DeviceTraffic:
+    """What one device's radio did."""
+    __slots__ = TRAFFIC_FIELDS + ("last_active",)
+
+    def __init__(self):
+        for name in TRAFFIC_FIELDS:
+            setattr(self, name, 0)
+        self.last_active = float("-inf")
+
+
+class TrafficMeter:
+    """
+    Datagrams and bytes each device actually sent and received, as seen at the socket,
+    so the energy model works on measured traffic instead of a formula: retransmissions,
+    ACKs/responses and lost datagrams (the radio sent them all the same) included.
+
+    A wake-up is a send after the radio has been quiet for more than `tail` seconds:
+    a flush and its fragments, or a request and its response, are one wake-up; a
+    retransmission after a timeout is another one.
+    """
+
+    def __init__(self, tail=RADIO_TAIL, clock=time.monotonic):
+        self.tail = tail
+        self.clock = clock
+        self.devices = {}  # device -> DeviceTraffic
+
+    def device(self, device):
+        traffic = self.devices.get(device)
+        if traffic is None:
+            traffic = self.devices[device] = DeviceTraffic()
+        return traffic
+
+    def sent(self, device, nbytes, lost=False):
+        traffic = self.device(device)
+        now = self.clock()
+        if now - traffic.last_active > self.tail:
+            traffic.wakeups += 1
+        traffic.last_active = now
+        traffic.tx_datagrams += 1
+        traffic.tx_bytes += nbytes
+        if lost:
+            traffic.lost += 1
+
+    def received(self, device, nbytes):
+        traffic = self.device(device)
+        traffic.last_active = self.clock()
+        traffic.rx_datagrams += 1
+        traffic.rx_bytes += nbytes
+
+    def retransmitted(self, device):
+        self.device(device).retransmits += 1
+
+    def totals(self):
+        """Sums over every device: {field: value}, plus "bytes" (both directions) and "devices"."""
+        totals = {name: sum(getattr(t, name) for t in self.devices.values()) for name in TRAFFIC_FIELDS}
+        totals["bytes"] = totals["tx_bytes"] + totals["rx_bytes"]
+        totals["devices"] = len(self.devices)
+        return totals
+
+
+class MeteredSocket:
+    """A UDP socket that reports every datagram to a TrafficMeter. Everything else goes to the socket."""
+
+    def __init__(self, sock, meter, device):
+        self.sock = sock
+        self.meter = meter
+        self.device = device
+
+    def sendto(self, data, addr):
+        self.meter.sent(self.device, len(data))
+        return self.sock.sendto(data, addr)
+
+    def drop(self, data):
+        """A datagram the (simulated) link loses: transmitted, paid for, never delivered."""
+        self.meter.sent(self.device, len(data), lost=True)
+
+    def recvfrom(self, bufsize, flags=0):
+        data, addr = self.sock.recvfrom(bufsize, flags)
+        self.meter.received(self.device, len(data))
+        return data, addr
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class MeteredRelay(asyncio.DatagramProtocol):
+    """
+    UDP relay in front of a server, for clients whose sockets we don't own (aiocoap):
+    they talk to the relay, the relay to the server, and every datagram is counted
+    per client address. retransmit_key(data) -> a key equal for a message and its
+    retransmissions (None = not a retransmittable message).
+    """
+
+    def __init__(self, target, meter, retransmit_key=None):
+        self.target = target
+        self.meter = meter
+        self.retransmit_key = retransmit_key
+        self.transport = None
+        self.upstreams = {}  # client addr -> transport to the server (or a list of datagrams while it opens)
+        self.seen = {}  # client addr -> retransmit keys already sent
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.meter.sent(addr, len(data))
+        if self.retransmit_key is not None:
+            key = self.retransmit_key(data)
+            seen = self.seen.setdefault(addr, set())
+            if key is not None:
+                if key in seen:
+                    self.meter.retransmitted(addr)
+                seen.add(key)
+
+        upstream = self.upstreams.get(addr)
+        if upstream is None:
+            self.upstreams[addr] = [data]
+            asyncio.ensure_future(self._open(addr))
+        elif isinstance(upstream, list):
+            upstream.append(data)
+        else:
+            upstream.sendto(data)
+
+    async def _open(self, addr):
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _Upstream(self, addr), remote_addr=self.target)
+        for data in self.upstreams[addr]:
+            transport.sendto(data)
+        self.upstreams[addr] = transport
+
+    def downstream(self, data, addr):
+        self.meter.received(addr, len(data))
+        self.transport.sendto(data, addr)
+
+    def close(self):
+        for upstream in self.upstreams.values():
+            if not isinstance(upstream, list):
+                upstream.close()
+        if self.transport:
+            self.transport.close()
+
+
+class _Upstream(asyncio.DatagramProtocol):
+    """The relay's socket towards the server for one client: replies go back to that client."""
+
+    def __init__(self, relay, client):
+        self.relay = relay
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.relay.downstream(data, self.client)
+
+
+async def start_relay(target, meter, retransmit_key=None, host="127.0.0.1", port=0):
+    """Starts a MeteredRelay to target on (host, port); port 0 = any free one. Returns (relay, port)."""
+    _, relay = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: MeteredRelay(target, meter, retransmit_key), local_addr=(host, port))
+    return relay, relay.transport.get_extra_info("sockname")[1]
@@ -1,6 +1,9 @@
 import struct
 import random
+import socket
 import os
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 # Configuration
@@ -10,26 +13,71 @@ LISTEN_PORT = 5005
 # Protocol Constants
 # Header: Seq (4 bytes) + Flags (1 byte) + Budget (1 byte) = 6 Bytes
 HEADER_FORMAT = "!IBB"
-HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER_STRUCT = struct.Struct(HEADER_FORMAT)  # Precompiled: no format parsing per packet
+HEADER_SIZE = HEADER_STRUCT.size
 FLAG_AGGREGATED = 0x01
 FLAG_ACK = 0x02
+FLAG_DEVICE_ID = 0x04  # Payload starts with a 4-byte Device ID (selects the per-device key)
+
+FLAG_SACK = 0x08  # ACK carries a selective ACK: Cumulative (4B) + Bitmap (4B)
+FLAG_V2 = 0x80  # Protocol v2 frame: nonce not sent (derived from Device ID + seq), header authenticated
+
+# Fragmentation (uplink only, same bit as FLAG_DOWNLINK on ACKs): a frame bigger than MTU is sent as
+# fragments, each with the frame's header (+ Device ID) and Offset (2B) + Total (2B) of the rest of the
+# frame. The gateway rebuilds the frame (see reassembly.py) and handles it like any other, ACK included.
+FLAG_FRAGMENT = 0x40
+FRAGMENT_STRUCT = struct.Struct("!HH")
+MTU = 1024  # Largest datagram a sender puts on the air (the gateway's receive buffer)
+MAX_FRAME = 16384  # Largest frame a gateway reassembles
+ZERO_COPY_MIN = 4096  # Packet.unpack_from copies payloads below this; bigger ones get a memoryview
+
+DEVICE_ID_STRUCT = struct.Struct("!I")
+DEVICE_ID_SIZE = DEVICE_ID_STRUCT.size
+
+# Selective ACK: every seq < Cumulative arrived; bit j of Bitmap = seq Cumulative + 1 + j arrived.
+# The ACK header still carries the seq that triggered it, so stop-and-wait senders keep working.
+SACK_STRUCT = struct.Struct("!II")
+SACK_WIDTH = 32
+
+# Downlink piggybacked on an ACK (after the SACK, if any): one or more Type (1B) + Value (2B) items.
+# Devices that don't know a type skip it, so new settings don't break old firmware.
+FLAG_DOWNLINK = 0x40
+DOWNLINK_ITEM_STRUCT = struct.Struct("!BH")
+DL_THRESHOLD = 1  # Recommended aggregation threshold (readings per packet, 0 = back to the device's own)
+DL_CONFIG_REV = 2  # Current configuration revision: a device behind it should fetch its config
+DL_RETRIES = 3  # Recommended retry budget per packet (DL_UNSET = back to the device's own)
+DL_UNSET = 0xFFFF
 
 # --- SECURITY MODULE ---
 # In a real device, this key is burned into the chip.
 # We use a hardcoded 32-byte key (AES-256) for this PoC.
+# Devices that don't send a Device ID all share it; the others get their own key (see keystore.py).
 MASTER_KEY = b'\x01\x02\x03\x04\x05\x06\x07\x08' * 4
+NONCE_SIZE = 12
+TAG_SIZE = 16  # Full AES-GCM auth tag
+MIN_TAG_SIZE = 8  # Shortest truncated tag we accept (v2 only, see TruncatedGCM)
+
+# Protocol v2: the 12-byte nonce is Device ID (4B) + Seq (4B) + 4 zero bytes, rebuilt by the receiver.
+# A nonce must never repeat under a key: v2 needs the per-device key (FLAG_DEVICE_ID), and a device
+# must not reuse a seq, across reboots too (keystore.SeqStore), nor wrap it (re-key instead).
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+NONCE_V2_STRUCT = struct.Struct("!II4x")
+
+# Built once: creating an AESGCM context runs the key schedule, too expensive to repeat per packet
+_MASTER_AEAD = AESGCM(MASTER_KEY)
 
 
-def encrypt_payload(plaintext_bytes):
+def encrypt_payload(plaintext_bytes, aesgcm=None):
     """
-    Encrypts data using AES-GCM.
+    Encrypts data using AES-GCM (with the shared MASTER_KEY unless a per-device context is given).
     Returns: [Nonce (12B)] + [Ciphertext + AuthTag]
     """
     # 1. Generate unique Nonce (Number used once)
-    nonce = os.urandom(12)
+    nonce = os.urandom(NONCE_SIZE)
 
     # 2. Encrypt
-    aesgcm = AESGCM(MASTER_KEY)
+    aesgcm = aesgcm or _MASTER_AEAD
     # associated_data=None means only authenticate the payload, not the header (for simplicity)
     ciphertext = aesgcm.encrypt(nonce, plaintext_bytes, associated_data=None)
 
@@ -37,19 +85,21 @@ def encrypt_payload(plaintext_bytes):
     return nonce + ciphertext
 
 
-def decrypt_payload(encrypted_data):
+def decrypt_payload(encrypted_data, aesgcm=None):
     """
     Decrypts data. Returns None if tampering is detected.
+    Accepts any bytes-like object; a memoryview is split without copying.
     """
-    if len(encrypted_data) < 12:
+    if len(encrypted_data) < NONCE_SIZE:
         return None  # Too short to contain nonce
 
-    # 1. Extract Nonce
-    nonce = encrypted_data[:12]
-    ciphertext = encrypted_data[12:]
+    # 1. Extract Nonce (views into the receive buffer, no copies)
+    view = memoryview(encrypted_data)
+    nonce = view[:NONCE_SIZE]
+    ciphertext = view[NONCE_SIZE:]
 
     # 2. Decrypt & Verify
-    aesgcm = AESGCM(MASTER_KEY)
+    aesgcm = aesgcm or _MASTER_AEAD
     try:
         plaintext = aesgcm.decrypt(nonce, ciphertext, associated_data=None)
         return plaintext
@@ -58,6 +108,60 @@ def decrypt_payload(encrypted_data):
         return None
 
 
+def encrypt_payload_v2(plaintext_bytes, aead, device_id, seq, header):
+    """
+    v2: the nonce comes from the Device ID and the seq, the 6-byte header is the AAD.
+    aead is the device's context (AESGCM, or TruncatedGCM for a short tag).
+    Returns: [Ciphertext + AuthTag]
+    """
+    return aead.encrypt(NONCE_V2_STRUCT.pack(device_id, seq), plaintext_bytes, header)
+
+
+def decrypt_payload_v2(encrypted_data, aead, device_id, seq, header):
+    """Reverse of encrypt_payload_v2. Returns None if the payload or the header was tampered with."""
+    try:
+        return aead.decrypt(NONCE_V2_STRUCT.pack(device_id, seq), encrypted_data, header)
+    except Exception:
+        return None
+
+
+def crypto_overhead(version=PROTOCOL_V1, tag_size=TAG_SIZE):
+    """Bytes the encryption adds to a frame: Nonce + AuthTag in v1, only the (maybe truncated) tag in v2."""
+    return NONCE_SIZE + TAG_SIZE if version == PROTOCOL_V1 else tag_size
+
+
+class TruncatedGCM:
+    """
+    AES-GCM with the tag cut to tag_size bytes, same encrypt/decrypt calls as AESGCM.
+    Each byte cut halves the work of a forgery, so keep it for links where bytes are
+    really scarce (NIST SP 800-38D: the tag length is fixed per key, never below 8 here).
+    Slower than AESGCM (a Cipher object per packet), but still microseconds.
+    """
+
+    def __init__(self, key, tag_size):
+        if not MIN_TAG_SIZE <= tag_size <= TAG_SIZE:
+            raise ValueError(f"Tag size must be {MIN_TAG_SIZE}-{TAG_SIZE} bytes, got {tag_size}")
+        self.algorithm = algorithms.AES(key)
+        self.tag_size = tag_size
+
+    def encrypt(self, nonce, data, associated_data):
+        encryptor = Cipher(self.algorithm, modes.GCM(nonce)).encryptor()
+        if associated_data:
+            encryptor.authenticate_additional_data(associated_data)
+        ciphertext = encryptor.update(data) + encryptor.finalize()
+        return ciphertext + encryptor.tag[:self.tag_size]
+
+    def decrypt(self, nonce, data, associated_data):
+        if len(data) < self.tag_size:
+            raise InvalidTag()
+        view = memoryview(data)
+        tag = bytes(view[len(view) - self.tag_size:])
+        decryptor = Cipher(self.algorithm, modes.GCM(nonce, tag, min_tag_length=self.tag_size)).decryptor()
+        if associated_data:
+            decryptor.authenticate_additional_data(associated_data)
+        return decryptor.update(view[:len(view) - self.tag_size]) + decryptor.finalize()
+
+
 class Packet:
     @staticmethod
     def pack(seq, flags, budget, payload):
@@ -65,20 +169,151 @@ class Packet:
         if isinstance(payload, str):
             payload = payload.encode('utf-8')
 
-        header = struct.pack(HEADER_FORMAT, seq, flags, budget)
+        header = HEADER_STRUCT.pack(seq, flags, budget)
         return header + payload
 
+    @staticmethod
+    def pack_v2(seq, flags, budget, device_id, plaintext, aead):
+        """
+        Protocol v2 frame: Header + Device ID + [Ciphertext + AuthTag].
+        No nonce on the wire, and the header is authenticated along with the payload.
+        """
+        header = HEADER_STRUCT.pack(seq, flags | FLAG_V2 | FLAG_DEVICE_ID, budget)
+        return header + DEVICE_ID_STRUCT.pack(device_id) + encrypt_payload_v2(plaintext, aead, device_id, seq, header)
+
+    @staticmethod
+    def fragment(frame, mtu=MTU):
+        """The datagrams for a frame: [frame] if it fits in mtu, else its fragments (each at most mtu bytes)."""
+        if len(frame) <= mtu:
+            return [frame]
+        if len(frame) > MAX_FRAME:
+            raise ValueError(f"Frame of {len(frame)} bytes is over MAX_FRAME ({MAX_FRAME}): send a smaller batch")
+        seq, flags, budget = HEADER_STRUCT.unpack_from(frame)
+        prefix_size = HEADER_SIZE + (DEVICE_ID_SIZE if flags & FLAG_DEVICE_ID else 0)
+        prefix = HEADER_STRUCT.pack(seq, flags | FLAG_FRAGMENT, budget) + frame[HEADER_SIZE:prefix_size]
+        body = frame[prefix_size:]
+        chunk = mtu - prefix_size - FRAGMENT_STRUCT.size
+        return [prefix + FRAGMENT_STRUCT.pack(offset, len(body)) + body[offset:offset + chunk]
+                for offset in range(0, len(body), chunk)]
+
     @staticmethod
     def unpack(data):
-        if len(data) < HEADER_SIZE:
+        return Packet.unpack_from(data, len(data))
+
+    @staticmethod
+    def unpack_from(buffer, nbytes):
+        """
+        Parse of the first nbytes of buffer.
+        A memoryview buffer (a pooled receive buffer) gives a memoryview payload: it is only valid
+        until the buffer is reused, so copy it (bytes(payload)) if it must outlive the packet.
+        Small bytes frames are just sliced, which is cheaper than building a view (see microbench unpack).
+        """
+        if nbytes < HEADER_SIZE:
             return None, None, None, None
 
-        header = data[:HEADER_SIZE]
-        payload_bytes = data[HEADER_SIZE:]
+        seq, flags, budget = HEADER_STRUCT.unpack_from(buffer)
+        if nbytes < ZERO_COPY_MIN or isinstance(buffer, memoryview):
+            return seq, flags, budget, buffer[HEADER_SIZE:nbytes]
+        return seq, flags, budget, memoryview(buffer)[HEADER_SIZE:nbytes]
+
+    @staticmethod
+    def pack_ack(seq, budget, sack=None, downlink=None):
+        """
+        ACK for seq. sack is (cumulative, bitmap) from SessionTable.sack(), or None for a plain ACK.
+        downlink is an optional {DL_* type: value} dict for the device.
+        """
+        flags = FLAG_ACK
+        body = b""
+        if sack is not None:
+            flags |= FLAG_SACK
+            body = SACK_STRUCT.pack(*sack)
+        if downlink:
+            flags |= FLAG_DOWNLINK
+            body += b"".join(DOWNLINK_ITEM_STRUCT.pack(t, v) for t, v in downlink.items())
+        return HEADER_STRUCT.pack(seq, flags, budget) + body
+
+    @staticmethod
+    def downlink(flags, payload):
+        """The {DL_* type: value} items piggybacked on an ACK ({} if there are none)."""
+        if not flags & FLAG_DOWNLINK:
+            return {}
+        offset = SACK_STRUCT.size if flags & FLAG_SACK else 0
+        items = {}
+        for i in range(offset, len(payload) - DOWNLINK_ITEM_STRUCT.size + 1, DOWNLINK_ITEM_STRUCT.size):
+            t, v = DOWNLINK_ITEM_STRUCT.unpack_from(payload, i)
+            items[t] = v
+        return items
+
+    @staticmethod
+    def acked_seqs(seq, flags, payload, candidates):
+        """Which of the candidate (in-flight) seqs this ACK acknowledges."""
+        if not flags & FLAG_SACK or len(payload) < SACK_STRUCT.size:
+            return [seq] if seq in candidates else []
+
+        cumulative, bitmap = SACK_STRUCT.unpack_from(payload)
+        acked = []
+        for s in candidates:
+            if s == seq or s < cumulative:
+                acked.append(s)
+            elif 0 <= s - cumulative - 1 < SACK_WIDTH and (bitmap >> (s - cumulative - 1)) & 1:
+                acked.append(s)
+        return acked
+
+    @staticmethod
+    def split_device_id(flags, payload):
+        """
+        Returns (device_id, rest). device_id is None for frames without FLAG_DEVICE_ID
+        (or too short to carry one), in which case rest is the payload unchanged.
+        """
+        if not flags & FLAG_DEVICE_ID or len(payload) < DEVICE_ID_SIZE:
+            return None, payload
+        device_id, = DEVICE_ID_STRUCT.unpack_from(payload)
+        return device_id, payload[DEVICE_ID_SIZE:]
+
+
+RECV_TRUNC = getattr(socket, "MSG_TRUNC", 0)  # recvfrom_into reports the size of a datagram it had to cut
+
+
+class BufferPool:
+    """
+    Preallocated receive buffers. The socket writes straight into a reused
+    bytearray (recvfrom_into) instead of allocating a new bytes per datagram.
+    """
+
+    def __init__(self, count=4, size=2048):
+        self.size = size
+        self.free = [bytearray(size) for _ in range(count)]
+
+    def acquire(self):
+        # Pool exhausted (e.g. buffers held by a slow consumer): grow instead of blocking
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def release(self, buf):
+        self.free.append(buf)
+
+    def recv_into(self, sock, flags=0):
+        """
+        Receives one datagram into a pooled buffer.
+        Returns (buffer, nbytes, addr); hand the buffer back with release() when done.
+        nbytes is the datagram's real size: more than the buffer means it was truncated (Linux, MSG_TRUNC).
+        """
+        buf = self.acquire()
+        try:
+            nbytes, addr = sock.recvfrom_into(buf, 0, RECV_TRUNC | flags)
+        except BaseException:
+            self.release(buf)
+            raise
+        return buf, nbytes, addr
+
 
-        seq, flags, budget = struct.unpack(HEADER_FORMAT, header)
-        return seq, flags, budget, payload_bytes
+def fragmented_size(frame_size, prefix_size, mtu=MTU):
+    """Bytes on the air for a frame of frame_size: each extra fragment repeats the prefix (+ Offset/Total)."""
+    if frame_size <= mtu:
+        return frame_size
+    body = frame_size - prefix_size
+    fragments = -(-body // (mtu - prefix_size - FRAGMENT_STRUCT.size))
+    return frame_size + fragments * FRAGMENT_STRUCT.size + (fragments - 1) * prefix_size
 
 
-def simulate_network_loss(probability=0.2):
-    return random.random() < probability
\ No newline at end of file
+def simulate_network_loss(probability=0.2, rng=random):
+    return rng.random() < probability
\ No newline at end of file
@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+
+from ack_scheduler import AckScheduler  # noqa: E402
+from sessions import SessionTable  # noqa: E402
+from utils import Packet  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def receive(table, acks, clock, seqs, gap=0.001):
+    """Accepts seqs back to back, as GatewayIngest does. Returns the ACK datagrams sent right away."""
+    sent = []
+    for seq in seqs:
+        clock.now += gap
+        table.update("dev", seq, clock.now)
+        sent += acks.ack("dev", seq, ("10.0.0.1", 5000))
+    return sent
+
+
+def acked(ack, in_flight):
+    seq, flags, _, payload = Packet.unpack(ack)
+    return Packet.acked_seqs(seq, flags, payload, in_flight)
+
+
+def test_packets_in_one_delay_window_share_one_ack():
+    # Persistent seqs: the session starts far from 0
+    table, clock = SessionTable(), Clock()
+    acks = AckScheduler(table.sack, delay=0.05, every=16, clock=clock)
+    assert len(receive(table, acks, clock, [1024])) == 1  # First packet of a wake-up: ACKed at once
+
+    burst = list(range(1025, 1033))
+    assert receive(table, acks, clock, burst) == []
+    clock.now += 0.05
+    due = acks.due()
+    assert len(due) == 1
+    assert acked(due[0][0], burst) == burst
+
+
+def test_held_ack_goes_out_when_every_is_reached():
+    table, clock = SessionTable(), Clock()
+    acks = AckScheduler(table.sack, delay=0.05, every=4, clock=clock)
+    receive(table, acks, clock, [2048])
+    sent = receive(table, acks, clock, [2049, 2050, 2051, 2052])
+    assert len(sent) == 1
+    assert acked(sent[0][0], [2049, 2050, 2051, 2052]) == [2049, 2050, 2051, 2052]
+    assert len(acks) == 0
@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+
+from keystore import SeqStore  # noqa: E402
+
+
+def test_leases_are_consecutive_and_per_device(tmp_path):
+    store = SeqStore(str(tmp_path / "seq.json"), lease=100)
+    assert store.lease(1) == (0, 100)
+    assert store.lease(1) == (100, 200)
+    assert store.lease(2) == (0, 100)
+    assert store.lease(2, count=5, start=1024) == (1024, 1029)
+
+
+def test_restart_continues_after_the_saved_lease(tmp_path):
+    path = str(tmp_path / "seq.json")
+    store = SeqStore(path, lease=100)
+    store.lease(1)
+    store.save()
+    store.lease(1)  # Never saved: as if the process crashed before using it
+
+    restarted = SeqStore(path, lease=100)
+    first, _ = restarted.lease(1)
+    assert first == 100  # Whatever was used of the saved lease is never handed out again
+
+
+def test_save_is_atomic_and_leaves_no_lock(tmp_path):
+    path = tmp_path / "state" / "seq.json"
+    store = SeqStore(str(path), lease=10)
+    store.lease(7)
+    store.save()
+    assert json.loads(path.read_text()) == {"7": 10}
+    assert sorted(os.listdir(path.parent)) == ["seq.json"]
+
+
+def test_used_up_seq_space_raises(tmp_path):
+    store = SeqStore(str(tmp_path / "seq.json"), lease=100, limit=250)
+    assert store.lease(1) == (0, 100)
+    assert store.lease(1) == (100, 200)
+    assert store.lease(1) == (200, 250)  # The last lease is cut at the limit
+    with pytest.raises(OverflowError):
+        store.lease(1)
+    store.save()
+    with pytest.raises(OverflowError):
+        SeqStore(str(tmp_path / "seq.json"), lease=100, limit=250).lease(1)
+
+
+def test_processes_sharing_a_file_keep_each_others_leases(tmp_path):
+    path = str(tmp_path / "seq.json")
+    a, b = SeqStore(path, lease=100), SeqStore(path, lease=100)
+    a.lease(1)
+    a.save()
+    b.lease(2)
+    b.lease(2)
+    b.save()  # Loaded before a saved: must not roll device 1 back
+    a.lease(1)
+    a.save()
+
+    reloaded = SeqStore(path, lease=100)
+    assert reloaded.reserved == {1: 200, 2: 200}
@@ -0,0 +1,96 @@
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+
+from payload_codecs import CODEC_RAW, CODEC_DELTA_VARINT, CODEC_BITPACK, CODEC_FLOAT_XOR, INTEGER_CODECS, \
+    encode, decode, encode_smallest, decode_batch  # noqa: E402
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+INTEGER_CASES = [
+    [],
+    [42],
+    [20, 21, 25, 30, 22, 20],
+    [7] * 50,
+    [-5, 0, 5, -1000, 1000],
+    [0, 2 ** 40, -2 ** 40],
+    [INT64_MIN, INT64_MIN + 1],
+    [INT64_MAX - 1, INT64_MAX],
+    [INT64_MIN, 0],
+    [-1, INT64_MAX],  # Span 2**63: one past what BITPACK carries
+    [INT64_MIN, INT64_MAX],
+]
+
+
+def round_trip(codec, values):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")  # An overflow warning is a wrong answer in disguise
+        return decode(codec, encode(codec, values)).tolist()
+
+
+@pytest.mark.parametrize("values", INTEGER_CASES)
+def test_delta_varint_round_trip(values):
+    assert round_trip(CODEC_DELTA_VARINT, values) == values
+
+
+@pytest.mark.parametrize("values", INTEGER_CASES)
+def test_bitpack_round_trip_or_refuse(values):
+    if values and max(values) - min(values) >= 2 ** 63:
+        with pytest.raises(ValueError):
+            encode(CODEC_BITPACK, values)
+    else:
+        assert round_trip(CODEC_BITPACK, values) == values
+
+
+def test_raw_round_trip_and_range():
+    assert round_trip(CODEC_RAW, [0, 1, 255]) == [0, 1, 255]
+    for values in ([256], [-1]):
+        with pytest.raises(ValueError):
+            encode(CODEC_RAW, values)
+
+
+@pytest.mark.parametrize("values", INTEGER_CASES)
+def test_smallest_round_trip(values):
+    codec, data = encode_smallest(values)
+    assert decode(codec, data).tolist() == values
+
+
+def test_smallest_falls_back_when_bitpack_refuses():
+    values = [INT64_MIN, INT64_MAX]
+    codec, data = encode_smallest(values)
+    assert codec == CODEC_DELTA_VARINT
+    assert decode(codec, data).tolist() == values
+
+
+def test_smallest_is_no_bigger_than_any_codec():
+    values = [20, 21, 25, 30, 22, 20, 24, 26]
+    _, data = encode_smallest(values)
+    assert len(data) == min(len(encode(codec, values)) for codec in INTEGER_CODECS)
+
+
+def test_float_xor_round_trip():
+    values = [21.5, 21.5, 21.625, -0.0, 0.0, 1e308, -1e-308, float("inf"), -float("inf")]
+    assert round_trip(CODEC_FLOAT_XOR, values) == values
+    out = decode(CODEC_FLOAT_XOR, encode(CODEC_FLOAT_XOR, [float("nan"), 1.0]))
+    assert np.isnan(out[0]) and out[1] == 1.0
+    assert round_trip(CODEC_FLOAT_XOR, []) == []
+
+
+def test_decode_batch_matches_one_by_one():
+    batches = [(CODEC_RAW, [1, 2, 3]), (CODEC_DELTA_VARINT, [5, -5, INT64_MAX]), (CODEC_BITPACK, [10, 12]),
+               (CODEC_RAW, []), (CODEC_DELTA_VARINT, [0])]
+    values, offsets = decode_batch([c for c, _ in batches], [encode(c, v) for c, v in batches])
+    for i, (_, expected) in enumerate(batches):
+        assert values[offsets[i]:offsets[i + 1]].tolist() == expected
+
+
+def test_truncated_payloads_raise():
+    with pytest.raises(ValueError):
+        decode(CODEC_DELTA_VARINT, b"\x80")
+    with pytest.raises(ValueError):
+        decode(CODEC_BITPACK, encode(CODEC_BITPACK, [1, 200, 3000])[:-1])
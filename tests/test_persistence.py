@@ -0,0 +1,91 @@
+import os
+import sys
+import csv
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from persistence import LogWriter, CsvSink, LOG_HEADER, FSYNC_NEVER  # noqa: E402
+from payload_codecs import CODEC_RAW, CODEC_DELTA_VARINT, encode, decode_batch  # noqa: E402
+
+
+def record(seq, readings=(20, 21, 22), codec=CODEC_RAW):
+    return (1700000000.0 + seq, "10.0.0.1", seq, 80, encode(codec, list(readings)), 1, codec)
+
+
+def rows(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_records_are_written_in_batches(tmp_path):
+    path = str(tmp_path / "log.csv")
+    writer = LogWriter(path, batch_size=4, flush_interval=0.05, fsync=FSYNC_NEVER)
+    for seq in range(10):
+        assert writer.submit(record(seq))
+    writer.start()
+    writer.close()
+
+    assert writer.written == 10 and writer.batches == 3  # 4 + 4 + the 2 left at the deadline
+    lines = rows(path)
+    assert lines[0] == LOG_HEADER
+    assert [int(r[2]) for r in lines[1:]] == list(range(10))
+    assert lines[1][4:] == ["3", "20 21 22"]
+
+
+def test_a_partial_batch_goes_out_after_flush_interval(tmp_path):
+    path = str(tmp_path / "log.csv")
+    writer = LogWriter(path, batch_size=100, flush_interval=0.05, fsync=FSYNC_NEVER).start()
+    try:
+        writer.submit(record(1, readings=(5, -3, 7), codec=CODEC_DELTA_VARINT))
+        deadline = time.monotonic() + 5.0
+        while writer.written < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert writer.written == 1  # Before close(): the flush interval alone wrote it
+        assert rows(path)[1][5] == "5 -3 7"
+    finally:
+        writer.close()
+
+
+def test_full_queue_drops_and_counts(tmp_path):
+    writer = LogWriter(str(tmp_path / "log.csv"), max_queue=2)
+    assert writer.submit(record(1)) and writer.submit(record(2))
+    assert not writer.submit(record(3))
+    assert writer.dropped == 1
+
+
+def write(sink, records):
+    """One batch, decoded as LogWriter does."""
+    sink.write_batch(records, *decode_batch([r[6] for r in records], [r[4] for r in records]))
+
+
+def test_csv_log_rotates_by_size(tmp_path):
+    path = str(tmp_path / "log.csv")
+    sink = CsvSink(path, rotate_bytes=200, rotate_seconds=0)
+    sink.open()
+    for seq in range(0, 30, 5):
+        write(sink, [record(s) for s in range(seq, seq + 5)])
+    sink.close()
+
+    files = sorted(os.listdir(tmp_path))
+    assert len(files) > 1 and "log.csv" in files
+    seqs = []
+    for name in files:
+        lines = rows(tmp_path / name)
+        assert lines[0] == LOG_HEADER  # Every file stands alone
+        seqs += [int(r[2]) for r in lines[1:]]
+    assert sorted(seqs) == list(range(30))  # Nothing lost or written twice
+
+
+def test_csv_log_rotates_by_age(tmp_path):
+    path = str(tmp_path / "log.csv")
+    sink = CsvSink(path, rotate_bytes=0, rotate_seconds=60)
+    sink.open()
+    write(sink, [record(1)])
+    write(sink, [record(2)])
+    assert os.listdir(tmp_path) == ["log.csv"]
+    sink._opened_at -= 61
+    write(sink, [record(3)])
+    sink.close()
+    assert len(os.listdir(tmp_path)) == 2
+    assert [int(r[2]) for r in rows(path)[1:]] == [3]
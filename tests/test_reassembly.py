@@ -0,0 +1,108 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+
+from reassembly import Reassembler  # noqa: E402
+from utils import Packet, DEVICE_ID_STRUCT, FLAG_DEVICE_ID, HEADER_SIZE, DEVICE_ID_SIZE  # noqa: E402
+
+ADDR = ("10.0.0.1", 5000)
+MTU = 64
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def frame(device_id, seq, size=200):
+    body = bytes((seq + i) % 256 for i in range(size))
+    return Packet.pack(seq, FLAG_DEVICE_ID, 80, DEVICE_ID_STRUCT.pack(device_id) + body)
+
+
+def feed_all(reassembler, fragments):
+    """The frames the fragments completed."""
+    return [out for out in (reassembler.feed(f, ADDR) for f in fragments) if out is not None]
+
+
+def test_whole_frames_pass_through():
+    reassembler = Reassembler(slots=2, max_frame=1024)
+    data = frame(1, 7, size=10)
+    assert reassembler.feed(data, ADDR) is data
+    assert len(reassembler) == 0
+
+
+def test_out_of_order_fragments_rebuild_the_frame():
+    reassembler = Reassembler(slots=2, max_frame=1024)
+    original = frame(1, 7)
+    fragments = Packet.fragment(original, MTU)
+    assert len(fragments) > 2
+    assert feed_all(reassembler, fragments[::-1]) == [original]
+    assert len(reassembler) == 0 and reassembler.completed == 1
+
+
+def test_retransmission_fills_the_gap():
+    reassembler = Reassembler(slots=2, max_frame=1024)
+    original = frame(1, 7)
+    fragments = Packet.fragment(original, MTU)
+    assert feed_all(reassembler, fragments[:1] + fragments[2:]) == []  # Second fragment lost
+    # The frame again: the part already in is skipped, the lost one completes it
+    assert feed_all(reassembler, fragments[:2]) == [original]
+    assert reassembler.duplicates == 1 and len(reassembler) == 0
+
+
+def test_frames_over_max_frame_are_refused():
+    reassembler = Reassembler(slots=2, max_frame=128)
+    assert feed_all(reassembler, Packet.fragment(frame(1, 7, size=200), MTU)) == []
+    assert len(reassembler) == 0
+    assert reassembler.refused == len(Packet.fragment(frame(1, 7, size=200), MTU))
+
+
+def test_one_device_cannot_hold_more_than_its_share():
+    reassembler = Reassembler(slots=8, max_frame=1024, per_device=2)
+    for seq in (1, 2, 3):
+        reassembler.feed(Packet.fragment(frame(1, seq), MTU)[0], ADDR)
+    assert len(reassembler) == 2 and reassembler.evicted == 1
+    assert sorted(seq for _, seq in reassembler.index) == [2, 3]  # Its oldest gave way
+    reassembler.feed(Packet.fragment(frame(2, 1), MTU)[0], ADDR)
+    assert len(reassembler) == 3  # Other devices still get slots
+
+
+def test_full_table_gives_up_the_oldest_frame():
+    reassembler = Reassembler(slots=2, max_frame=1024)
+    first = Packet.fragment(frame(1, 1), MTU)
+    reassembler.feed(first[0], ADDR)
+    reassembler.feed(Packet.fragment(frame(2, 1), MTU)[0], ADDR)
+    reassembler.feed(Packet.fragment(frame(3, 1), MTU)[0], ADDR)
+    assert len(reassembler) == 2 and reassembler.evicted == 1
+    assert (1, 1) not in reassembler.index
+    assert feed_all(reassembler, first[1:]) == []  # Its first part is gone
+
+
+def test_partial_frames_expire():
+    clock = Clock()
+    reassembler = Reassembler(slots=2, max_frame=1024, timeout=30.0, clock=clock)
+    fragments = Packet.fragment(frame(1, 7), MTU)
+    reassembler.feed(fragments[0], ADDR)
+    clock.now += 29.0
+    assert reassembler.expire() == 0
+    clock.now += 2.0
+    assert reassembler.expire() == 1
+    assert len(reassembler) == 0 and reassembler.expired == 1
+    assert feed_all(reassembler, fragments[1:]) == []  # Too late to complete the old one
+
+
+def test_fragments_of_delivered_frames_only_bring_back_the_header():
+    delivered = {(1, 7)}
+    reassembler = Reassembler(slots=2, max_frame=1024, delivered=lambda device, seq: (device, seq) in delivered)
+    original = frame(1, 7)
+    out = [reassembler.feed(f, ADDR) for f in Packet.fragment(original, MTU)]
+    assert out[0] == original[:HEADER_SIZE + DEVICE_ID_SIZE]  # Enough to ACK it again
+    assert all(o is None for o in out[1:])
+    assert len(reassembler) == 0 and reassembler.late == len(out)
+
+    fresh = frame(1, 8)
+    assert feed_all(reassembler, Packet.fragment(fresh, MTU)) == [fresh]
@@ -0,0 +1,81 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+
+from sessions import SessionTable, SEQ_NEW, SEQ_REORDERED, SEQ_DUPLICATE, SEQ_REPLAY  # noqa: E402
+from utils import Packet, FLAG_SACK, SACK_STRUCT  # noqa: E402
+
+
+def acked(table, key, seq, in_flight):
+    """What the sender makes of the ACK the gateway would send for seq."""
+    return Packet.acked_seqs(seq, FLAG_SACK, SACK_STRUCT.pack(*table.sack(key)), in_flight)
+
+
+def test_first_packet_lost_is_not_acked():
+    table = SessionTable()
+    table.update("dev", 1)
+    assert table.sack("dev") == (0, 1)
+    assert acked(table, "dev", 1, [0, 1]) == [1]
+
+
+def test_hole_stays_unacked_while_in_window():
+    table = SessionTable()
+    table.update("dev", 0)
+    for seq in range(2, 40):
+        table.update("dev", seq)
+    assert table.sack("dev")[0] == 1
+    assert 1 not in acked(table, "dev", 39, [1, 38, 39])
+
+
+def test_cumulative_passes_holes_that_left_the_window():
+    table = SessionTable()
+    table.update("dev", 0)
+    for seq in range(2, 80):
+        table.update("dev", seq)
+    assert table.check("dev", 1) == SEQ_REPLAY  # Can't be accepted any more
+    assert table.sack("dev") == (80, 0)
+
+
+def test_session_starting_at_nonzero_seq():
+    # Persistent v2 counters: a new session (next run, gateway restart, idle eviction) starts mid-range
+    table = SessionTable()
+    for seq in (1024, 1025, 1027, 1028):
+        table.update("dev", seq)
+    assert table.sack("dev") == (1026, 0b11)
+    table.update("dev", 1026)
+    assert table.sack("dev") == (1029, 0)
+
+
+def test_cumulative_advances_once_the_hole_is_filled():
+    table = SessionTable()
+    for seq in (0, 1, 2, 4, 5):
+        table.update("dev", seq)
+    assert table.sack("dev") == (3, 0b11)
+    table.update("dev", 3)
+    assert table.sack("dev") == (6, 0)
+
+
+def test_window_verdicts():
+    table = SessionTable()
+    assert table.check("dev", 5) == SEQ_NEW
+    table.update("dev", 5)
+    assert table.check("dev", 5) == SEQ_DUPLICATE
+    assert table.check("dev", 6) == SEQ_NEW
+    assert table.check("dev", 3) == SEQ_REORDERED
+    table.update("dev", 100)
+    assert table.check("dev", 5) == SEQ_REPLAY  # Below the 64-seq window
+    assert table.check("dev", 40) == SEQ_REORDERED
+    assert table.check("other", 5) == SEQ_NEW  # Windows are per device
+
+
+def test_reboot_starts_a_new_session():
+    # What the gateway does on SEQ_REPLAY: a device back at seq 0 after a reboot
+    table = SessionTable()
+    for seq in range(200, 210):
+        table.update("dev", seq)
+    assert table.check("dev", 0) == SEQ_REPLAY
+    table.forget("dev")
+    table.update("dev", 0)
+    assert table.check("dev", 0) == SEQ_DUPLICATE
+    assert table.sack("dev") == (1, 0)